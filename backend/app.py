@@ -1,8 +1,15 @@
-import os, datetime, math
-from contextlib import contextmanager
-
-from fastapi import FastAPI, Depends, HTTPException, Query
+import os, sys, datetime, calendar, math, threading, bisect, heapq, json, base64, logging, asyncio, csv, io, zlib
+import hashlib, hmac, random, unicodedata, time, re, multiprocessing, weakref
+from contextvars import ContextVar
+from array import array
+from collections import OrderedDict, Counter
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager, asynccontextmanager
+
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel, conint,  EmailStr, constr
 from dotenv import load_dotenv
@@ -10,6 +17,8 @@ from typing import Optional, Literal,  List, Dict
 from enum import Enum
 import mysql.connector
 from mysql.connector import pooling
+import aiomysql
+import numpy as np
 
 
 # --- Config ---
@@ -23,156 +32,2967 @@ MYSQL_PORT = int(os.getenv("MYSQL_PORT", "3306"))
 MYSQL_DB   = os.getenv("MYSQL_DB", "habitos_db")
 MYSQL_USER = os.getenv("MYSQL_USER", "habitos_user")
 MYSQL_PSW  = os.getenv("MYSQL_PASSWORD", "")
+# réplica de lectura opcional (mismo usuario/base); vacío = todo va al primario
+MYSQL_REPLICA_HOST = os.getenv("MYSQL_REPLICA_HOST", "")
+MYSQL_REPLICA_PORT = int(os.getenv("MYSQL_REPLICA_PORT", str(MYSQL_PORT)))
 
 CORS_ORIGINS = os.getenv("CORS_ORIGINS", "*")
 
+# pool async (endpoints calientes) y pool sync (resto de endpoints)
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "5"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "50"))
+DB_SYNC_POOL_SIZE = int(os.getenv("DB_SYNC_POOL_SIZE", "5"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "5"))
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "5000"))
+DB_STICKY_SECONDS = float(os.getenv("DB_STICKY_SECONDS", "5"))
+DB_REPLICA_RETRY_SECONDS = float(os.getenv("DB_REPLICA_RETRY_SECONDS", "30"))
+# arranque/apagado: /readyz da 503 con el pool por encima de READY_MAX_SATURATION
+# y al apagar se espera hasta DRAIN_SECONDS a que terminen los requests en curso
+READY_MAX_SATURATION = float(os.getenv("READY_MAX_SATURATION", "1.0"))
+DRAIN_SECONDS = float(os.getenv("DRAIN_SECONDS", "10"))
+# DB_WARMUP=0 arranca sin precalentar (pools e índices al primer request); sirve
+# para comparar con bench/coldstart.py
+DB_WARMUP = os.getenv("DB_WARMUP", "1") != "0"
+
+log = logging.getLogger("habitos")
+
+# --- Instrumentación (consultas por ruta + /metrics) ---
+# Un middleware abre un _ReqStats por request (ContextVar, también visible en
+# el threadpool) y get_conn/get_aconn entregan conexiones cuyos cursores
+# cuentan consultas, tiempo en BD y filas. Al terminar se vuelca en METRICS.
+SLOW_QUERY_MS = float(os.getenv("SLOW_QUERY_MS", "200"))
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+slow_log = logging.getLogger("habitos.slow")
+
+
+class _ReqStats:
+    __slots__ = ("scope", "queries", "db", "pool_wait", "rows")
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.queries = 0
+        self.db = 0.0
+        self.pool_wait = 0.0
+        self.rows = 0
+
+    def route(self) -> str:
+        return _route_label(self.scope)
+
+
+_REQ: ContextVar[Optional[_ReqStats]] = ContextVar("habitos_req", default=None)
+
+
+def _route_label(scope) -> str:
+    # plantilla de la ruta (/posts/{post_id}/like), no la URL: cardinalidad acotada
+    return getattr(scope.get("route"), "path", "other")
+
+
+_SQL_PARAM = re.compile(r"%s|'(?:[^'\\]|\\.|'')*'|\b\d+(?:\.\d+)?\b")
+_SQL_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))*")
+
+
+def normalize_sql(sql: str) -> str:
+    # parámetros y literales -> ?, listas IN (...) / VALUES (...),(...) colapsadas
+    sql = " ".join(sql.split())
+    sql = _SQL_PARAM.sub("?", sql)
+    return _SQL_LIST.sub("(...)", sql)
+
+
+def _note_query(sql: str, seconds: float):
+    st = _REQ.get()
+    if st is not None:
+        st.queries += 1
+        st.db += seconds
+    if seconds * 1000 >= SLOW_QUERY_MS:
+        route = st.route() if st is not None else "background"
+        METRICS.slow_query(route)
+        slow_log.warning("slow query %.1f ms [%s] %s", seconds * 1000, route, normalize_sql(sql))
+
+
+def _note_fetch(rows: int, seconds: float):
+    st = _REQ.get()
+    if st is not None:
+        st.rows += rows
+        st.db += seconds
+
+
+def _note_pool_wait(seconds: float):
+    st = _REQ.get()
+    if st is not None:
+        st.pool_wait += seconds
+
+
+class _TracedCursor:
+    # proxy de un cursor de mysql.connector; lo demás (rowcount, lastrowid...) se delega
+    __slots__ = ("_cur",)
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    def __iter__(self):
+        return iter(self._cur)
+
+    def execute(self, sql, params=()):
+        t0 = time.perf_counter()
+        try:
+            return self._cur.execute(sql, params)
+        finally:
+            _note_query(sql, time.perf_counter() - t0)
+
+    def executemany(self, sql, seq_params):
+        t0 = time.perf_counter()
+        try:
+            return self._cur.executemany(sql, seq_params)
+        finally:
+            _note_query(sql, time.perf_counter() - t0)
+
+    def fetchone(self):
+        t0 = time.perf_counter()
+        row = self._cur.fetchone()
+        _note_fetch(row is not None, time.perf_counter() - t0)
+        return row
+
+    def fetchmany(self, size: int = 1):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchmany(size)
+        _note_fetch(len(rows), time.perf_counter() - t0)
+        return rows
+
+    def fetchall(self):
+        t0 = time.perf_counter()
+        rows = self._cur.fetchall()
+        _note_fetch(len(rows), time.perf_counter() - t0)
+        return rows
+
+
+class _TracedConn:
+    __slots__ = ("_con",)
+
+    def __init__(self, con):
+        self._con = con
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    def cursor(self, *args, **kwargs):
+        return _TracedCursor(self._con.cursor(*args, **kwargs))
+
+
+class _ATracedCursor:
+    # igual que _TracedCursor para cursores de aiomysql
+    __slots__ = ("_cur",)
+
+    def __init__(self, cur):
+        self._cur = cur
+
+    def __getattr__(self, name):
+        return getattr(self._cur, name)
+
+    async def execute(self, sql, args=None):
+        t0 = time.perf_counter()
+        try:
+            return await self._cur.execute(sql, args)
+        finally:
+            _note_query(sql, time.perf_counter() - t0)
+
+    async def executemany(self, sql, args):
+        t0 = time.perf_counter()
+        try:
+            return await self._cur.executemany(sql, args)
+        finally:
+            _note_query(sql, time.perf_counter() - t0)
+
+    async def fetchone(self):
+        t0 = time.perf_counter()
+        row = await self._cur.fetchone()
+        _note_fetch(row is not None, time.perf_counter() - t0)
+        return row
+
+    async def fetchmany(self, size: Optional[int] = None):
+        t0 = time.perf_counter()
+        rows = await self._cur.fetchmany(size)
+        _note_fetch(len(rows), time.perf_counter() - t0)
+        return rows
+
+    async def fetchall(self):
+        t0 = time.perf_counter()
+        rows = await self._cur.fetchall()
+        _note_fetch(len(rows), time.perf_counter() - t0)
+        return rows
+
+
+class _ATracedConn:
+    __slots__ = ("_con",)
+
+    def __init__(self, con):
+        self._con = con
+
+    def __getattr__(self, name):
+        return getattr(self._con, name)
+
+    async def cursor(self, *args):
+        return _ATracedCursor(await self._con.cursor(*args))
+
+
+class _Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, v: float):
+        i = bisect.bisect_left(self.buckets, v)
+        if i < len(self.counts):
+            self.counts[i] += 1
+        self.sum += v
+        self.count += 1
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        out, acc = [], 0
+        for b, c in zip(self.buckets, self.counts):
+            acc += c
+            out.append(f'{name}_bucket{{{labels},le="{b}"}} {acc}')
+        out.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        out.append(f"{name}_sum{{{labels}}} {self.sum:.6f}")
+        out.append(f"{name}_count{{{labels}}} {self.count}")
+        return out
+
+
+class _RouteMetrics:
+    __slots__ = ("statuses", "queries", "db", "pool_wait", "rows", "latency", "per_request")
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+        self.queries = 0
+        self.db = 0.0
+        self.pool_wait = 0.0
+        self.rows = 0
+        self.latency = _Histogram(LATENCY_BUCKETS)
+        self.per_request = _Histogram(QUERY_BUCKETS)
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes: Dict[tuple, _RouteMetrics] = {}
+        self._slow: Dict[str, int] = {}
+        self.pool_exhausted = 0
+
+    def observe(self, method: str, route: str, status: int, elapsed: float, st: _ReqStats):
+        with self._lock:
+            m = self._routes.get((method, route))
+            if m is None:
+                m = self._routes[(method, route)] = _RouteMetrics()
+            m.statuses[status] = m.statuses.get(status, 0) + 1
+            m.queries += st.queries
+            m.db += st.db
+            m.pool_wait += st.pool_wait
+            m.rows += st.rows
+            m.latency.observe(elapsed)
+            m.per_request.observe(st.queries)
+
+    def slow_query(self, route: str):
+        with self._lock:
+            self._slow[route] = self._slow.get(route, 0) + 1
+
+    def pool_error(self):
+        with self._lock:
+            self.pool_exhausted += 1
+
+    def render(self, gauges: Dict[str, float]) -> str:
+        def block(name, kind, help_, lines):
+            return [f"# HELP {name} {help_}", f"# TYPE {name} {kind}", *lines]
+
+        with self._lock:
+            items = sorted(self._routes.items())
+            lab = {k: f'method="{k[0]}",route="{k[1]}"' for k, _ in items}
+            out = []
+            out += block("habitos_requests_total", "counter", "Requests por ruta y status", [
+                f'habitos_requests_total{{{lab[k]},status="{code}"}} {n}'
+                for k, m in items for code, n in sorted(m.statuses.items())])
+            out += block("habitos_db_queries_total", "counter", "Consultas SQL ejecutadas",
+                         [f"habitos_db_queries_total{{{lab[k]}}} {m.queries}" for k, m in items])
+            out += block("habitos_db_seconds_total", "counter", "Tiempo en BD (execute + fetch)",
+                         [f"habitos_db_seconds_total{{{lab[k]}}} {m.db:.6f}" for k, m in items])
+            out += block("habitos_db_pool_wait_seconds_total", "counter", "Espera por una conexión del pool",
+                         [f"habitos_db_pool_wait_seconds_total{{{lab[k]}}} {m.pool_wait:.6f}" for k, m in items])
+            out += block("habitos_db_rows_fetched_total", "counter", "Filas leídas",
+                         [f"habitos_db_rows_fetched_total{{{lab[k]}}} {m.rows}" for k, m in items])
+            out += block("habitos_request_duration_seconds", "histogram", "Latencia por ruta",
+                         [l for k, m in items for l in m.latency.lines("habitos_request_duration_seconds", lab[k])])
+            out += block("habitos_db_queries_per_request", "histogram", "Consultas por request (N+1)",
+                         [l for k, m in items for l in m.per_request.lines("habitos_db_queries_per_request", lab[k])])
+            out += block("habitos_slow_queries_total", "counter", f"Consultas >= {SLOW_QUERY_MS:g} ms",
+                         [f'habitos_slow_queries_total{{route="{r}"}} {n}' for r, n in sorted(self._slow.items())])
+            out += block("habitos_db_pool_exhausted_total", "counter", "Pool sync sin conexiones libres",
+                         [f"habitos_db_pool_exhausted_total {self.pool_exhausted}"])
+        out += block("habitos_db_pool_connections", "gauge", "Conexiones del pool async",
+                     [f'habitos_db_pool_connections{{state="{k}"}} {v}' for k, v in gauges.items()])
+        return "\n".join(out) + "\n"
+
+
+METRICS = Metrics()
+
+# --- Versiones (ETag / GET condicional) ---
+# Contadores en memoria por usuario ("habits", "logs", "friends", "profile"),
+# por post ("post") y globales ("posts", "rank"). Cada escritura sube, después
+# del commit, los que afecta; los GET que se repiten arman su ETag con ellos
+# antes de consultar MySQL, y si coincide con If-None-Match responden 304.
+# BOOT_NONCE cambia en cada arranque (y en cada worker), así que un ETag de otro
+# proceso nunca coincide aunque los contadores hayan vuelto a cero.
+BOOT_NONCE = os.urandom(6).hex()
+
+
+class Versions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._v: Dict[tuple, int] = {}
+        self.seq = 0        # sube con cada bump: detecta escrituras durante una lectura
+
+    def bump(self, *keys: tuple):
+        with self._lock:
+            self.seq += 1
+            for k in keys:
+                self._v[k] = self._v.get(k, 0) + 1
+
+    def etag(self, parts: tuple, keys) -> str:
+        keys = [("all",), *keys]      # ("all",): invalida todo (reparaciones)
+        with self._lock:
+            vals = [self._v.get(k, 0) for k in keys]
+        digest = hashlib.blake2b(repr((parts, keys, vals)).encode(), digest_size=12).hexdigest()
+        return f'"{BOOT_NONCE}-{digest}"'
+
+
+VERSIONS = Versions()
+
+
+def _if_none_match(request: Request, etag: str) -> bool:
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in header.split(",")]
+    return "*" in tags or etag in tags
+
+
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def _set_etag(response: Response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+
+# --- Ruteo lectura/escritura ---
+# get_conn/get_aconn(read_only=True, user_id=...) mandan la lectura a la réplica
+# salvo que ese usuario haya escrito hace menos de DB_STICKY_SECONDS
+# (read-your-writes: un mark_today recién hecho se ve en /stats/weekly). Las
+# escrituras con user_id marcan esa ventana al hacer commit. Si la réplica
+# falla, se lee del primario y no se vuelve a intentar por
+# DB_REPLICA_RETRY_SECONDS. Las cargas de estructuras en memoria con token de
+# escrituras (ranking, bitmaps, timelines, caché de perfiles...) siempre leen
+# del primario: con lag, una carga podría instalar datos viejos sin que el
+# token lo note. Lo mismo para las lecturas que responden con ETag (VERSIONS):
+# el ETag ya refleja la escritura y el cuerpo tiene que hacerlo también.
+# La ventana es por proceso, como todo el estado en memoria (un solo worker,
+# ver _check_single_worker).
+class DbRouter:
+    def __init__(self, enabled: bool):
+        self._lock = threading.Lock()
+        self.enabled = enabled
+        self._sticky: Dict[int, float] = {}    # user_id -> monotonic hasta cuándo
+        self._down_until = 0.0
+        self.reads = {"replica": 0, "primary": 0, "sticky": 0, "fallback": 0}
+
+    def touch(self, user_id: int):
+        now = time.monotonic()
+        with self._lock:
+            self._sticky[user_id] = now + DB_STICKY_SECONDS
+            if len(self._sticky) > 100_000:
+                self._sticky = {u: t for u, t in self._sticky.items() if t > now}
+
+    def use_replica(self, user_id: Optional[int]) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            if not self.enabled or now < self._down_until:
+                self.reads["primary"] += 1
+                return False
+            if user_id is not None and self._sticky.get(user_id, 0) > now:
+                self.reads["sticky"] += 1
+                return False
+            self.reads["replica"] += 1
+            return True
+
+    def replica_failed(self, exc: Exception):
+        with self._lock:
+            self.reads["fallback"] += 1
+            first = time.monotonic() >= self._down_until
+            self._down_until = time.monotonic() + DB_REPLICA_RETRY_SECONDS
+        if first:
+            log.warning("réplica no disponible, leyendo del primario por %ss: %s", DB_REPLICA_RETRY_SECONDS, exc)
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [
+                "# HELP habitos_db_reads_total Lecturas ruteadas por destino",
+                "# TYPE habitos_db_reads_total counter",
+                *(f'habitos_db_reads_total{{target="{k}"}} {v}' for k, v in self.reads.items()),
+                "# HELP habitos_db_replica_up Réplica configurada y disponible",
+                "# TYPE habitos_db_replica_up gauge",
+                f"habitos_db_replica_up {int(self.enabled and time.monotonic() >= self._down_until)}",
+            ]
+        return "\n".join(lines) + "\n"
+
+
+ROUTER = DbRouter(bool(MYSQL_REPLICA_HOST))
+
 # --- Pool de conexiones ---
-POOL = pooling.MySQLConnectionPool(
-    pool_name="habitos_pool",
-    pool_size=5,
-    host=MYSQL_HOST,
-    port=MYSQL_PORT,
-    database=MYSQL_DB,
-    user=MYSQL_USER,
-    password=MYSQL_PSW,
-    charset="utf8mb4",
-    collation="utf8mb4_0900_ai_ci",
-    autocommit=False,
-)
+# No se abre al importar el módulo: lo abre el lifespan al arrancar (y lo
+# precalienta). Si algo lo usa antes (un script, una tarea), se crea al vuelo.
+POOL: Optional[pooling.MySQLConnectionPool] = None
+_POOL_LOCK = threading.Lock()
+_SYNC_IN_USE = 0
+
+
+def open_sync_pool() -> pooling.MySQLConnectionPool:
+    global POOL
+    with _POOL_LOCK:
+        if POOL is None:
+            POOL = pooling.MySQLConnectionPool(
+                pool_name="habitos_pool",
+                pool_size=DB_SYNC_POOL_SIZE,
+                # no usamos estado de sesión propio: sin reset, devolver una
+                # conexión no cuesta un round-trip extra
+                pool_reset_session=False,
+                host=MYSQL_HOST,
+                port=MYSQL_PORT,
+                database=MYSQL_DB,
+                user=MYSQL_USER,
+                password=MYSQL_PSW,
+                charset="utf8mb4",
+                collation="utf8mb4_0900_ai_ci",
+                autocommit=False,
+            )
+        return POOL
+
+
+def _sync_in_use(delta: int):
+    global _SYNC_IN_USE
+    with _POOL_LOCK:
+        _SYNC_IN_USE += delta
+
+
+RPOOL: Optional[pooling.MySQLConnectionPool] = None
+_RPOOL_LOCK = threading.Lock()
+
+
+def _replica_pool() -> pooling.MySQLConnectionPool:
+    # se crea al primer uso: una réplica caída no impide arrancar
+    global RPOOL
+    with _RPOOL_LOCK:
+        if RPOOL is None:
+            RPOOL = pooling.MySQLConnectionPool(
+                pool_name="habitos_replica",
+                pool_size=DB_SYNC_POOL_SIZE,
+                host=MYSQL_REPLICA_HOST,
+                port=MYSQL_REPLICA_PORT,
+                database=MYSQL_DB,
+                user=MYSQL_USER,
+                password=MYSQL_PSW,
+                charset="utf8mb4",
+                collation="utf8mb4_0900_ai_ci",
+                autocommit=False,
+            )
+        return RPOOL
+
 
 @contextmanager
-def get_conn():
-    con = POOL.get_connection()
+def get_conn(read_only: bool = False, user_id: Optional[int] = None):
+    t0 = time.perf_counter()
+    con = None
+    if read_only and ROUTER.use_replica(user_id):
+        try:
+            con = _replica_pool().get_connection()
+        except mysql.connector.errors.PoolError:
+            pass                                  # réplica ocupada: esta vez, primario
+        except mysql.connector.Error as e:
+            ROUTER.replica_failed(e)
+    replica = con is not None
+    if con is None:
+        try:
+            con = (POOL or open_sync_pool()).get_connection()
+        except mysql.connector.errors.PoolError:
+            METRICS.pool_error()
+            raise
+        _sync_in_use(1)
+    _note_pool_wait(time.perf_counter() - t0)
     try:
-        yield con
+        yield _TracedConn(con)
         con.commit()
-    except Exception:
-        con.rollback()
+    except Exception as e:
+        try:
+            con.rollback()
+        except mysql.connector.Error:
+            pass
+        if replica and isinstance(e, (mysql.connector.errors.OperationalError, mysql.connector.errors.InterfaceError)):
+            ROUTER.replica_failed(e)
         raise
     finally:
         con.close()
+        if not replica:
+            _sync_in_use(-1)
+    if user_id is not None and not read_only:
+        ROUTER.touch(user_id)
+
+# --- Pool async (aiomysql) ---
+# Los endpoints `async def` no bloquean el event loop: esperan la conexión
+# (con límite DB_ACQUIRE_TIMEOUT) y el servidor corta las sentencias lentas
+# (max_execution_time para SELECT, innodb_lock_wait_timeout para bloqueos).
+APOOL: Optional[aiomysql.Pool] = None
+ARPOOL: Optional[aiomysql.Pool] = None   # réplica (si MYSQL_REPLICA_HOST)
+_TIMEOUT_ERRORS = (3024, 1205)   # max_execution_time excedido, lock wait timeout
+
+
+async def _create_apool(host: str, port: int, minsize: int) -> aiomysql.Pool:
+    return await aiomysql.create_pool(
+        minsize=minsize,
+        maxsize=DB_POOL_MAX,
+        host=host,
+        port=port,
+        db=MYSQL_DB,
+        user=MYSQL_USER,
+        password=MYSQL_PSW,
+        charset="utf8mb4",
+        autocommit=False,
+        init_command=(
+            f"SET SESSION max_execution_time={DB_STATEMENT_TIMEOUT_MS}, "
+            f"SESSION innodb_lock_wait_timeout={max(1, math.ceil(DB_STATEMENT_TIMEOUT_MS / 1000))}"
+        ),
+    )
+
+
+async def open_async_pool():
+    global APOOL
+    if APOOL is None:
+        APOOL = await _create_apool(MYSQL_HOST, MYSQL_PORT, DB_POOL_MIN)
+
+
+async def _areplica_pool() -> aiomysql.Pool:
+    # como _replica_pool: se crea al primer uso (minsize 0, no conecta aún)
+    global ARPOOL
+    if ARPOOL is None:
+        ARPOOL = await _create_apool(MYSQL_REPLICA_HOST, MYSQL_REPLICA_PORT, 0)
+    return ARPOOL
+
+
+async def close_async_pool(timeout: Optional[float] = None):
+    # close() deja de entregar conexiones; wait_closed() espera a que vuelvan
+    # las prestadas. Pasado `timeout`, se cortan.
+    global APOOL, ARPOOL
+    for pool in (APOOL, ARPOOL):
+        if pool is not None:
+            pool.close()
+            try:
+                await asyncio.wait_for(pool.wait_closed(), timeout)
+            except asyncio.TimeoutError:
+                pool.terminate()
+                await pool.wait_closed()
+    APOOL = ARPOOL = None
+
+
+@asynccontextmanager
+async def get_aconn(read_only: bool = False, user_id: Optional[int] = None):
+    if APOOL is None:
+        await open_async_pool()
+    t0 = time.perf_counter()
+    pool, con = APOOL, None
+    if read_only and ROUTER.use_replica(user_id):
+        try:
+            rpool = await _areplica_pool()
+            con = await asyncio.wait_for(rpool.acquire(), DB_ACQUIRE_TIMEOUT)
+            pool = rpool
+        except asyncio.TimeoutError as e:
+            if ARPOOL is None or ARPOOL.size < ARPOOL.maxsize:
+                ROUTER.replica_failed(e)          # no llegó a conectar
+            # si no, réplica ocupada: esta vez, primario
+        except (aiomysql.Error, OSError) as e:
+            ROUTER.replica_failed(e)
+    replica = pool is not APOOL
+    if con is None:
+        try:
+            con = await asyncio.wait_for(APOOL.acquire(), DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            METRICS.pool_error()
+            raise HTTPException(503, "Base de datos saturada, intenta de nuevo")
+    _note_pool_wait(time.perf_counter() - t0)
+    try:
+        yield _ATracedConn(con)
+        await con.commit()
+    except Exception as e:
+        try:
+            await con.rollback()
+        except (aiomysql.Error, OSError):
+            pass
+        if isinstance(e, aiomysql.OperationalError) and e.args and e.args[0] in _TIMEOUT_ERRORS:
+            raise HTTPException(504, "La consulta excedió el tiempo límite")
+        if replica and isinstance(e, (aiomysql.OperationalError, aiomysql.InterfaceError)):
+            ROUTER.replica_failed(e)
+        raise
+    finally:
+        pool.release(con)
+    if user_id is not None and not read_only:
+        ROUTER.touch(user_id)
+
+# --- Sentencias preparadas (consultas calientes) ---
+# Consultas grandes y calientes registradas con nombre que corren como
+# sentencias preparadas del servidor: MySQL las parsea y optimiza una vez por
+# conexión y no en cada llamada. aiomysql solo habla el protocolo de texto, así
+# que se usa PREPARE/EXECUTE de SQL con variables de sesión: un SET y después
+# el EXECUTE, en dos llamadas (el pool no habilita multi-statements). Ese viaje
+# extra solo compensa en consultas caras de parsear (el feed); las de una fila
+# (likes, mark_today) siguen como cur.execute normal. Cada
+# conexión recuerda qué preparó: una conexión nueva (reconexión, pool
+# recreado) empieza vacía y prepara al primer uso, y si el servidor ya no
+# conoce la sentencia (1243) se vuelve a preparar.
+_ER_UNKNOWN_STMT_HANDLER = 1243
+_STMT_NAME = re.compile(r"^[a-z_]+$")
+
+
+class Statements:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._sql: Dict[str, str] = {}
+        self._set: Dict[str, str] = {}
+        self._call: Dict[str, str] = {}
+        self._nparams: Dict[str, int] = {}
+        self._prepared = weakref.WeakKeyDictionary()    # conexión aiomysql -> {nombre}
+        self.calls: Dict[str, int] = {}
+        self.seconds: Dict[str, float] = {}
+        self.prepares: Dict[str, int] = {}
+
+    def define(self, name: str, sql: str) -> str:
+        # placeholders con ? (sintaxis de PREPARE), no %s
+        assert _STMT_NAME.match(name) and name not in self._sql, name
+        n = sql.count("?")
+        self._sql[name] = " ".join(sql.split())
+        self._nparams[name] = n
+        if n:
+            self._set[name] = "SET " + ", ".join(f"@hp{i} = %s" for i in range(n))
+            self._call[name] = f"EXECUTE stmt_{name} USING " + ", ".join(f"@hp{i}" for i in range(n))
+        else:
+            self._call[name] = f"EXECUTE stmt_{name}"
+        self.calls[name] = self.seconds[name] = self.prepares[name] = 0
+        return name
+
+    async def _prepare(self, cur, name: str):
+        await cur.execute(f"PREPARE stmt_{name} FROM %s", (self._sql[name],))
+        self._prepared.setdefault(cur.connection, set()).add(name)
+        with self._lock:
+            self.prepares[name] += 1
+
+    async def prepare_all(self, cur):
+        # arranque: deja todas preparadas en una conexión recién abierta
+        for name in self._sql:
+            await self._prepare(cur, name)
+
+    async def run(self, cur, name: str, params: tuple = ()):
+        # cur: cursor de get_aconn(); después se leen filas/rowcount como siempre
+        if len(params) != self._nparams[name]:
+            raise TypeError(f"{name}: se esperaban {self._nparams[name]} parámetros")
+        t0 = time.perf_counter()
+        for retry in (False, True):
+            if name not in self._prepared.get(cur.connection, ()):
+                await self._prepare(cur, name)
+            try:
+                if params:
+                    await cur.execute(self._set[name], params)
+                await cur.execute(self._call[name])
+                break
+            except aiomysql.MySQLError as e:
+                if retry or not e.args or e.args[0] != _ER_UNKNOWN_STMT_HANDLER:
+                    raise
+                self._prepared.pop(cur.connection, None)
+        with self._lock:
+            self.calls[name] += 1
+            self.seconds[name] += time.perf_counter() - t0
+
+    def render(self) -> str:
+        with self._lock:
+            names = sorted(self._sql)
+            lines = [
+                "# HELP habitos_stmt_executions_total Ejecuciones por sentencia preparada",
+                "# TYPE habitos_stmt_executions_total counter",
+                *(f'habitos_stmt_executions_total{{stmt="{n}"}} {self.calls[n]}' for n in names),
+                "# HELP habitos_stmt_seconds_total Tiempo de SET + EXECUTE por sentencia",
+                "# TYPE habitos_stmt_seconds_total counter",
+                *(f'habitos_stmt_seconds_total{{stmt="{n}"}} {self.seconds[n]:.6f}' for n in names),
+                "# HELP habitos_stmt_prepares_total PREPARE enviados (conexiones nuevas o re-preparadas)",
+                "# TYPE habitos_stmt_prepares_total counter",
+                *(f'habitos_stmt_prepares_total{{stmt="{n}"}} {self.prepares[n]}' for n in names),
+            ]
+        return "\n".join(lines) + "\n"
+
+
+STATEMENTS = Statements()
+
+# --- Motor de estadísticas (bitmap de días por hábito) ---
+# Por cada hábito se guarda un entero de Python usado como bitset: el bit k
+# indica que el día (origin + k) se cumplió. Un usuario se carga completo con
+# una sola consulta y desde ahí mark_today/add_habit/delete_habit lo mantienen.
+# El estado vive en memoria del proceso (un worker = una copia).
+STATS_MAX_WINDOW = 365
+STATS_MAX_USERS = int(os.getenv("STATS_MAX_USERS", "20000"))
+
+
+class _UserBits:
+    __slots__ = ("habits", "bits")
+
+    def __init__(self):
+        self.habits: Dict[int, str] = {}        # habit_id -> name (orden por id)
+        self.bits: Dict[int, List[int]] = {}    # habit_id -> [origin, bitset]
+
+
+def _bits_set(entry: List[int], ordinal: int, value: int):
+    origin, bits = entry
+    k = ordinal - origin
+    if k < 0:
+        bits <<= -k
+        origin, k = ordinal, 0
+    if value:
+        bits |= 1 << k
+    else:
+        bits &= ~(1 << k)
+    # recorta historia vieja para que el bitset no crezca sin límite
+    floor = ordinal - 2 * STATS_MAX_WINDOW
+    if origin < floor:
+        bits >>= floor - origin
+        origin = floor
+    entry[0], entry[1] = origin, bits
+
+
+def _bits_count(entry: List[int], first: int, last: int) -> int:
+    origin, bits = entry
+    lo, hi = first - origin, last - origin
+    if hi < 0:
+        return 0
+    lo = max(lo, 0)
+    return ((bits >> lo) & ((1 << (hi - lo + 1)) - 1)).bit_count()
+
+
+class _LoadTokens:
+    # Escrituras por clave mientras se carga esa clave desde la base (detecta
+    # carreras al cargar). Solo guarda claves con cargas en curso: begin() la
+    # registra, touch() cuenta una escritura y end() devuelve el conteo y la
+    # suelta con la última carga. Sin lock propio: lo usa bajo el del dueño.
+    def __init__(self):
+        self._keys: Dict[int, List[int]] = {}   # clave -> [cargas en curso, escrituras]
+
+    def begin(self, key: int) -> int:
+        entry = self._keys.setdefault(key, [0, 0])
+        entry[0] += 1
+        return entry[1]
+
+    def touch(self, key: int):
+        entry = self._keys.get(key)
+        if entry is not None:
+            entry[1] += 1
+
+    def end(self, key: int) -> Optional[int]:
+        entry = self._keys.get(key)
+        if entry is None:
+            return None
+        entry[0] -= 1
+        if not entry[0]:
+            del self._keys[key]
+        return entry[1]
+
+
+class HabitBitmaps:
+    def __init__(self, max_users: int):
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[int, _UserBits]" = OrderedDict()
+        self._loads = _LoadTokens()         # user_id -> escrituras durante su carga
+        self._max_users = max_users
+
+    def begin_load(self, user_id: int) -> int:
+        # cada begin_load termina en load_user o, si la lectura falla, en end_load
+        with self._lock:
+            return self._loads.begin(user_id)
+
+    def end_load(self, user_id: int):
+        with self._lock:
+            self._loads.end(user_id)
+
+    def load_user(self, user_id: int, rows, token: int) -> _UserBits:
+        # rows: (id, name, day) con day=None si el hábito no tiene días cumplidos
+        ub = _UserBits()
+        origin = datetime.date.today().toordinal() - STATS_MAX_WINDOW + 1
+        try:
+            for r in rows:
+                ub.habits.setdefault(r["id"], r["name"])
+                entry = ub.bits.setdefault(r["id"], [origin, 0])
+                if r["day"] is not None:
+                    _bits_set(entry, r["day"].toordinal(), 1)
+        except Exception:
+            self.end_load(user_id)
+            raise
+        with self._lock:
+            # si hubo una escritura mientras leíamos, no instalamos (se recarga luego)
+            if self._loads.end(user_id) == token:
+                self._users[user_id] = ub
+                self._users.move_to_end(user_id)
+                while len(self._users) > self._max_users:
+                    self._users.popitem(last=False)
+        return ub
+
+    def get(self, user_id: int) -> Optional[_UserBits]:
+        with self._lock:
+            ub = self._users.get(user_id)
+            if ub is not None:
+                self._users.move_to_end(user_id)
+            return ub
+
+    def set_day(self, user_id: int, habit_id: int, day: datetime.date, value: int):
+        with self._lock:
+            self._loads.touch(user_id)
+            ub = self._users.get(user_id)
+            if ub is not None and habit_id in ub.bits:
+                _bits_set(ub.bits[habit_id], day.toordinal(), value)
+
+    def add_habit(self, user_id: int, habit_id: int, name: str):
+        with self._lock:
+            self._loads.touch(user_id)
+            ub = self._users.get(user_id)
+            if ub is not None:
+                ub.habits[habit_id] = name
+                ub.bits[habit_id] = [datetime.date.today().toordinal(), 0]
+
+    def drop_habit(self, user_id: int, habit_id: int):
+        with self._lock:
+            self._loads.touch(user_id)
+            ub = self._users.get(user_id)
+            if ub is not None:
+                ub.habits.pop(habit_id, None)
+                ub.bits.pop(habit_id, None)
+
+    def window(self, ub: _UserBits, window: int, today: datetime.date) -> List[Dict]:
+        last = today.toordinal()
+        first = last - window + 1
+        with self._lock:
+            return [
+                {
+                    "habit_id": hid,
+                    "habit_name": name,
+                    "done": _bits_count(ub.bits[hid], first, last),
+                    "total_days": window,
+                    "today_done": bool(_bits_count(ub.bits[hid], last, last)),
+                }
+                for hid, name in ub.habits.items()
+            ]
+
+
+STATS = HabitBitmaps(STATS_MAX_USERS)
+
+# --- Heatmap anual (bits empaquetados por hábito y año) ---
+# Cada (usuario, año) es una matriz uint8 de (hábitos x 46): 366 bits por fila,
+# bit k = día k del año (np.packbits, orden big-endian). Las agregaciones son
+# vectoriales: unpackbits + sum por eje, popcount por tabla de bytes.
+HEATMAP_MAX_USERS = int(os.getenv("HEATMAP_MAX_USERS", "5000"))
+_YEAR_BYTES = 46
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint16)
+
+
+class _YearBits:
+    __slots__ = ("rows", "names", "packed")
+
+    def __init__(self, habits: List[tuple], packed: np.ndarray):
+        self.rows = {hid: i for i, (hid, _) in enumerate(habits)}   # habit_id -> fila
+        self.names = [name for _, name in habits]
+        self.packed = packed
+
+
+class HeatmapStore:
+    def __init__(self, max_users: int):
+        self._lock = threading.Lock()
+        self._users: "OrderedDict[int, Dict[int, _YearBits]]" = OrderedDict()
+        self._loads = _LoadTokens()         # user_id -> escrituras durante su carga
+        self._max_users = max_users
+
+    def begin_load(self, user_id: int) -> int:
+        # cada begin_load termina en load o, si la lectura falla, en end_load
+        with self._lock:
+            return self._loads.begin(user_id)
+
+    def end_load(self, user_id: int):
+        with self._lock:
+            self._loads.end(user_id)
+
+    def get(self, user_id: int, year: int) -> Optional[_YearBits]:
+        with self._lock:
+            years = self._users.get(user_id)
+            if years is None or year not in years:
+                return None
+            self._users.move_to_end(user_id)
+            return years[year]
+
+    def load(self, user_id: int, year: int, rows, token: int) -> _YearBits:
+        # rows: (id, name, day) con day=None si el hábito no tiene días ese año
+        habits: Dict[int, str] = {}
+        marks = []
+        jan1 = datetime.date(year, 1, 1).toordinal()
+        try:
+            for hid, name, day in rows:
+                habits.setdefault(hid, name)
+                if day is not None:
+                    marks.append((hid, day.toordinal() - jan1))
+            yb_habits = list(habits.items())
+            dense = np.zeros((len(yb_habits), _YEAR_BYTES * 8), dtype=np.uint8)
+            index = {hid: i for i, (hid, _) in enumerate(yb_habits)}
+            if marks:
+                r, c = zip(*((index[h], k) for h, k in marks))
+                dense[list(r), list(c)] = 1
+            yb = _YearBits(yb_habits, np.packbits(dense, axis=1))
+        except Exception:
+            self.end_load(user_id)
+            raise
+        with self._lock:
+            if self._loads.end(user_id) == token:
+                self._users.setdefault(user_id, {})[year] = yb
+                self._users.move_to_end(user_id)
+                while len(self._users) > self._max_users:
+                    self._users.popitem(last=False)
+        return yb
+
+    def set_day(self, user_id: int, habit_id: int, day: datetime.date, value: int):
+        with self._lock:
+            self._loads.touch(user_id)
+            yb = self._users.get(user_id, {}).get(day.year)
+            if yb is None or habit_id not in yb.rows:
+                return
+            k = day.timetuple().tm_yday - 1
+            mask = np.uint8(0x80 >> (k & 7))
+            row = yb.rows[habit_id]
+            if value:
+                yb.packed[row, k >> 3] |= mask
+            else:
+                yb.packed[row, k >> 3] &= ~mask
+
+    def add_habit(self, user_id: int, habit_id: int, name: str):
+        with self._lock:
+            self._loads.touch(user_id)
+            for yb in self._users.get(user_id, {}).values():
+                yb.rows[habit_id] = len(yb.names)
+                yb.names.append(name)
+                yb.packed = np.vstack([yb.packed, np.zeros((1, _YEAR_BYTES), dtype=np.uint8)])
+
+    def drop_habit(self, user_id: int, habit_id: int):
+        with self._lock:
+            self._loads.touch(user_id)
+            # más simple que reindexar filas: se recargan los años de ese usuario
+            self._users.pop(user_id, None)
+
+    def aggregate(self, yb: _YearBits, year: int, per_habit: bool) -> Dict:
+        ndays = 366 if calendar.isleap(year) else 365
+        with self._lock:
+            packed = yb.packed.copy()
+            habits = sorted(yb.rows.items(), key=lambda t: t[1])
+            names = list(yb.names)
+        bits = np.unpackbits(packed, axis=1, count=ndays)          # (hábitos, días)
+        per_day = bits.sum(axis=0, dtype=np.int32)
+        done = _POPCOUNT[packed].sum(axis=1)
+        out = {
+            "days": per_day.tolist(),
+            "total": int(per_day.sum()),
+            "max": int(per_day.max()) if ndays and len(habits) else 0,
+            "active_days": int(np.count_nonzero(per_day)),
+        }
+        if per_habit:
+            out["habits"] = [
+                {"habit_id": hid, "habit_name": names[i], "done": int(done[i]), "series": bits[i].tolist()}
+                for hid, i in habits
+            ]
+        return out
+
+
+HEATMAP = HeatmapStore(HEATMAP_MAX_USERS)
+
+# --- Directorio de perfiles públicos ---
+# id -> {id, username, bio} de los perfiles con is_public=1. Se carga una vez
+# y lo mantiene set_profile_visibility.
+LOAD_RETRIES = 3
+
+
+def _fold(s: str) -> str:
+    # minúsculas y sin tildes (equivalente a comparar con *_ai_ci)
+    s = unicodedata.normalize("NFKD", s.casefold())
+    return "".join(c for c in s if not unicodedata.combining(c))
+
+
+def _grams(s: str):
+    # n-gramas de 1 a 3 caracteres: q de 1-3 letras se resuelve con una sola lista
+    return {s[i:i + n] for n in (1, 2, 3) for i in range(len(s) - n + 1)}
+
+
+class PublicDirectory:
+    # Además del perfil, cada usuario público entra a un índice de n-gramas
+    # del username (búsqueda por subcadena) y a una lista ordenada
+    # (username plegado, username, id) para listar sin filtro.
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.writes = 0
+        self._users: Dict[int, Dict] = {}
+        self._folded: Dict[int, str] = {}
+        self._grams: Dict[str, set] = {}
+        self._order: List[tuple] = []
+
+    def _index(self, user_id: int, username: str):
+        f = self._folded[user_id] = _fold(username)
+        for g in _grams(f):
+            self._grams.setdefault(g, set()).add(user_id)
+        bisect.insort(self._order, (f, username, user_id))
+
+    def _unindex(self, user_id: int):
+        u = self._users.pop(user_id, None)
+        if u is None:
+            return
+        f = self._folded.pop(user_id)
+        for g in _grams(f):
+            members = self._grams[g]
+            members.discard(user_id)
+            if not members:
+                del self._grams[g]
+        i = bisect.bisect_left(self._order, (f, u["username"], user_id))
+        if i < len(self._order) and self._order[i][2] == user_id:
+            del self._order[i]
+
+    def install(self, rows, token: Optional[int]) -> bool:
+        with self._lock:
+            if token is not None and token != self.writes:
+                return False
+            self._users, self._folded, self._grams, self._order = {}, {}, {}, []
+            for r in rows:
+                self._users[r["id"]] = {"id": r["id"], "username": r["username"], "bio": r["bio"]}
+                f = self._folded[r["id"]] = _fold(r["username"])
+                for g in _grams(f):
+                    self._grams.setdefault(g, set()).add(r["id"])
+                self._order.append((f, r["username"], r["id"]))
+            self._order.sort()
+            self.loaded = True
+            return True
+
+    def put(self, user_id: int, username: str, bio: Optional[str]):
+        with self._lock:
+            self.writes += 1
+            if self.loaded:
+                old = self._users.get(user_id)
+                if old is None or old["username"] != username:
+                    self._unindex(user_id)
+                    self._index(user_id, username)
+                self._users[user_id] = {"id": user_id, "username": username, "bio": bio}
+
+    def remove(self, user_id: int):
+        with self._lock:
+            self.writes += 1
+            self._unindex(user_id)
+
+    def search(self, q: str, after: Optional[list], offset: int, size: int):
+        # Devuelve (filas, total, clave_de_la_última|None). Sin q: orden alfabético.
+        # Con q: exacto, luego prefijo, luego subcadena (por posición y largo).
+        qf = _fold(q)
+        with self._lock:
+            if not qf:
+                keys = self._order
+                total = len(keys)
+                start = bisect.bisect_right(keys, tuple(after)) if after is not None else offset
+                page = keys[start:start + size + 1]
+            else:
+                if len(qf) <= 3:
+                    cands = self._grams.get(qf, ())
+                else:
+                    lists = sorted((self._grams.get(qf[i:i + 3], set()) for i in range(len(qf) - 2)), key=len)
+                    cands = lists[0].intersection(*lists[1:])
+                scored = []
+                for uid in cands:
+                    f = self._folded[uid]
+                    pos = f.find(qf)
+                    if pos >= 0:
+                        tier = 0 if f == qf else (1 if pos == 0 else 2)
+                        scored.append((tier, pos, len(f), f, self._users[uid]["username"], uid))
+                total = len(scored)
+                if after is not None:
+                    a = tuple(after)
+                    page = heapq.nsmallest(size + 1, (k for k in scored if k > a))
+                else:
+                    page = heapq.nsmallest(offset + size + 1, scored)[offset:]
+            rows = [dict(self._users[k[-1]]) for k in page[:size]]
+            last = list(page[size - 1]) if len(page) > size else None
+        return rows, total, last
+
+    def get(self, user_id: int) -> Optional[Dict]:
+        with self._lock:
+            return self._users.get(user_id)
+
+    def names(self) -> Dict[int, str]:
+        with self._lock:
+            return {uid: u["username"] for uid, u in self._users.items()}
+
+    def __len__(self):
+        return len(self._users)
+
+
+PUBLIC = PublicDirectory()
+
+
+def _ensure_public_loaded():
+    if PUBLIC.loaded:
+        return
+    with PUBLIC.load_lock:
+        if PUBLIC.loaded:
+            return
+        for attempt in range(LOAD_RETRIES):
+            token = PUBLIC.writes if attempt < LOAD_RETRIES - 1 else None
+            with get_conn() as con:
+                cur = con.cursor(dictionary=True)
+                cur.execute("""
+                    SELECT u.id, u.username, p.bio
+                    FROM profiles p JOIN users u ON u.id = p.user_id
+                    WHERE p.is_public = 1
+                """)
+                rows = cur.fetchall()
+            if PUBLIC.install(rows, token):
+                return
+
+# --- Caché de perfiles públicos (/public/user/{username}) ---
+# LRU con TTL sobre la respuesta completa. Las escrituras invalidan por
+# user_id; cada invalidación marca un número de secuencia y una lectura que
+# empezó antes de esa marca no puede guardar su resultado (evita reinsertar
+# datos viejos, p. ej. un perfil que acaba de volverse privado).
+PROFILE_CACHE_TTL = float(os.getenv("PROFILE_CACHE_TTL", "60"))
+PROFILE_CACHE_MAX = int(os.getenv("PROFILE_CACHE_MAX", "10000"))
+
+
+class ProfileCache:
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()   # username -> (expira, día, user_id, valor)
+        self._by_user: Dict[int, set] = {}
+        self._seq = 0
+        self._floor = 0                 # tokens anteriores a esto se rechazan siempre
+        self._invalidated: Dict[int, int] = {}
+        self.hits = self.misses = self.evictions = self.expired = self.rejected = 0
+
+    def begin(self) -> int:
+        with self._lock:
+            return self._seq
+
+    def get(self, username: str, today: datetime.date):
+        with self._lock:
+            e = self._entries.get(username)
+            if e is not None and (e[0] < time.monotonic() or e[1] != today):
+                self._drop(username)
+                self.expired += 1
+                e = None
+            if e is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(username)
+            self.hits += 1
+            return e[3]
+
+    def put(self, username: str, user_id: int, today: datetime.date, value: Dict, token: int):
+        with self._lock:
+            if token < self._floor or self._invalidated.get(user_id, -1) >= token:
+                self.rejected += 1
+                return
+            self._drop(username)
+            self._entries[username] = (time.monotonic() + self.ttl, today, user_id, value)
+            self._by_user.setdefault(user_id, set()).add(username)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _drop(self, username: str):
+        e = self._entries.pop(username, None)
+        if e is not None:
+            names = self._by_user.get(e[2])
+            if names is not None:
+                names.discard(username)
+                if not names:
+                    del self._by_user[e[2]]
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._invalidated[user_id] = self._seq
+            self._seq += 1
+            for username in list(self._by_user.get(user_id, ())):
+                self._drop(username)
+            if len(self._invalidated) > 4 * self.max_entries:
+                # acotar memoria: se olvidan las marcas y se rechaza todo lo anterior
+                self._invalidated.clear()
+                self._floor = self._seq
+
+    def invalidate_all(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+            self._invalidated.clear()
+            self._seq += 1
+            self._floor = self._seq
+
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._entries), "max_entries": self.max_entries, "ttl": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions, "expired": self.expired, "rejected": self.rejected,
+            }
 
-# --- App ---
-app = FastAPI(title="Hábitos API (MySQL)")
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"] if CORS_ORIGINS == "*" else [CORS_ORIGINS],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
 
-# --- Modelos ---
-@app.get("/public/users")
-def public_users(
-    q: Optional[str] = None,
-    page: int = 1,
-    page_size: int = 50
-):
-    if page <= 0 or page_size <= 0 or page_size > 200:
-        raise HTTPException(400, "Parámetros de paginación inválidos")
+PROFILE_CACHE = ProfileCache(PROFILE_CACHE_TTL, PROFILE_CACHE_MAX)
+
+# --- Ranking incremental (/public/rank) ---
+# Se guardan los hábitos cumplidos por usuario y día (últimos 365 días) y, por
+# cada ventana pedida, un tablero con el puntaje de cada perfil público y una
+# lista ordenada (-puntaje, username, id) sobre la que se hace bisect: la
+# posición de un usuario y cualquier página salen sin recorrer la tabla.
+# mark_today aplica deltas y al cambiar de día solo se restan los usuarios que
+# tenían algo en el día que sale de la ventana.
+RANK_MAX_WINDOW = 365
+RANK_MAX_BOARDS = int(os.getenv("RANK_MAX_BOARDS", "8"))
+
+
+class _Board:
+    __slots__ = ("window", "scores", "keys")
+
+    def __init__(self, window: int):
+        self.window = window
+        self.scores: Dict[int, int] = {}
+        self.keys: List[tuple] = []
+
+
+class Leaderboard:
+    def __init__(self, max_boards: int):
+        self._lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.writes = 0
+        self._today = 0                              # ordinal del "hoy" ya procesado
+        self._days: Dict[int, Dict[int, int]] = {}   # ordinal -> {user_id: cumplidos}
+        self._names: Dict[int, str] = {}             # miembros: perfiles públicos
+        self._joining: Dict[int, int] = {}           # entrando: applies vistos mientras se leen sus días
+        self._boards: "OrderedDict[int, _Board]" = OrderedDict()
+        self._max_boards = max_boards
+
+    def _key(self, board: _Board, user_id: int) -> tuple:
+        name = self._names[user_id]
+        return (-board.scores[user_id], name.casefold(), name, user_id)
+
+    def _adjust(self, board: _Board, user_id: int, delta: int):
+        if not delta or user_id not in board.scores:
+            return
+        old = self._key(board, user_id)
+        i = bisect.bisect_left(board.keys, old)
+        del board.keys[i]
+        board.scores[user_id] += delta
+        bisect.insort(board.keys, self._key(board, user_id))
+
+    def _build(self, window: int) -> _Board:
+        board = _Board(window)
+        board.scores = dict.fromkeys(self._names, 0)
+        for d in range(self._today - window + 1, self._today + 1):
+            for uid, n in self._days.get(d, {}).items():
+                if uid in board.scores:
+                    board.scores[uid] += n
+        board.keys = sorted(self._key(board, uid) for uid in board.scores)
+        return board
+
+    def _roll(self, today: int):
+        if today <= self._today:
+            return
+        if today - self._today >= RANK_MAX_WINDOW:
+            self._today = today
+            for w in list(self._boards):
+                self._boards[w] = self._build(w)
+        else:
+            for d in range(self._today + 1, today + 1):
+                for board in self._boards.values():
+                    for uid, n in self._days.get(d - board.window, {}).items():
+                        self._adjust(board, uid, -n)
+            self._today = today
+        for d in [d for d in self._days if d <= today - RANK_MAX_WINDOW]:
+            del self._days[d]
+
+    def _board(self, window: int, today: datetime.date) -> _Board:
+        self._roll(today.toordinal())
+        board = self._boards.get(window)
+        if board is None:
+            board = self._boards[window] = self._build(window)
+            while len(self._boards) > self._max_boards:
+                self._boards.popitem(last=False)
+        self._boards.move_to_end(window)
+        return board
+
+    def install(self, names: Dict[int, str], rows, today: datetime.date, token: Optional[int]) -> bool:
+        # rows: (user_id, day, n) de los últimos RANK_MAX_WINDOW días
+        days: Dict[int, Dict[int, int]] = {}
+        for r in rows:
+            days.setdefault(r["day"].toordinal(), {})[r["user_id"]] = int(r["n"])
+        with self._lock:
+            if token is not None and token != self.writes:
+                return False
+            self._names, self._days = names, days
+            self._today = today.toordinal()
+            self._boards.clear()
+            self.loaded = True
+            return True
+
+    def apply(self, user_id: int, day: datetime.date, delta: int):
+        with self._lock:
+            self.writes += 1
+            if user_id in self._joining:
+                self._joining[user_id] += 1
+            if not self.loaded or user_id not in self._names or not delta:
+                return
+            self._roll(datetime.date.today().toordinal())
+            d = day.toordinal()
+            if d <= self._today - RANK_MAX_WINDOW:
+                return
+            per_user = self._days.setdefault(d, {})
+            n = per_user.get(user_id, 0) + delta
+            if n > 0:
+                per_user[user_id] = n
+            else:
+                per_user.pop(user_id, None)
+            for board in self._boards.values():
+                if self._today - board.window < d <= self._today:
+                    self._adjust(board, user_id, delta)
+
+    def begin_member(self, user_id: int):
+        # antes de leer los días del usuario que se hace público: desde acá se
+        # cuentan sus applies (que aún se descartan porque no es miembro)
+        with self._lock:
+            self._joining[user_id] = 0
+
+    def abort_member(self, user_id: int):
+        with self._lock:
+            self._joining.pop(user_id, None)
+
+    def add_member(self, user_id: int, username: str, rows, force: bool = False) -> bool:
+        # rows: (day, n) del usuario, leídos después de begin_member. Si entre
+        # medio se aplicó algún log suyo, rows puede no incluirlo: False y se relee.
+        with self._lock:
+            self.writes += 1
+            if self._joining.pop(user_id, 0) and not force:
+                return False
+            if not self.loaded or user_id in self._names:
+                return True
+            self._names[user_id] = username
+            for r in rows:
+                self._days.setdefault(r["day"].toordinal(), {})[user_id] = int(r["n"])
+            for w in list(self._boards):
+                self._boards[w] = self._build(w)
+            return True
+
+    def remove_member(self, user_id: int):
+        with self._lock:
+            self.writes += 1
+            if not self.loaded or user_id not in self._names:
+                return
+            for board in self._boards.values():
+                i = bisect.bisect_left(board.keys, self._key(board, user_id))
+                del board.keys[i]
+                del board.scores[user_id]
+            del self._names[user_id]
+            for per_user in self._days.values():
+                per_user.pop(user_id, None)
+
+    def roll(self):
+        # cambio de día fuera de los requests (lo llama un hilo en segundo plano)
+        with self._lock:
+            if self.loaded:
+                self._roll(datetime.date.today().toordinal())
+
+    def page(self, window: int, offset: int, size: int, today: datetime.date):
+        with self._lock:
+            board = self._board(window, today)
+            items = [
+                {"id": uid, "username": name, "done_days": -neg}
+                for neg, _, name, uid in board.keys[offset:offset + size]
+            ]
+            return items, len(board.keys)
+
+    def rank_of(self, window: int, user_id: int, today: datetime.date) -> Optional[Dict]:
+        with self._lock:
+            board = self._board(window, today)
+            if user_id not in board.scores:
+                return None
+            pos = bisect.bisect_left(board.keys, self._key(board, user_id))
+            return {"rank": pos + 1, "done_days": board.scores[user_id]}
+
+
+LEADERBOARD = Leaderboard(RANK_MAX_BOARDS)
+
+
+def _ensure_rank_loaded():
+    if LEADERBOARD.loaded:
+        return
+    _ensure_public_loaded()
+    with LEADERBOARD.load_lock:
+        if LEADERBOARD.loaded:
+            return
+        for attempt in range(LOAD_RETRIES):
+            token = LEADERBOARD.writes if attempt < LOAD_RETRIES - 1 else None
+            today = datetime.date.today()
+            start = today - datetime.timedelta(days=RANK_MAX_WINDOW - 1)
+            names = PUBLIC.names()
+            with get_conn() as con:
+                cur = con.cursor(dictionary=True)
+                cur.execute("""
+                    SELECT d.user_id, d.day, d.done_count AS n
+                    FROM user_daily_done d
+                    JOIN profiles p ON p.user_id = d.user_id AND p.is_public = 1
+                    WHERE d.day BETWEEN %s AND %s AND d.done_count > 0
+                """, (start, today))
+                rows = cur.fetchall()
+            if LEADERBOARD.install(names, rows, today, token):
+                return
+
+
+def _join_leaderboard(user_id: int, username: str):
+    # llamar DESPUÉS del commit que hace público el perfil: entra al ranking
+    # con sus días ya cumplidos, sin perder logs que se escriban mientras tanto
+    if not LEADERBOARD.loaded:
+        return
+    for attempt in range(LOAD_RETRIES):
+        LEADERBOARD.begin_member(user_id)
+        today = datetime.date.today()
+        try:
+            with get_conn() as con:
+                cur = con.cursor(dictionary=True)
+                cur.execute("""
+                    SELECT day, done_count AS n
+                    FROM user_daily_done
+                    WHERE user_id = %s AND day BETWEEN %s AND %s AND done_count > 0
+                """, (user_id, today - datetime.timedelta(days=RANK_MAX_WINDOW - 1), today))
+                rows = cur.fetchall()
+        except Exception:
+            LEADERBOARD.abort_member(user_id)
+            raise
+        if LEADERBOARD.add_member(user_id, username, rows, force=attempt == LOAD_RETRIES - 1):
+            return
+
+
+def _on_log_written(user_id: int, habit_id: int, day: datetime.date, value: int, old_value: int):
+    # llamar DESPUÉS del commit: mantiene al día las estructuras en memoria
+    STATS.set_day(user_id, habit_id, day, value)
+    HEATMAP.set_day(user_id, habit_id, day, value)
+    LEADERBOARD.apply(user_id, day, value - old_value)
+    PROFILE_CACHE.invalidate(user_id)
+    VERSIONS.bump(("logs", user_id), ("rank",))
+
+
+def _on_logs_written(user_id: int, changes):
+    # versión por lotes de _on_log_written: changes = [(habit_id, day, value, old_value)]
+    per_day: Dict[datetime.date, int] = {}
+    for habit_id, day, value, old_value in changes:
+        STATS.set_day(user_id, habit_id, day, value)
+        HEATMAP.set_day(user_id, habit_id, day, value)
+        per_day[day] = per_day.get(day, 0) + value - old_value
+    for day, delta in per_day.items():
+        LEADERBOARD.apply(user_id, day, delta)
+    if changes:
+        PROFILE_CACHE.invalidate(user_id)
+        VERSIONS.bump(("logs", user_id), ("rank",))
+
+
+def _on_habit_deleted(user_id: int, habit_id: int, name: str, done_days: List[datetime.date]):
+    STATS.drop_habit(user_id, habit_id)
+    HEATMAP.drop_habit(user_id, habit_id)
+    SIMILAR.remove_habit(user_id, name)
+    PROFILE_CACHE.invalidate(user_id)
+    for d in done_days:
+        LEADERBOARD.apply(user_id, d, -1)
+    VERSIONS.bump(("habits", user_id), ("logs", user_id), ("rank",))
+
+# --- Rachas (tabla habit_streaks) ---
+# Por hábito: último día cumplido, largo de la racha que termina ahí y la más
+# larga. Marcar un día posterior a last_done se resuelve en O(1); desmarcar o
+# tocar un día pasado (backfill) recalcula ese hábito con RLE sobre sus días
+# cumplidos. Se escribe en la misma transacción que el log.
+STREAK_REBUILD_BATCH = 500
+
+
+def _streak_rle(days) -> tuple:
+    # days: ordenados y sin repetir -> (last_done, racha actual, racha más larga)
+    last, run, best = None, 0, 0
+    for d in days:
+        run = run + 1 if last is not None and (d - last).days == 1 else 1
+        best = max(best, run)
+        last = d
+    return last, run, best
+
+
+def _streak_step(state: tuple, day: datetime.date, value: int) -> Optional[tuple]:
+    # nuevo (last_done, current, longest) o None si hay que recalcular
+    last, cur, best = state
+    if value:
+        if last is None or day > last:
+            cur = cur + 1 if last is not None and (day - last).days == 1 else 1
+            return day, cur, max(best, cur)
+        return None
+    if last is None or day > last:
+        return state        # ese día no estaba cumplido
+    return None
+
+
+def _streak_view(last_done, current: int, longest: int, today: datetime.date) -> Dict:
+    # la racha actual sigue viva si se cumplió hoy o ayer
+    alive = last_done is not None and (today - last_done).days <= 1
+    return {
+        "current": current if alive else 0,
+        "longest": longest,
+        "last_done": last_done.isoformat() if last_done else None,
+    }
 
-    offset = (page - 1) * page_size
-    like = f"%{q.strip()}%" if q else None
 
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        if like:
-            cur.execute("""
-                SELECT u.id, u.username, p.bio
-                FROM profiles p
-                JOIN users u ON u.id = p.user_id
-                WHERE p.is_public=1 AND u.username LIKE %s
-                ORDER BY u.username ASC
-                LIMIT %s OFFSET %s
-            """, (like, page_size, offset))
-        else:
-            cur.execute("""
-                SELECT u.id, u.username, p.bio
-                FROM profiles p
-                JOIN users u ON u.id = p.user_id
-                WHERE p.is_public=1
-                ORDER BY u.username ASC
-                LIMIT %s OFFSET %s
-            """, (page_size, offset))
-        items = cur.fetchall()
-
-        # total públicos (para paginación)
-        if like:
-            cur.execute("""
-                SELECT COUNT(*) AS total
-                FROM profiles p JOIN users u ON u.id=p.user_id
-                WHERE p.is_public=1 AND u.username LIKE %s
-            """, (like,))
-        else:
-            cur.execute("SELECT COUNT(*) AS total FROM profiles WHERE is_public=1")
-        total = cur.fetchone()["total"]
+async def _arebuild_streaks(cur, habit_ids: List[int]):
+    if not habit_ids:
+        return
+    marks = ",".join(["%s"] * len(habit_ids))
+    await cur.execute(f"""
+        SELECT habit_id, day FROM logs
+        WHERE value = 1 AND habit_id IN ({marks})
+        ORDER BY habit_id, day
+    """, tuple(habit_ids))
+    days: Dict[int, list] = {h: [] for h in habit_ids}
+    for h, d in await cur.fetchall():
+        days[h].append(d)
+    rows = [(h, *_streak_rle(ds)) for h, ds in days.items()]
+    await cur.execute(f"""
+        INSERT INTO habit_streaks (habit_id, last_done, current_len, longest_len)
+        VALUES {",".join(["(%s,%s,%s,%s)"] * len(rows))}
+        ON DUPLICATE KEY UPDATE last_done=VALUES(last_done),
+          current_len=VALUES(current_len), longest_len=VALUES(longest_len)
+    """, [v for r in rows for v in r])
+
+
+async def _aupdate_streak(cur, habit_id: int, day: datetime.date, value: int, old_value: int):
+    if value == old_value:
+        return
+    await cur.execute("""
+        SELECT last_done, current_len, longest_len FROM habit_streaks
+        WHERE habit_id=%s FOR UPDATE
+    """, (habit_id,))
+    row = await cur.fetchone()
+    new = _streak_step(tuple(row), day, value) if row else None
+    if new is None:
+        await _arebuild_streaks(cur, [habit_id])
+    elif new != tuple(row):
+        await cur.execute("""
+            UPDATE habit_streaks SET last_done=%s, current_len=%s, longest_len=%s
+            WHERE habit_id=%s
+        """, (*new, habit_id))
+
+# --- Rollup diario (tabla user_daily_done) ---
+# Hábitos cumplidos por usuario y día. Se actualiza en la misma transacción que
+# logs (mark_today, /logs/bulk, borrar hábito) y de ahí leen el ranking, el
+# trending de sugeridos y el resumen del perfil: una ventana de N días son a lo
+# sumo N filas contiguas de la clave (user_id, day), sin recorrer logs.
+ROLLUP_CHUNK = 1000
+ROLLUP_REBUILD_BATCH = 500
+
+
+async def _abump_daily(cur, user_id: int, deltas: Dict[datetime.date, int]):
+    # deltas: día -> cambio en cumplidos; en orden de día para bloquear siempre igual
+    rows = [(user_id, d, n) for d, n in sorted(deltas.items()) if n]
+    for i in range(0, len(rows), ROLLUP_CHUNK):
+        chunk = rows[i:i + ROLLUP_CHUNK]
+        await cur.execute(f"""
+            INSERT INTO user_daily_done (user_id, day, done_count)
+            VALUES {",".join(["(%s,%s,%s)"] * len(chunk))}
+            ON DUPLICATE KEY UPDATE done_count = done_count + VALUES(done_count)
+        """, [v for r in chunk for v in r])
+
+
+async def _arebuild_daily(cur, user_ids: List[int]):
+    if not user_ids:
+        return
+    marks = ",".join(["%s"] * len(user_ids))
+    await cur.execute(f"DELETE FROM user_daily_done WHERE user_id IN ({marks})", tuple(user_ids))
+    await cur.execute(f"""
+        INSERT INTO user_daily_done (user_id, day, done_count)
+        SELECT h.user_id, l.day, COUNT(*)
+        FROM logs l JOIN habits h ON h.id = l.habit_id
+        WHERE l.value = 1 AND h.user_id IN ({marks})
+        GROUP BY h.user_id, l.day
+    """, tuple(user_ids))
+
+# --- Grafo de amistades (CSR) ---
+# ids: usuarios con amigos (ordenados); los amigos de ids[i] son
+# adj[offsets[i]:offsets[i+1]] (ordenados). Las altas/bajas posteriores van a un
+# overlay pequeño (_extra/_gone) que se compacta al pasar GRAPH_COMPACT_EDGES.
+GRAPH_COMPACT_EDGES = int(os.getenv("GRAPH_COMPACT_EDGES", "20000"))
+
+
+class FriendGraph:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.writes = 0
+        self._ids = array("i")
+        self._offsets = array("l", [0])
+        self._adj = array("i")
+        self._adj_np = np.zeros(0, dtype=np.intc)   # vista numpy de _adj (sin copia)
+        self._extra: Dict[int, set] = {}
+        self._gone: Dict[int, set] = {}
+        self._overlay = 0
+
+    def _build(self, pairs):
+        # pairs ordenados por (user_id, friend_id)
+        ids, offsets, adj = array("i"), array("l", [0]), array("i")
+        for uid, fid in pairs:
+            if not ids or ids[-1] != uid:
+                if ids:
+                    offsets.append(len(adj))
+                ids.append(uid)
+            adj.append(fid)
+        if ids:
+            offsets.append(len(adj))
+        self._ids, self._offsets, self._adj = ids, offsets, adj
+        # _adj ya no crece (cada _build arma uno nuevo), así que la vista es segura
+        self._adj_np = np.frombuffer(adj, dtype=np.intc) if adj else np.zeros(0, dtype=np.intc)
+        self._extra, self._gone, self._overlay = {}, {}, 0
+
+    def install(self, rows, token: Optional[int]) -> bool:
+        with self._lock:
+            if token is not None and token != self.writes:
+                return False
+            self._build((r[0], r[1]) for r in rows)
+            self.loaded = True
+            return True
+
+    def _base(self, uid: int):
+        i = bisect.bisect_left(self._ids, uid)
+        if i < len(self._ids) and self._ids[i] == uid:
+            return self._adj[self._offsets[i]:self._offsets[i + 1]]
+        return array("i")
+
+    def _neighbors_np(self, uid: int) -> np.ndarray:
+        # como _neighbors, pero como vista de _adj_np cuando no hay overlay
+        gone, extra = self._gone.get(uid), self._extra.get(uid)
+        if gone or extra:
+            return np.fromiter(self._neighbors(uid), dtype=np.intc)
+        i = bisect.bisect_left(self._ids, uid)
+        if i < len(self._ids) and self._ids[i] == uid:
+            return self._adj_np[self._offsets[i]:self._offsets[i + 1]]
+        return self._adj_np[:0]
+
+    def _in_base(self, a: int, b: int) -> bool:
+        base = self._base(a)
+        j = bisect.bisect_left(base, b)
+        return j < len(base) and base[j] == b
+
+    def _neighbors(self, uid: int):
+        base = self._base(uid)
+        gone, extra = self._gone.get(uid), self._extra.get(uid)
+        if not gone and not extra:
+            return base
+        out = [f for f in base if f not in gone] if gone else list(base)
+        if extra:
+            out.extend(extra)
+        return out
+
+    def _link(self, a: int, b: int, on: bool):
+        # alta: deshace una baja pendiente o agrega a _extra (y viceversa)
+        undo, redo = (self._gone, self._extra) if on else (self._extra, self._gone)
+        if b in undo.get(a, ()):
+            undo[a].discard(b)
+            self._overlay -= 1
+        elif self._in_base(a, b) != on and b not in redo.get(a, ()):
+            redo.setdefault(a, set()).add(b)
+            self._overlay += 1
+
+    def _set_edge(self, a: int, b: int, on: bool):
+        with self._lock:
+            self.writes += 1
+            if not self.loaded:
+                return
+            self._link(a, b, on)
+            self._link(b, a, on)
+            if self._overlay > GRAPH_COMPACT_EDGES:
+                self._build((u, f) for u in sorted(self._all_users()) for f in sorted(self._neighbors(u)))
+
+    def _all_users(self):
+        return set(self._ids) | set(self._extra)
+
+    def add_edge(self, a: int, b: int):
+        self._set_edge(a, b, True)
+
+    def remove_edge(self, a: int, b: int):
+        self._set_edge(a, b, False)
+
+    def friends(self, uid: int) -> List[int]:
+        with self._lock:
+            return list(self._neighbors(uid))
+
+    def mutual(self, a: int, b: int) -> List[int]:
+        with self._lock:
+            return sorted(set(self._neighbors(a)).intersection(self._neighbors(b)))
+
+    def foaf(self, uid: int, k: int, accept=None) -> List[tuple]:
+        # top-k (candidato, amigos en común) sin contar a uid ni a sus amigos.
+        # Se cuenta en numpy sobre las listas de adyacencia (bincount por id):
+        # un hub con miles de amigos de miles de amigos son millones de ids.
+        with self._lock:
+            mine = self._neighbors_np(uid)
+            parts = [self._neighbors_np(int(f)) for f in mine]
+        if not parts:
+            return []
+        per_id = np.bincount(np.concatenate(parts))
+        per_id[mine[mine < len(per_id)]] = 0
+        if uid < len(per_id):
+            per_id[uid] = 0
+        cands = np.flatnonzero(per_id)
+        counts = per_id[cands]
+        # más mutuos primero; a igual conteo, id menor (cands sale ordenado)
+        order = np.argsort(-counts, kind="stable")
+        if accept is None:
+            order = order[:k]
+        out = []
+        for i in order:
+            c = int(cands[i])
+            if accept is None or accept(c):
+                out.append((c, int(counts[i])))
+                if len(out) == k:
+                    break
+        return out
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            directed = (len(self._adj) + sum(map(len, self._extra.values()))
+                        - sum(map(len, self._gone.values())))
+            return {"users": len(self._all_users()), "friendships": directed // 2}
+
+
+GRAPH = FriendGraph()
+
+
+def _ensure_graph_loaded(force: bool = False):
+    if GRAPH.loaded and not force:
+        return
+    with GRAPH.load_lock:
+        if GRAPH.loaded and not force:
+            return
+        for attempt in range(LOAD_RETRIES):
+            token = GRAPH.writes if attempt < LOAD_RETRIES - 1 else None
+            with get_conn() as con:
+                cur = con.cursor()
+                cur.execute("SELECT user_id, friend_id FROM friendships ORDER BY user_id, friend_id")
+                rows = cur.fetchall()
+            if GRAPH.install(rows, token):
+                return
+
+# --- Similitud por hábitos (índice invertido + MinHash) ---
+# Nombre normalizado (sin mayúsculas ni tildes, como la collation *_ai_ci) ->
+# usuarios que lo tienen. Cada usuario guarda además una firma MinHash de
+# SIMILAR_K componentes, repartida en bandas LSH de SIMILAR_ROWS filas.
+# Modo exacto: Jaccard real recorriendo solo las listas de mis nombres.
+# Modo aproximado: candidatos de los buckets LSH y Jaccard estimado por firma.
+SIMILAR_K = 32
+SIMILAR_ROWS = 2                     # 16 bandas de 2 -> umbral ~0.25
+SIMILAR_EXACT_MAX = int(os.getenv("SIMILAR_EXACT_MAX", "50000"))
+_MH_PRIME = (1 << 61) - 1
+_MH_RNG = random.Random(1234)
+_MH_PARAMS = [(_MH_RNG.randrange(1, _MH_PRIME), _MH_RNG.randrange(0, _MH_PRIME)) for _ in range(SIMILAR_K)]
+
+
+def _norm_habit(name: str) -> str:
+    return " ".join(_fold(name).split())
+
+
+def _minhash(names) -> array:
+    sig = array("Q", [_MH_PRIME] * SIMILAR_K)
+    for n in names:
+        h = int.from_bytes(hashlib.blake2b(n.encode(), digest_size=8).digest(), "big")
+        for i, (a, b) in enumerate(_MH_PARAMS):
+            v = (a * h + b) % _MH_PRIME
+            if v < sig[i]:
+                sig[i] = v
+    return sig
+
+
+class HabitSimilarity:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.writes = 0
+        self._names: Dict[int, Counter] = {}        # user -> nombre normalizado -> nº de hábitos
+        self._index: Dict[str, set] = {}            # nombre normalizado -> usuarios
+        self._sigs: Dict[int, array] = {}
+        self._buckets: Dict[tuple, set] = {}        # (banda, valores) -> usuarios
+
+    def _bands(self, sig: array):
+        for b in range(0, SIMILAR_K, SIMILAR_ROWS):
+            yield (b, *sig[b:b + SIMILAR_ROWS])
+
+    def _resign(self, user_id: int):
+        old = self._sigs.pop(user_id, None)
+        if old is not None:
+            for key in self._bands(old):
+                members = self._buckets.get(key)
+                if members is not None:
+                    members.discard(user_id)
+                    if not members:
+                        del self._buckets[key]
+        names = self._names.get(user_id)
+        if names:
+            sig = self._sigs[user_id] = _minhash(names)
+            for key in self._bands(sig):
+                self._buckets.setdefault(key, set()).add(user_id)
+
+    def _add(self, user_id: int, name: str) -> bool:
+        names = self._names.setdefault(user_id, Counter())
+        names[name] += 1
+        self._index.setdefault(name, set()).add(user_id)
+        return names[name] == 1
+
+    def install(self, rows, token: Optional[int]) -> bool:
+        with self._lock:
+            if token is not None and token != self.writes:
+                return False
+            self._names, self._index, self._sigs, self._buckets = {}, {}, {}, {}
+            for user_id, name in rows:
+                self._add(user_id, _norm_habit(name))
+            for user_id in self._names:
+                self._resign(user_id)
+            self.loaded = True
+            return True
+
+    def add_habit(self, user_id: int, name: str):
+        with self._lock:
+            self.writes += 1
+            if self.loaded and self._add(user_id, _norm_habit(name)):
+                self._resign(user_id)
+
+    def remove_habit(self, user_id: int, name: str):
+        with self._lock:
+            self.writes += 1
+            names = self._names.get(user_id)
+            key = _norm_habit(name)
+            if not self.loaded or not names or key not in names:
+                return
+            names[key] -= 1
+            if names[key] == 0:
+                del names[key]
+                self._index[key].discard(user_id)
+                if not self._index[key]:
+                    del self._index[key]
+                if not names:
+                    del self._names[user_id]
+                self._resign(user_id)
+
+    def similar(self, user_id: int, k: int, mode: str = "auto", accept=None) -> List[Dict]:
+        with self._lock:
+            mine = self._names.get(user_id)
+            if not mine:
+                return []
+            if mode == "auto":
+                work = sum(len(self._index[n]) for n in mine)
+                mode = "exact" if work <= SIMILAR_EXACT_MAX else "approx"
+            scored = []
+            if mode == "exact":
+                inter = Counter()
+                for n in mine:
+                    inter.update(self._index[n])
+                inter.pop(user_id, None)
+                for c, i in inter.items():
+                    scored.append((c, i / (len(mine) + len(self._names[c]) - i)))
+            else:
+                sig = self._sigs[user_id]
+                cands = set()
+                for key in self._bands(sig):
+                    cands |= self._buckets.get(key, set())
+                cands.discard(user_id)
+                for c in cands:
+                    other = self._sigs[c]
+                    scored.append((c, sum(x == y for x, y in zip(sig, other)) / SIMILAR_K))
+        if accept is not None:
+            scored = [t for t in scored if accept(t[0])]
+        top = heapq.nsmallest(k, scored, key=lambda t: (-t[1], t[0]))
+        return [{"candidate": c, "jaccard": round(j, 4), "mode": mode} for c, j in top]
+
+
+SIMILAR = HabitSimilarity()
+
+
+def _ensure_similar_loaded():
+    if SIMILAR.loaded:
+        return
+    with SIMILAR.load_lock:
+        if SIMILAR.loaded:
+            return
+        for attempt in range(LOAD_RETRIES):
+            token = SIMILAR.writes if attempt < LOAD_RETRIES - 1 else None
+            with get_conn() as con:
+                cur = con.cursor()
+                cur.execute("SELECT user_id, name FROM habits")
+                rows = cur.fetchall()
+            if SIMILAR.install(rows, token):
+                return
+
+# --- Timelines materializados (fan-out on write) ---
+# Los posts públicos van a un stream global; los de solo amigos se empujan al
+# timeline de cada amigo (y del autor) que ya esté en memoria. El feed mezcla
+# ambos streams: el costo depende del tamaño de página, no del total de posts.
+# Cada stream es una lista ascendente de (created_at, post_id, author_id); si se
+# recortó (cap), las páginas más viejas que lo guardado caen al SQL.
+TIMELINE_CAP = int(os.getenv("TIMELINE_CAP", "1000"))
+GLOBAL_STREAM_CAP = int(os.getenv("GLOBAL_STREAM_CAP", "5000"))
+TIMELINE_MAX_VIEWERS = int(os.getenv("TIMELINE_MAX_VIEWERS", "20000"))
+
+
+class _Stream:
+    __slots__ = ("keys", "complete", "cap")
+
+    def __init__(self, rows, cap: int):
+        # rows vienen más nuevos primero y con LIMIT cap+1
+        self.cap = cap
+        self.complete = len(rows) <= cap
+        self.keys = sorted((r["created_at"], r["id"], r["author_id"]) for r in rows[:cap])
+
+    def insert(self, key: tuple):
+        bisect.insort(self.keys, key)
+        if len(self.keys) > self.cap:
+            del self.keys[0]
+            self.complete = False
+
+    def remove(self, key: tuple):
+        i = bisect.bisect_left(self.keys, key)
+        if i < len(self.keys) and self.keys[i] == key:
+            del self.keys[i]
+
+    def iter_desc(self, after):
+        # after = (created_at, id) del cursor: solo claves estrictamente anteriores
+        i = bisect.bisect_left(self.keys, after) if after is not None else len(self.keys)
+        for j in range(i - 1, -1, -1):
+            yield self.keys[j]
+
+
+class TimelineStore:
+    def __init__(self, max_viewers: int):
+        self._lock = threading.Lock()
+        self._global: Optional[_Stream] = None
+        self._global_writes = 0
+        self._viewers: "OrderedDict[int, _Stream]" = OrderedDict()
+        self._loads = _LoadTokens()         # viewer -> escrituras durante su carga
+        self._removals = 0                  # borrados de posts de solo amigos (afectan a cualquier viewer)
+        self._max_viewers = max_viewers
+
+    def needs(self, viewer: int):
+        with self._lock:
+            return (self._global is None, viewer not in self._viewers)
+
+    def begin_load(self, viewer: int, need_viewer: bool):
+        # -> (token global, token del viewer o None). Si se pidió el del viewer,
+        # la carga termina en install_viewer o, si la lectura falla, en end_load
+        with self._lock:
+            v_token = (self._loads.begin(viewer), self._removals) if need_viewer else None
+            return self._global_writes, v_token
+
+    def end_load(self, viewer: int):
+        with self._lock:
+            self._loads.end(viewer)
+
+    def install_global(self, rows, token: int):
+        with self._lock:
+            if token == self._global_writes:
+                self._global = _Stream(rows, GLOBAL_STREAM_CAP)
+
+    def install_viewer(self, viewer: int, rows, token):
+        with self._lock:
+            if token == (self._loads.end(viewer), self._removals):
+                self._viewers[viewer] = _Stream(rows, TIMELINE_CAP)
+                while len(self._viewers) > self._max_viewers:
+                    self._viewers.popitem(last=False)
+
+    def _touch(self, viewers):
+        for v in viewers:
+            self._loads.touch(v)
+
+    def add_post(self, post_id: int, author_id: int, created_at, visibility: str, friend_ids: List[int]):
+        key = (created_at, post_id, author_id)
+        with self._lock:
+            if visibility == "public":
+                self._global_writes += 1
+                if self._global is not None:
+                    self._global.insert(key)
+                return
+            audience = [author_id, *friend_ids]
+            self._touch(audience)
+            for v in audience:
+                tl = self._viewers.get(v)
+                if tl is not None:
+                    tl.insert(key)
+
+    def remove_post(self, post_id: int, author_id: int, created_at, visibility: str):
+        key = (created_at, post_id, author_id)
+        with self._lock:
+            if visibility == "public":
+                self._global_writes += 1
+                if self._global is not None:
+                    self._global.remove(key)
+                return
+            # no sabemos quién lo tenía: se busca (bisect) en los timelines cargados,
+            # y una carga en curso (de cualquier viewer) deja de ser válida
+            self._removals += 1
+            for tl in self._viewers.values():
+                tl.remove(key)
+
+    def invalidate(self, *viewers: int):
+        # cambios de amistad: se descartan y se reconstruyen en la próxima lectura
+        with self._lock:
+            self._touch(viewers)
+            for v in viewers:
+                self._viewers.pop(v, None)
+
+    def feed_ids(self, viewer: int, after, offset: int, size: int) -> Optional[List[int]]:
+        # devuelve hasta size+1 ids en orden del feed, o None si hay que ir al SQL
+        with self._lock:
+            tl = self._viewers.get(viewer)
+            if tl is None or self._global is None:
+                return None
+            self._viewers.move_to_end(viewer)
+            streams = (self._global, tl)
+            cut = [s.keys[0][:2] for s in streams if not s.complete and s.keys]
+            horizon = max(cut) if cut else None
+            need = offset + size + 1
+            out = []
+            for key in heapq.merge(*(s.iter_desc(after) for s in streams), reverse=True):
+                if horizon is not None and key[:2] < horizon:
+                    return None
+                out.append(key[1])
+                if len(out) >= need:
+                    break
+            if len(out) < need and not all(s.complete for s in streams):
+                return None
+            return out[offset:]
+
+
+TIMELINES = TimelineStore(TIMELINE_MAX_VIEWERS)
+
+# --- Feed por relevancia (sort=ranked) ---
+# Puntaje "hot" por post: log10(1 + W_LIKE*likes + W_COMMENT*comments) más la
+# antigüedad en unidades de RANK_DECAY_SECONDS (un post RANK_DECAY_SECONDS más
+# nuevo vale lo mismo que 10x interacción). Como el término de tiempo es fijo
+# por post, el orden no cambia con el reloj: el puntaje se calcula al cargar y
+# solo se recalcula cuando toggle_like/create_comment lo tocan. Se guardan
+# listas ordenadas (puntaje, id): una global de posts públicos y una por autor.
+# Los posts de amigos suman RANK_FRIEND_BONUS; el feed mezcla (heap) la lista
+# global con las de los amigos del viewer ya desplazadas, así cada página
+# cuesta O(tamaño de página · log amigos) sin puntuar nada por request. Solo
+# entran posts de los últimos RANK_WINDOW_DAYS; un hilo recarga cada
+# RANK_REFRESH_SECONDS (ventana deslizante + corrige deriva de contadores).
+RANK_W_LIKE = float(os.getenv("RANK_W_LIKE", "1"))
+RANK_W_COMMENT = float(os.getenv("RANK_W_COMMENT", "2"))
+RANK_DECAY_SECONDS = float(os.getenv("RANK_DECAY_SECONDS", "45000"))
+RANK_FRIEND_BONUS = float(os.getenv("RANK_FRIEND_BONUS", "0.5"))
+RANK_WINDOW_DAYS = int(os.getenv("RANK_WINDOW_DAYS", "14"))
+RANK_REFRESH_SECONDS = float(os.getenv("RANK_REFRESH_SECONDS", "600"))
+_RANK_EPOCH = datetime.datetime(2024, 1, 1)
+
+
+def _hot_score(created_at: datetime.datetime, likes: int, comments: int) -> float:
+    engagement = max(0.0, RANK_W_LIKE * likes + RANK_W_COMMENT * comments)
+    return math.log10(1 + engagement) + (created_at - _RANK_EPOCH).total_seconds() / RANK_DECAY_SECONDS
+
+
+class _RankedPost:
+    __slots__ = ("author_id", "public", "created_at", "likes", "comments", "score")
+
+    def __init__(self, author_id: int, public: bool, created_at, likes: int, comments: int):
+        self.author_id, self.public, self.created_at = author_id, public, created_at
+        self.likes, self.comments = likes, comments
+        self.score = _hot_score(created_at, likes, comments)
+
+
+def _desc_from(keys: List[tuple], after: Optional[tuple], shift: float):
+    # (puntaje + shift, id) en orden descendente, estrictamente antes de `after`.
+    # El corte por bisect es holgado (redondeo de floats) y se filtra exacto.
+    i = len(keys)
+    if after is not None:
+        i = bisect.bisect_left(keys, (after[0] - shift + 1e-9,))
+    for j in range(i - 1, -1, -1):
+        k = (keys[j][0] + shift, keys[j][1])
+        if after is None or k < after:
+            yield k
+
+
+class RankedFeed:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.load_lock = threading.Lock()
+        self.loaded = False
+        self.writes = 0
+        self._posts: Dict[int, _RankedPost] = {}
+        self._public: List[tuple] = []                # (score, post_id), ascendente
+        self._by_author: Dict[int, List[tuple]] = {}  # author_id -> [(score, post_id)]
+
+    def install(self, rows, token: Optional[int]) -> bool:
+        # rows: (id, author_id, visibility, created_at, likes, comments)
+        posts = {r[0]: _RankedPost(r[1], r[2] == "public", r[3], int(r[4]), int(r[5])) for r in rows}
+        public, by_author = [], {}
+        for pid, rp in posts.items():
+            if rp.public:
+                public.append((rp.score, pid))
+            by_author.setdefault(rp.author_id, []).append((rp.score, pid))
+        public.sort()
+        for keys in by_author.values():
+            keys.sort()
+        with self._lock:
+            if token is not None and token != self.writes:
+                return False
+            self._posts, self._public, self._by_author = posts, public, by_author
+            self.loaded = True
+            return True
+
+    def _link(self, pid: int, rp: _RankedPost, add: bool):
+        key = (rp.score, pid)
+        lists = [self._by_author.setdefault(rp.author_id, [])]
+        if rp.public:
+            lists.append(self._public)
+        for keys in lists:
+            if add:
+                bisect.insort(keys, key)
+            else:
+                i = bisect.bisect_left(keys, key)
+                if i < len(keys) and keys[i] == key:
+                    del keys[i]
+        if not add and not self._by_author[rp.author_id]:
+            del self._by_author[rp.author_id]
+
+    def add_post(self, post_id: int, author_id: int, created_at, visibility: str):
+        with self._lock:
+            self.writes += 1
+            rp = self._posts[post_id] = _RankedPost(author_id, visibility == "public", created_at, 0, 0)
+            self._link(post_id, rp, True)
+
+    def remove_post(self, post_id: int):
+        with self._lock:
+            self.writes += 1
+            rp = self._posts.pop(post_id, None)
+            if rp is not None:
+                self._link(post_id, rp, False)
+
+    def bump(self, post_id: int, likes: int = 0, comments: int = 0):
+        # like/comentario: se mueve solo ese post en sus listas
+        with self._lock:
+            self.writes += 1
+            rp = self._posts.get(post_id)
+            if rp is None:
+                return                      # fuera de la ventana
+            self._link(post_id, rp, False)
+            rp.likes += likes
+            rp.comments += comments
+            rp.score = _hot_score(rp.created_at, rp.likes, rp.comments)
+            self._link(post_id, rp, True)
+
+    def page(self, viewer: int, friends: List[int], after: Optional[tuple], offset: int, size: int):
+        # hasta size+1 claves (puntaje ajustado, post_id) visibles para viewer
+        friend_set = set(friends)
+        with self._lock:
+            streams = [(k for k in _desc_from(self._public, after, 0.0)
+                        if self._posts[k[1]].author_id not in friend_set)]
+            for f in friend_set:
+                keys = self._by_author.get(f)
+                if keys:
+                    streams.append(_desc_from(keys, after, RANK_FRIEND_BONUS))
+            own = self._by_author.get(viewer)
+            if own and viewer not in friend_set:
+                # los públicos propios ya vienen en la lista global
+                streams.append(k for k in _desc_from(own, after, 0.0) if not self._posts[k[1]].public)
+            need = offset + size + 1
+            out = []
+            for k in heapq.merge(*streams, reverse=True):
+                out.append(k)
+                if len(out) >= need:
+                    break
+        return out[offset:]
+
+
+RANKED = RankedFeed()
+
+
+def _ensure_ranked_loaded(force: bool = False):
+    if RANKED.loaded and not force:
+        return
+    with RANKED.load_lock:
+        if RANKED.loaded and not force:
+            return
+        since = datetime.datetime.now() - datetime.timedelta(days=RANK_WINDOW_DAYS)
+        for attempt in range(LOAD_RETRIES):
+            token = RANKED.writes if attempt < LOAD_RETRIES - 1 else None
+            with get_conn() as con:
+                cur = con.cursor()
+                cur.execute("""
+                    SELECT p.id, p.author_id, p.visibility, p.created_at,
+                           COALESCE(pc.likes, 0), COALESCE(pc.comments, 0)
+                    FROM posts p
+                    LEFT JOIN post_counters pc ON pc.post_id = p.id
+                    WHERE p.created_at >= %s
+                """, (since,))
+                rows = cur.fetchall()
+            # lo que aún no se volcó a post_counters también cuenta
+            rows = [(*r[:4], r[4] + d["likes"], r[5] + d["comments"])
+                    for r in rows for d in (COUNTERS.delta(r[0]),)]
+            if RANKED.install(rows, token):
+                return
+
+
+def _refresh_ranked():
+    if RANKED.loaded:
+        _ensure_ranked_loaded(force=True)
+
+# --- Contadores de interacción (write-behind) ---
+# toggle_like / create_comment / toggle_reaction acumulan deltas en memoria y un
+# hilo los vuelca cada COUNTER_FLUSH_SECONDS a post_counters con un solo
+# INSERT ... ON DUPLICATE KEY UPDATE multi-fila. Las lecturas suman lo que aún
+# no se volcó. reconcile_counters() repara la deriva contra las tablas fuente.
+COUNTER_FIELDS = ("likes", "comments", "rx_like", "rx_clap", "rx_star")
+COUNTER_FLUSH_SECONDS = float(os.getenv("COUNTER_FLUSH_SECONDS", "2"))
+COUNTER_RECONCILE_SECONDS = float(os.getenv("COUNTER_RECONCILE_SECONDS", "3600"))
+COUNTER_BATCH = 500
+
+
+class CounterBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.flush_lock = threading.Lock()   # serializa flush y reconciliación
+        self._pending: Dict[int, Dict[str, int]] = {}
+        self._inflight: Dict[int, Dict[str, int]] = {}
+        # +1 al pasar un lote a _inflight y +1 al vaciarlo (impar: flush en curso).
+        # Quien lee post_counters y después el buffer compara seq antes y después:
+        # si se cruzó un flush, no sabe si lo leído ya incluye el lote.
+        self.seq = 0
+
+    def add(self, post_id: int, field: str, delta: int):
+        with self._lock:
+            d = self._pending.setdefault(post_id, dict.fromkeys(COUNTER_FIELDS, 0))
+            d[field] += delta
+
+    def drop(self, post_id: int):
+        with self._lock:
+            self._pending.pop(post_id, None)
+            self._inflight.pop(post_id, None)
+
+    def _delta(self, post_id: int) -> Dict[str, int]:
+        out = dict.fromkeys(COUNTER_FIELDS, 0)
+        for src in (self._pending, self._inflight):
+            d = src.get(post_id)
+            if d:
+                for k in COUNTER_FIELDS:
+                    out[k] += d[k]
+        return out
+
+    def delta(self, post_id: int) -> Dict[str, int]:
+        with self._lock:
+            return self._delta(post_id)
+
+    def snapshot(self, post_id: int, seq: int) -> Optional[Dict[str, int]]:
+        # delta pendiente, o None si desde `seq` (leído antes de la consulta) hubo un flush
+        with self._lock:
+            if seq != self.seq or seq % 2:
+                return None
+            return self._delta(post_id)
+
+    def has_pending(self, post_id: int) -> bool:
+        with self._lock:
+            return post_id in self._pending or post_id in self._inflight
+
+    def overlay(self, rows: List[Dict]):
+        # suma a cada fila (likes/comments) lo que todavía no llegó a MySQL
+        with self._lock:
+            for r in rows:
+                if r["id"] in self._pending or r["id"] in self._inflight:
+                    d = self._delta(r["id"])
+                    r["likes"] += d["likes"]
+                    r["comments"] += d["comments"]
+
+    def flush(self) -> int:
+        with self.flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                batch, self._pending = self._pending, {}
+                self._inflight = batch
+                self.seq += 1
+            rows = [(pid, *(d[k] for k in COUNTER_FIELDS)) for pid, d in batch.items() if any(d.values())]
+            try:
+                with get_conn() as con:
+                    cur = con.cursor()
+                    for i in range(0, len(rows), COUNTER_BATCH):
+                        chunk = rows[i:i + COUNTER_BATCH]
+                        # IGNORE: si el post se borró entretanto, la FK no tumba el lote
+                        cur.execute(f"""
+                            INSERT IGNORE INTO post_counters (post_id, likes, comments, rx_like, rx_clap, rx_star)
+                            VALUES {",".join(["(%s,%s,%s,%s,%s,%s)"] * len(chunk))}
+                            ON DUPLICATE KEY UPDATE
+                              likes    = likes    + VALUES(likes),
+                              comments = comments + VALUES(comments),
+                              rx_like  = rx_like  + VALUES(rx_like),
+                              rx_clap  = rx_clap  + VALUES(rx_clap),
+                              rx_star  = rx_star  + VALUES(rx_star)
+                        """, [v for row in chunk for v in row])
+            except Exception:
+                with self._lock:
+                    # vuelven al buffer para el próximo intento
+                    for pid in list(self._inflight):
+                        d = self._pending.setdefault(pid, dict.fromkeys(COUNTER_FIELDS, 0))
+                        for k in COUNTER_FIELDS:
+                            d[k] += self._inflight[pid][k]
+                    self._inflight = {}
+                    self.seq += 1
+                raise
+            with self._lock:
+                self._inflight = {}
+                self.seq += 1
+            return len(rows)
+
+
+COUNTERS = CounterBuffer()
+
+
+def reconcile_counters(batch_size: int = 5000) -> Dict[str, int]:
+    # Recorre posts por id en lotes y corrige las filas de post_counters que no
+    # cuadran con post_likes / post_comments / post_reactions. Los posts con
+    # deltas aún en el buffer se saltan (los corregirá la próxima pasada).
+    checked = repaired = 0
+    last_id = 0
+    while True:
+        with COUNTERS.flush_lock:
+            with get_conn() as con:
+                cur = con.cursor(dictionary=True)
+                cur.execute("""
+                    SELECT p.id,
+                      COALESCE(c.likes, 0)    AS c_likes,
+                      COALESCE(c.comments, 0) AS c_comments,
+                      COALESCE(c.rx_like, 0)  AS c_rx_like,
+                      COALESCE(c.rx_clap, 0)  AS c_rx_clap,
+                      COALESCE(c.rx_star, 0)  AS c_rx_star,
+                      (SELECT COUNT(*) FROM post_likes    pl WHERE pl.post_id = p.id) AS likes,
+                      (SELECT COUNT(*) FROM post_comments pc WHERE pc.post_id = p.id) AS comments,
+                      (SELECT COUNT(*) FROM post_reactions r WHERE r.post_id = p.id AND r.type = 'like') AS rx_like,
+                      (SELECT COUNT(*) FROM post_reactions r WHERE r.post_id = p.id AND r.type = 'clap') AS rx_clap,
+                      (SELECT COUNT(*) FROM post_reactions r WHERE r.post_id = p.id AND r.type = 'star') AS rx_star
+                    FROM posts p
+                    LEFT JOIN post_counters c ON c.post_id = p.id
+                    WHERE p.id > %s
+                    ORDER BY p.id
+                    LIMIT %s
+                """, (last_id, batch_size))
+                rows = cur.fetchall()
+                if not rows:
+                    break
+                last_id = rows[-1]["id"]
+                checked += len(rows)
+                fixes = [
+                    (r["id"], *(r[k] for k in COUNTER_FIELDS))
+                    for r in rows
+                    if any(r[k] != r["c_" + k] for k in COUNTER_FIELDS) and not COUNTERS.has_pending(r["id"])
+                ]
+                if fixes:
+                    cur.executemany("""
+                        INSERT INTO post_counters (post_id, likes, comments, rx_like, rx_clap, rx_star)
+                        VALUES (%s,%s,%s,%s,%s,%s)
+                        ON DUPLICATE KEY UPDATE
+                          likes=VALUES(likes), comments=VALUES(comments),
+                          rx_like=VALUES(rx_like), rx_clap=VALUES(rx_clap), rx_star=VALUES(rx_star)
+                    """, fixes)
+                    repaired += len(fixes)
+    if repaired:
+        VERSIONS.bump(("all",))
+    return {"checked": checked, "repaired": repaired}
+
+# --- Contraseñas (scrypt en un pool de procesos) ---
+# scrypt es caro a propósito (CPU + memoria), así que corre en un
+# ProcessPoolExecutor: no bloquea el event loop ni el threadpool ni compite por
+# el GIL. Hay a lo sumo PWD_MAX_PENDING hashes en curso o en cola; el resto
+# espera PWD_QUEUE_TIMEOUT y recibe 503 en vez de alargar la cola. Formato
+# scrypt$N$r$p$salt$hash (base64). Las contraseñas en texto plano heredadas y
+# las de parámetros viejos se re-hashean en el primer login correcto.
+def _available_cpus() -> int:
+    # os.cpu_count() ve las CPUs del host; en un contenedor valen la afinidad y
+    # la cuota de cgroup (cpu.max = "cuota periodo" o "max periodo")
+    try:
+        n = len(os.sched_getaffinity(0))
+    except AttributeError:
+        n = os.cpu_count() or 1
+    try:
+        with open("/sys/fs/cgroup/cpu.max") as f:
+            quota, period = f.read().split()
+        if quota != "max":
+            n = min(n, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return n
 
-    return {"page": page, "page_size": page_size, "total": total, "items": items}
 
-@app.get("/stats/weekly")
+PWD_SCRYPT_N = int(os.getenv("PWD_SCRYPT_N", str(2 ** 14)))
+PWD_SCRYPT_R = int(os.getenv("PWD_SCRYPT_R", "8"))
+PWD_SCRYPT_P = int(os.getenv("PWD_SCRYPT_P", "1"))
+# pocos workers por defecto (hasta 4): cada uno ocupa una CPU entera mientras
+# hashea y compite con el único worker de uvicorn
+PWD_WORKERS = int(os.getenv("PWD_WORKERS", str(min(4, _available_cpus()))))
+PWD_MAX_PENDING = int(os.getenv("PWD_MAX_PENDING", str(PWD_WORKERS * 4)))
+PWD_QUEUE_TIMEOUT = float(os.getenv("PWD_QUEUE_TIMEOUT", "2"))
+_PWD_PREFIX = "scrypt$"
 
-def stats_weekly(user_id: int = Query(...)):
+PWD_POOL: Optional[ProcessPoolExecutor] = None
+_PWD_SLOTS = asyncio.Semaphore(PWD_MAX_PENDING)
 
-    today = datetime.date.today()
 
-    start = today - datetime.timedelta(days=6)
+def _scrypt(password: str, salt: bytes, n: int, r: int, p: int, dklen: int = 32) -> bytes:
+    return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r + (1 << 20), dklen=dklen)
 
-    with get_conn() as con:
 
-        cur = con.cursor(dictionary=True)
+def _pwd_hash(password: str, n: int, r: int, p: int) -> str:
+    salt = os.urandom(16)
+    dk = _scrypt(password, salt, n, r, p)
+    return f"{_PWD_PREFIX}{n}${r}${p}${base64.b64encode(salt).decode()}${base64.b64encode(dk).decode()}"
 
-        cur.execute("SELECT id, name FROM habits WHERE user_id=%s", (user_id,))
 
-        habits = cur.fetchall()
+def _pwd_check(password: str, stored: str, n: int, r: int, p: int):
+    # -> (ok, hash nuevo si hay que reemplazar el guardado)
+    if not stored.startswith(_PWD_PREFIX):
+        ok = hmac.compare_digest(password.encode(), stored.encode())   # texto plano heredado
+        return ok, (_pwd_hash(password, n, r, p) if ok else None)
+    try:
+        _, sn, sr, sp, salt, dk = stored.split("$")
+        params = (int(sn), int(sr), int(sp))
+        salt, dk = base64.b64decode(salt), base64.b64decode(dk)
+    except ValueError:
+        return False, None
+    ok = hmac.compare_digest(_scrypt(password, salt, *params, dklen=len(dk)), dk)
+    return ok, (_pwd_hash(password, n, r, p) if ok and params != (n, r, p) else None)
 
-        items = []
 
-        for h in habits:
+def _pwd_pool() -> ProcessPoolExecutor:
+    global PWD_POOL
+    if PWD_POOL is None:
+        # fork: los workers no reimportan este módulo (que abre el pool de MySQL);
+        # con fork el executor lanza todos los procesos en el primer submit
+        PWD_POOL = ProcessPoolExecutor(PWD_WORKERS, mp_context=multiprocessing.get_context("fork"))
+    return PWD_POOL
 
-            cur.execute(
 
-                "SELECT day, value FROM logs WHERE habit_id=%s AND day BETWEEN %s AND %s",
+async def _pwd_run(fn, *args):
+    try:
+        await asyncio.wait_for(_PWD_SLOTS.acquire(), PWD_QUEUE_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise HTTPException(503, "Servidor ocupado, intenta de nuevo", headers={"Retry-After": "1"})
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_pwd_pool(), fn, *args)
+    finally:
+        _PWD_SLOTS.release()
+
+
+async def _hash_password(password: str) -> str:
+    return await _pwd_run(_pwd_hash, password, PWD_SCRYPT_N, PWD_SCRYPT_R, PWD_SCRYPT_P)
+
+
+async def _check_password(password: str, stored: str):
+    return await _pwd_run(_pwd_check, password, stored, PWD_SCRYPT_N, PWD_SCRYPT_R, PWD_SCRYPT_P)
+
+# --- Eventos en tiempo real (SSE) ---
+# GET /events abre un stream text/event-stream por pestaña. Cada conexión es
+# una corrutina con una cola asyncio acotada (SSE_QUEUE_MAX), sin hilos ni
+# conexiones a MySQL, así que miles de conexiones ociosas cuestan poco. publish()
+# se puede llamar desde cualquier hilo (los endpoints sync corren en el
+# threadpool) y reparte en el event loop con call_soon_threadsafe. Si la cola de
+# un cliente lento se llena, sus eventos se descartan y luego recibe "resync"
+# para recargar. Los eventos de un post llegan a quien puede verlo, igual que en
+# el feed: si es público, a todos; si es de solo amigos, al autor y sus amigos.
+SSE_QUEUE_MAX = int(os.getenv("SSE_QUEUE_MAX", "64"))
+SSE_PING_SECONDS = float(os.getenv("SSE_PING_SECONDS", "20"))
+SSE_MAX_CONNECTIONS = int(os.getenv("SSE_MAX_CONNECTIONS", "20000"))
+
+
+class _Sub:
+    __slots__ = ("user_id", "queue", "dropped")
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.queue: asyncio.Queue = asyncio.Queue(SSE_QUEUE_MAX)
+        self.dropped = 0
+
+
+class EventHub:
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._subs: Dict[int, set] = {}     # user_id -> {_Sub}; solo se toca desde el loop
+        self.connections = 0
+        self.dropped = 0
+        self.closed = False
+
+    def bind(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+
+    def subscribe(self, user_id: int) -> _Sub:
+        sub = _Sub(user_id)
+        self._subs.setdefault(user_id, set()).add(sub)
+        self.connections += 1
+        return sub
+
+    def unsubscribe(self, sub: _Sub):
+        subs = self._subs.get(sub.user_id)
+        if subs and sub in subs:
+            subs.discard(sub)
+            self.connections -= 1
+            if not subs:
+                del self._subs[sub.user_id]
+
+    def publish(self, event: str, data: dict, audience: Optional[List[int]] = None):
+        # audience: ids que pueden ver el evento; None = todos
+        if self._loop is None or not self.connections:
+            return
+        msg = f"event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, msg, None if audience is None else set(audience))
+        except RuntimeError:
+            pass        # loop cerrado: se está apagando
+
+    def _deliver(self, msg: str, audience: Optional[set]):
+        if audience is None:
+            groups = list(self._subs.values())
+        elif len(audience) < len(self._subs):
+            groups = [self._subs[u] for u in audience if u in self._subs]
+        else:
+            groups = [subs for u, subs in self._subs.items() if u in audience]
+        for subs in groups:
+            for sub in subs:
+                try:
+                    sub.queue.put_nowait(msg)
+                except asyncio.QueueFull:
+                    sub.dropped += 1
+                    self.dropped += 1
+
+    def close(self):
+        # al apagar: cada stream recibe None y termina (el cliente reconecta a
+        # otro proceso). Se llama desde el loop.
+        self.closed = True
+        for subs in self._subs.values():
+            for sub in subs:
+                while True:
+                    try:
+                        sub.queue.put_nowait(None)
+                        break
+                    except asyncio.QueueFull:
+                        sub.queue.get_nowait()
+
+
+EVENTS = EventHub()
+
+
+def _post_audience(author_id: int, visibility: str) -> Optional[List[int]]:
+    if visibility == "public":
+        return None
+    return [author_id, *GRAPH.friends(author_id)]
+
+
+async def _event_stream(user_id: int):
+    sub = EVENTS.subscribe(user_id)
+    try:
+        yield "retry: 5000\n\n"
+        while not EVENTS.closed:
+            try:
+                msg = await asyncio.wait_for(sub.queue.get(), SSE_PING_SECONDS)
+            except asyncio.TimeoutError:
+                yield ": ping\n\n"        # mantiene viva la conexión a través de proxies
+                continue
+            if msg is None:
+                return
+            yield msg
+            if sub.dropped:
+                sub.dropped = 0
+                yield "event: resync\ndata: {}\n\n"
+    finally:
+        EVENTS.unsubscribe(sub)
 
-                (h["id"], start, today)
+# --- Tareas en segundo plano ---
+BG_STOP = threading.Event()
+
+
+def _every(seconds: float, fn, name: str):
+    def loop():
+        while not BG_STOP.wait(seconds):
+            try:
+                fn()
+            except Exception:
+                log.exception("tarea %s falló", name)
+    t = threading.Thread(target=loop, name=name, daemon=True)
+    t.start()
+    return t
+
+
+async def _ensure_timelines(cur, viewer: int):
+    need_global, need_viewer = TIMELINES.needs(viewer)
+    if not (need_global or need_viewer):
+        return
+    g_token, v_token = TIMELINES.begin_load(viewer, need_viewer)
+    try:
+        if need_global:
+            await cur.execute("""
+                SELECT id, author_id, created_at FROM posts
+                WHERE visibility = 'public'
+                ORDER BY created_at DESC, id DESC
+                LIMIT %s
+            """, (GLOBAL_STREAM_CAP + 1,))
+            TIMELINES.install_global(await cur.fetchall(), g_token)
+        if need_viewer:
+            await cur.execute("""
+                SELECT p.id, p.author_id, p.created_at FROM posts p
+                WHERE p.visibility = 'friends'
+                  AND (p.author_id = %s
+                       OR p.author_id IN (SELECT friend_id FROM friendships WHERE user_id = %s))
+                ORDER BY p.created_at DESC, p.id DESC
+                LIMIT %s
+            """, (viewer, viewer, TIMELINE_CAP + 1))
+            rows = await cur.fetchall()
+    except BaseException:
+        if need_viewer:
+            TIMELINES.end_load(viewer)
+        raise
+    if need_viewer:
+        TIMELINES.install_viewer(viewer, rows, v_token)
+
+# --- Arranque y apagado (lifespan) ---
+# Al arrancar se abren los pools y se precalientan: cada conexión ya tiene las
+# variables de sesión aplicadas y las tablas calientes abiertas en el servidor,
+# así el primer request no paga el connect ni la primera lectura. Si MySQL aún
+# no responde, el proceso arranca igual y reintenta en segundo plano; /readyz
+# dice 503 hasta que termina. Al apagar se deja de estar listo, se cierran los
+# streams SSE, se espera a los requests en curso y luego a las conexiones.
+WARMUP_QUERIES = (
+    "SELECT 1",
+    "SELECT 1 FROM users LIMIT 1",
+    "SELECT 1 FROM habits LIMIT 1",
+    "SELECT 1 FROM logs LIMIT 1",
+    "SELECT 1 FROM user_daily_done LIMIT 1",
+    "SELECT 1 FROM posts LIMIT 1",
+    "SELECT 1 FROM post_counters LIMIT 1",
+    "SELECT 1 FROM friendships LIMIT 1",
+)
 
-            )
 
-            vals = cur.fetchall()
+class Lifecycle:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.ready = False
+        self.draining = False
+        self.inflight = 0                  # requests en curso (solo desde el loop)
+        self.timings: Dict[str, float] = {}
 
-            day_map = {row["day"]: int(row["value"]) for row in vals}
+    def mark(self, name: str):
+        self.timings[name] = round(time.monotonic() - self.started, 3)
 
-            done = 0
 
-            for i in range(7):
+LIFECYCLE = Lifecycle()
 
-                d = start + datetime.timedelta(days=i)
 
-                done += day_map.get(d, 0)
+async def _warm_aconn(con):
+    async with con.cursor() as cur:
+        for q in WARMUP_QUERIES:
+            await cur.execute(q)
+            await cur.fetchall()
+        await STATEMENTS.prepare_all(cur)
+    await con.rollback()       # el pool cierra las que vuelven con transacción abierta
 
-            today_done = bool(day_map.get(today, 0))
 
-            items.append({
+async def _warm_async_pool():
+    cons = []
+    try:
+        for _ in range(min(DB_POOL_MIN, DB_POOL_MAX)):
+            cons.append(await asyncio.wait_for(APOOL.acquire(), DB_ACQUIRE_TIMEOUT))
+        await asyncio.gather(*(_warm_aconn(c) for c in cons))
+    finally:
+        for c in cons:
+            APOOL.release(c)
+
 
-                "habit_id": h["id"],
+def _warm_sync_pool():
+    # se piden todas a la vez para pasar por cada conexión del pool (las que
+    # tenga prestadas una tarea en segundo plano ya están en uso)
+    pool, cons = open_sync_pool(), []
+    try:
+        for _ in range(DB_SYNC_POOL_SIZE):
+            try:
+                cons.append(pool.get_connection())
+            except mysql.connector.errors.PoolError:
+                break
+        for con in cons:
+            cur = con.cursor()
+            for q in WARMUP_QUERIES:
+                cur.execute(q)
+                cur.fetchall()
+            cur.close()
+            con.rollback()
+    finally:
+        for con in cons:
+            con.close()
+
+
+async def _warmup():
+    if not DB_WARMUP:
+        LIFECYCLE.mark("ready_s")
+        LIFECYCLE.ready = True
+        return
+    delay = 0.5
+    while True:
+        try:
+            await open_async_pool()
+            await _warm_async_pool()
+            await run_in_threadpool(_warm_sync_pool)
+            break
+        except (aiomysql.Error, mysql.connector.Error, OSError, asyncio.TimeoutError) as e:
+            log.warning("MySQL no disponible (%s); reintento en %.1fs", e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+    LIFECYCLE.mark("pools_warm_s")
+    try:
+        await run_in_threadpool(_ensure_graph_loaded)
+        await run_in_threadpool(_ensure_similar_loaded)
+        await run_in_threadpool(_ensure_ranked_loaded)
+        await run_in_threadpool(_ensure_rank_loaded)
+    except Exception:
+        log.exception("no se pudieron precargar los índices en memoria")
+    LIFECYCLE.mark("ready_s")
+    LIFECYCLE.ready = True
+    log.info("listo en %.3fs (pid %s)", LIFECYCLE.timings["ready_s"], os.getpid())
+
+
+def _pool_stats() -> dict:
+    stats = {}
+    if APOOL is not None:
+        in_use = APOOL.size - APOOL.freesize
+        stats["async"] = {"in_use": in_use, "idle": APOOL.freesize, "max": APOOL.maxsize,
+                          "saturation": round(in_use / APOOL.maxsize, 3)}
+    if POOL is not None:
+        stats["sync"] = {"in_use": _SYNC_IN_USE, "max": DB_SYNC_POOL_SIZE,
+                         "saturation": round(_SYNC_IN_USE / DB_SYNC_POOL_SIZE, 3)}
+    return stats
+
+
+async def _drain(warm: asyncio.Task):
+    LIFECYCLE.draining = True            # /readyz -> 503: el balanceador deja de mandar
+    LIFECYCLE.ready = False
+    warm.cancel()
+    EVENTS.close()
+    deadline = time.monotonic() + DRAIN_SECONDS
+    while LIFECYCLE.inflight and time.monotonic() < deadline:
+        await asyncio.sleep(0.05)
+    if LIFECYCLE.inflight:
+        log.warning("apagando con %d requests en curso", LIFECYCLE.inflight)
+    BG_STOP.set()
+    await run_in_threadpool(COUNTERS.flush)   # lo pendiente no se pierde al apagar
+    await close_async_pool(max(0.0, deadline - time.monotonic()))
+
+
+def _configured_workers() -> int:
+    # los workers de `uvicorn --workers N` heredan sys.argv del proceso padre
+    argv = sys.argv
+    source, raw = "WEB_CONCURRENCY", os.getenv("WEB_CONCURRENCY") or "1"
+    for i, a in enumerate(argv):
+        if a == "--workers" and i + 1 < len(argv):
+            source, raw = "--workers", argv[i + 1]
+            break
+        if a.startswith("--workers="):
+            source, raw = "--workers", a.split("=", 1)[1]
+            break
+    try:
+        return int(raw)
+    except ValueError:
+        raise RuntimeError(f"{source} debe ser un número entero (se recibió {raw!r})") from None
+
+
+def _check_single_worker():
+    # Versiones (ETag), caché de perfiles, timelines, ranking, ventana de la
+    # réplica... viven en memoria del proceso y se invalidan ahí mismo. Con
+    # varios workers, el que recibe la escritura invalida y los demás siguen
+    # respondiendo 304 a ETags viejos o mostrando un perfil que ya es privado.
+    workers = _configured_workers()
+    if workers > 1:
+        raise RuntimeError(f"La API debe correr con un solo worker (se pidieron {workers}): "
+                           "el estado en memoria es por proceso")
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global PWD_POOL
+    _check_single_worker()
+    loop = asyncio.get_running_loop()
+    # primero el pool de contraseñas: hace fork antes de que haya otros hilos
+    await loop.run_in_executor(_pwd_pool(), int)
+    EVENTS.bind(loop)
+    LIFECYCLE.mark("boot_s")
+    warm = asyncio.create_task(_warmup())
+    BG_STOP.clear()
+    _every(COUNTER_FLUSH_SECONDS, COUNTERS.flush, "counters-flush")
+    _every(COUNTER_RECONCILE_SECONDS, reconcile_counters, "counters-reconcile")
+    _every(RANK_REFRESH_SECONDS, _refresh_ranked, "ranked-refresh")
+    _every(60, LEADERBOARD.roll, "rank-roll")
+    try:
+        yield
+    finally:
+        await _drain(warm)
+        if PWD_POOL is not None:
+            PWD_POOL.shutdown(wait=False, cancel_futures=True)
+            PWD_POOL = None
+
+# --- App ---
+app = FastAPI(title="Hábitos API (MySQL)", lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"] if CORS_ORIGINS == "*" else [CORS_ORIGINS],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+    expose_headers=["X-Next-Cursor", "ETag"],
+)
 
-                "habit_name": h["name"],
+class _Instrument:
+    # ASGI puro (no @app.middleware): el request se cierra con el último
+    # http.response.body y no cuando se devuelve el objeto Response, así las
+    # respuestas en streaming (/export, /events) miden su duración completa,
+    # cuentan sus consultas y el drenaje del apagado las espera.
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        st = _ReqStats(scope)
+        reset = _REQ.set(st)
+        t0 = time.perf_counter()
+        status = 500
+        done = False
+        LIFECYCLE.inflight += 1
+
+        def finish():
+            nonlocal done
+            if not done:
+                done = True
+                LIFECYCLE.inflight -= 1
+                METRICS.observe(scope["method"], st.route(), status, time.perf_counter() - t0, st)
+
+        async def send_traced(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+            if message["type"] == "http.response.body" and not message.get("more_body", False):
+                finish()
 
-                "done": done,
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            finish()
+            _REQ.reset(reset)
+
+
+app.add_middleware(_Instrument)
+
+@app.get("/metrics")
+def metrics():
+    gauges = {}
+    if APOOL is not None:
+        gauges = {"idle": APOOL.freesize, "in_use": APOOL.size - APOOL.freesize, "max": APOOL.maxsize}
+    return PlainTextResponse(METRICS.render(gauges) + ROUTER.render() + STATEMENTS.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/events")
+async def events(user_id: int = Query(...)):
+    if EVENTS.connections >= SSE_MAX_CONNECTIONS:
+        raise HTTPException(503, "Demasiadas conexiones de eventos", headers={"Retry-After": "10"})
+    return StreamingResponse(
+        _event_stream(user_id),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/healthz")
+async def healthz():
+    # vivo: el proceso atiende; no toca la base
+    return {"status": "ok", "pid": os.getpid(), "uptime_s": round(time.monotonic() - LIFECYCLE.started, 3)}
+
+@app.get("/readyz")
+async def readyz(response: Response):
+    # listo: pools abiertos y precalentados, sin apagar y con conexiones libres
+    pools = _pool_stats()
+    ready = (LIFECYCLE.ready and not LIFECYCLE.draining
+             and all(p["saturation"] < READY_MAX_SATURATION for p in pools.values()))
+    if not ready:
+        response.status_code = 503
+    return {
+        "ready": ready,
+        "draining": LIFECYCLE.draining,
+        "pid": os.getpid(),
+        "inflight": LIFECYCLE.inflight,
+        "pools": pools,
+        "startup": LIFECYCLE.timings,
+    }
 
-                "total_days": 7,
+# --- Modelos ---
+@app.get("/public/users")
+def public_users(
+    q: Optional[str] = None,
+    page: int = 1,
+    page_size: int = 50,
+    cursor: Optional[str] = None,
+):
+    if page <= 0 or page_size <= 0 or page_size > 200:
+        raise HTTPException(400, "Parámetros de paginación inválidos")
 
-                "today_done": today_done
+    # con cursor se sigue desde la última clave de orden (keyset); si no, OFFSET
+    after = _decode_cursor(cursor).get("k") if cursor else None
+    if cursor and not isinstance(after, list):
+        raise HTTPException(400, "cursor inválido")
+    offset = 0 if cursor else (page - 1) * page_size
 
-            })
+    # índice de n-gramas en memoria: sin LIKE '%q%' ni COUNT(*) por tecla
+    _ensure_public_loaded()
+    try:
+        items, total, last = PUBLIC.search((q or "").strip(), after, offset, page_size)
+    except TypeError:
+        raise HTTPException(400, "cursor inválido")
 
-        return {"today": today.isoformat(), "items": items}
+    next_cursor = _encode_cursor({"k": last}) if last is not None else None
+    return {"page": page, "page_size": page_size, "total": total, "items": items, "next_cursor": next_cursor}
 
 @app.get("/public/user/{username}")
 def public_user_detail(username: str):
     today = datetime.date.today()
     start = today - datetime.timedelta(days=6)
 
+    cached = PROFILE_CACHE.get(username, today)
+    if cached is not None:
+        return cached
+    token = PROFILE_CACHE.begin()
+
     with get_conn() as con:
         cur = con.cursor(dictionary=True)
         # user + perfil público
@@ -196,70 +3016,73 @@ def public_user_detail(username: str):
 
         # días cumplidos (últimos 7)
         cur.execute("""
-            SELECT COALESCE(SUM(CASE WHEN l.value=1 THEN 1 ELSE 0 END),0) AS done_days
-            FROM habits h
-            LEFT JOIN logs l ON l.habit_id=h.id AND l.day BETWEEN %s AND %s
-            WHERE h.user_id=%s
-        """, (start, today, user_id))
+            SELECT COALESCE(SUM(done_count),0) AS done_days
+            FROM user_daily_done
+            WHERE user_id=%s AND day BETWEEN %s AND %s
+        """, (user_id, start, today))
         done_days = cur.fetchone()["done_days"]
 
-    return {
+        # rachas: la mejor actual (viva) y la más larga entre sus hábitos
+        cur.execute("""
+            SELECT s.last_done, s.current_len, s.longest_len
+            FROM habit_streaks s JOIN habits h ON h.id = s.habit_id
+            WHERE h.user_id=%s
+        """, (user_id,))
+        views = [_streak_view(r["last_done"], r["current_len"], r["longest_len"], today) for r in cur.fetchall()]
+
+    out = {
         "user": {"id": user_id, "username": row["username"], "bio": row["bio"]},
         "summary": {
             "window_days": 7,
             "range": {"start": start.isoformat(), "end": today.isoformat()},
             "habits_count": habits_count,
-            "done_days": int(done_days)
+            "done_days": int(done_days),
+            "current_streak": max((v["current"] for v in views), default=0),
+            "longest_streak": max((v["longest"] for v in views), default=0),
         }
     }
+    PROFILE_CACHE.put(username, user_id, today, out, token)
+    return out
 
 @app.get("/public/rank")
-def public_rank(
-    window: int = Query(7, ge=1, le=365),  # aceptamos int, validamos abajo a 7/30
+async def public_rank(
+    request: Request,
+    response: Response,
+    window: int = Query(7, ge=1, le=RANK_MAX_WINDOW),
     page: int = Query(1, ge=1),
     page_size: int = Query(50, ge=1, le=200),
+    user_id: Optional[int] = Query(None, description="Si se envía, incluye la posición de ese usuario"),
 ):
-    # normaliza a 7 o 30 (cualquier otro valor se redondea a 7)
-    window = 30 if window == 30 else 7
+    if not LEADERBOARD.loaded:
+        # carga única (bloqueante) fuera del event loop
+        await run_in_threadpool(_ensure_rank_loaded)
 
     today = datetime.date.today()
     start = today - datetime.timedelta(days=window - 1)
     offset = (page - 1) * page_size
 
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        cur.execute("""
-            SELECT u.id, u.username,
-                COALESCE(MAX(habit_done.done_days), 0) AS done_days
-            FROM users u
-            JOIN profiles p ON p.user_id = u.id AND p.is_public = 1
-            LEFT JOIN (
-                SELECT h.user_id,
-                    h.id AS habit_id,
-                    COUNT(*) AS done_days
-                FROM habits h
-                LEFT JOIN logs l
-                    ON l.habit_id = h.id
-                    AND l.value = 1
-                    AND l.day BETWEEN %s AND %s
-                GROUP BY h.user_id, h.id
-            ) habit_done ON habit_done.user_id = u.id
-            GROUP BY u.id, u.username
-            ORDER BY done_days DESC, u.username ASC
-            LIMIT %s OFFSET %s
-        """, (start, today, page_size, offset))
-
-        items = cur.fetchall()
+    etag = VERSIONS.etag(("rank", window, page, page_size, user_id, today.toordinal()), [("rank",)])
+    if _if_none_match(request, etag):
+        return _not_modified(etag)
+    _set_etag(response, etag)
 
-        cur.execute("SELECT COUNT(*) AS total_public FROM profiles WHERE is_public=1")
-        total_public = cur.fetchone()["total_public"]
+    # una ventana fría o el cambio de día reconstruyen el tablero (O(usuarios ×
+    # ventana) bajo el lock): nunca en el event loop
+    def read():
+        items, total_public = LEADERBOARD.page(window, offset, page_size, today)
+        me = LEADERBOARD.rank_of(window, user_id, today) if user_id is not None else None
+        return items, total_public, me
 
-    return {
+    items, total_public, me = await run_in_threadpool(read)
+    out = {
         "window": window,
         "range": {"start": start.isoformat(), "end": today.isoformat()},
         "page": page, "page_size": page_size, "total_public": total_public,
         "items": items
     }
+    if user_id is not None:
+        out["me"] = me
+    return out
 
 class FriendIn(BaseModel):
     user_id: int
@@ -373,12 +3196,20 @@ class ProfileVisibility(BaseModel):
 
 @app.put("/profile/visibility")
 def set_profile_visibility(p: ProfileVisibility):
-    with get_conn() as con:
+    with get_conn(user_id=p.user_id) as con:
         cur = con.cursor()
-        cur.execute("SELECT 1 FROM profiles WHERE user_id=%s", (p.user_id,))
-        if not cur.fetchone():
+        cur.execute("""
+            SELECT u.username, p.is_public
+            FROM profiles p JOIN users u ON u.id = p.user_id
+            WHERE p.user_id=%s
+        """, (p.user_id,))
+        row = cur.fetchone()
+        if not row:
             raise HTTPException(404, "Perfil no encontrado")
+        username, was_public = row[0], bool(row[1])
 
+        # antes del UPDATE: las lecturas en curso ya no pueden guardar la versión vieja
+        PROFILE_CACHE.invalidate(p.user_id)
         cur.execute("""
             UPDATE profiles
                SET is_public=%s, bio=%s
@@ -390,7 +3221,18 @@ def set_profile_visibility(p: ProfileVisibility):
             SELECT first_name, last_name, gender, birth_date, is_public, bio
             FROM profiles WHERE user_id=%s
         """, (p.user_id,))
-        return {"profile": cur.fetchone()}
+        profile = cur.fetchone()
+
+    if p.is_public:
+        PUBLIC.put(p.user_id, username, p.bio)
+        if not was_public:
+            _join_leaderboard(p.user_id, username)
+    else:
+        PUBLIC.remove(p.user_id)
+        LEADERBOARD.remove_member(p.user_id)
+    PROFILE_CACHE.invalidate(p.user_id)
+    VERSIONS.bump(("profile", p.user_id), ("rank",))
+    return {"profile": profile}
 
 
 
@@ -403,9 +3245,141 @@ def _is_friend(con, a: int, b: int) -> bool:
     return bool(cur.fetchone())
 
 
+async def _fetch_feed_rows(con, ids: List[int], viewer_id: int) -> List[Dict]:
+    # filas completas del feed para ids ya ordenados (PK lookups)
+    if not ids:
+        return []
+    cur = await con.cursor(aiomysql.DictCursor)
+    marks = ",".join(["%s"] * len(ids))
+    await cur.execute(f"""
+        SELECT
+          p.id, p.author_id, u.username, p.content, p.habit_id, p.visibility, p.created_at,
+          COALESCE(pc.likes, 0) AS likes, COALESCE(pc.comments, 0) AS comments
+        FROM posts p
+        JOIN users u ON u.id = p.author_id
+        LEFT JOIN post_counters pc ON pc.post_id = p.id
+        WHERE p.id IN ({marks})
+    """, tuple(ids))
+    by_id = {r["id"]: r for r in await cur.fetchall()}
+    rows = [by_id[i] for i in ids if i in by_id]
+    await _adecorate_posts(con, rows, viewer_id)
+    return rows
+
+def _liked_query(rows: List[Dict], viewer_id: int):
+    return f"""
+        SELECT post_id FROM post_likes
+        WHERE user_id = %s AND post_id IN ({",".join(["%s"] * len(rows))})
+    """, (viewer_id, *(r["id"] for r in rows))
+
+def _set_liked(rows: List[Dict], liked_rows):
+    liked = {r[0] for r in liked_rows}
+    for r in rows:
+        r["liked_by_me"] = int(r["id"] in liked)
+
+def _decorate_posts(con, rows: List[Dict], viewer_id: Optional[int] = None):
+    # deltas aún no volcados + liked_by_me en una sola consulta para toda la página
+    COUNTERS.overlay(rows)
+    if viewer_id is None or not rows:
+        return
+    cur = con.cursor()
+    cur.execute(*_liked_query(rows, viewer_id))
+    _set_liked(rows, cur.fetchall())
+
+async def _adecorate_posts(con, rows: List[Dict], viewer_id: Optional[int] = None):
+    COUNTERS.overlay(rows)
+    if viewer_id is None or not rows:
+        return
+    cur = await con.cursor()
+    await cur.execute(*_liked_query(rows, viewer_id))
+    _set_liked(rows, await cur.fetchall())
+
+# Vista previa de comentarios: los últimos `per_post` de cada post en una sola
+# consulta (ROW_NUMBER por post sobre idx_comments_post_created), en orden
+# cronológico como en /posts/{post_id}/comments.
+PREVIEW_PER_POST = 3
+PREVIEW_MAX_POSTS = 50
+
+def _previews_query(post_ids: List[int], per_post: int):
+    return f"""
+        SELECT t.post_id, t.id, t.content, t.created_at, u.username
+        FROM (
+          SELECT c.post_id, c.id, c.content, c.created_at, c.user_id,
+                 ROW_NUMBER() OVER (PARTITION BY c.post_id ORDER BY c.created_at DESC, c.id DESC) AS rn
+          FROM post_comments c
+          WHERE c.post_id IN ({",".join(["%s"] * len(post_ids))})
+        ) t
+        JOIN users u ON u.id = t.user_id
+        WHERE t.rn <= %s
+        ORDER BY t.post_id, t.created_at, t.id
+    """, (*post_ids, per_post)
+
+def _group_previews(post_ids: List[int], rows) -> Dict[int, List[Dict]]:
+    out: Dict[int, List[Dict]] = {pid: [] for pid in post_ids}
+    for post_id, cid, content, created_at, username in rows:
+        out[post_id].append({"id": cid, "content": content, "created_at": created_at, "username": username})
+    return out
+
+def _fetch_previews(con, post_ids: List[int], per_post: int) -> Dict[int, List[Dict]]:
+    if not post_ids:
+        return {}
+    cur = con.cursor()
+    cur.execute(*_previews_query(post_ids, per_post))
+    return _group_previews(post_ids, cur.fetchall())
+
+async def _afetch_previews(con, post_ids: List[int], per_post: int) -> Dict[int, List[Dict]]:
+    if not post_ids:
+        return {}
+    cur = await con.cursor()
+    await cur.execute(*_previews_query(post_ids, per_post))
+    return _group_previews(post_ids, await cur.fetchall())
+
+def _set_previews(rows: List[Dict], previews: Dict[int, List[Dict]]):
+    for r in rows:
+        r["comments_preview"] = previews.get(r["id"], [])
+
+# Cursores opacos para paginación keyset: base64url de un JSON pequeño.
+def _encode_cursor(data: dict) -> str:
+    raw = json.dumps(data, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str) -> dict:
+    try:
+        data = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise HTTPException(400, "cursor inválido")
+    if not isinstance(data, dict):
+        raise HTTPException(400, "cursor inválido")
+    return data
+
+def _time_cursor(row: dict) -> str:
+    return _encode_cursor({"t": row["created_at"].isoformat(), "id": row["id"]})
+
+def _decode_time_cursor(cursor: str):
+    data = _decode_cursor(cursor)
+    try:
+        return datetime.datetime.fromisoformat(data["t"]), int(data["id"])
+    except (KeyError, TypeError, ValueError):
+        raise HTTPException(400, "cursor inválido")
+
+def _keyset(alias: str, after, direction: str = "<"):
+    # (created_at, id) estrictamente antes/después del cursor; usa los índices por created_at
+    if after is None:
+        return "", ()
+    t, i = after
+    return (f"AND ({alias}.created_at {direction} %s OR ({alias}.created_at = %s AND {alias}.id {direction} %s))",
+            (t, t, i))
+
+def _page_out(rows: list, page_size: int):
+    # se pide page_size+1 filas para saber si hay otra página
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, _time_cursor(rows[-1])
+    return rows, None
+
+
 # --- Endpoints Auth ---
 @app.post("/signup")
-def signup(p: Signup):
+async def signup(p: Signup):
     # === Validaciones ===
     # Validar campos obligatorios
     if not p.email or not p.username or not p.password or not p.first_name or not p.last_name:
@@ -426,19 +3400,27 @@ def signup(p: Signup):
             raise HTTPException(400, "La edad mínima es de 5 años")
 
     # === Inserción en base de datos ===
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        cur.execute("SELECT 1 FROM users WHERE username=%s", (p.username,))
-        if cur.fetchone():
+    async with get_aconn() as con:
+        cur = await con.cursor()
+        await cur.execute("SELECT 1 FROM users WHERE username=%s", (p.username,))
+        if await cur.fetchone():
             raise HTTPException(400, "Usuario ya existe")
 
-        cur.execute(
-            "INSERT INTO users(email, username, password) VALUES (%s,%s,%s)",
-            (p.email, p.username, p.password)  # En producción: ¡hashear!
-        )
+    # el hash se calcula sin retener una conexión
+    password = await _hash_password(p.password)
+
+    async with get_aconn() as con:
+        cur = await con.cursor()
+        try:
+            await cur.execute(
+                "INSERT INTO users(email, username, password) VALUES (%s,%s,%s)",
+                (p.email, p.username, password)
+            )
+        except aiomysql.IntegrityError:
+            raise HTTPException(400, "Usuario ya existe")
         user_id = cur.lastrowid
 
-        cur.execute(
+        await cur.execute(
             """
             INSERT INTO profiles(user_id, first_name, last_name, gender, birth_date)
             VALUES (%s, %s, %s, %s, %s)
@@ -457,29 +3439,41 @@ def signup(p: Signup):
         }
 
 @app.post("/login")
-def login(p: Login):
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        cur.execute(
-            "SELECT id, email, username FROM users WHERE username=%s AND password=%s",
-            (p.username, p.password)
-        )
-        row = cur.fetchone()
-        if not row:
-            raise HTTPException(401, "Credenciales inválidas")
-
-        cur.execute(
-            "SELECT first_name, last_name, gender, birth_date FROM profiles WHERE user_id=%s",
-            (row["id"],)
-        )
-        prof = cur.fetchone()
-
-        return {"user": row, "profile": prof}
+async def login(p: Login):
+    async with get_aconn() as con:
+        cur = await con.cursor(aiomysql.DictCursor)
+        await cur.execute("""
+            SELECT u.id, u.email, u.username, u.password,
+                   p.first_name, p.last_name, p.gender, p.birth_date
+            FROM users u LEFT JOIN profiles p ON p.user_id = u.id
+            WHERE u.username=%s
+        """, (p.username,))
+        row = await cur.fetchone()
+
+    if not row:
+        # mismo costo que un usuario existente: no revela qué usernames existen
+        await _hash_password(p.password)
+        raise HTTPException(401, "Credenciales inválidas")
+    ok, upgraded = await _check_password(p.password, row["password"])
+    if not ok:
+        raise HTTPException(401, "Credenciales inválidas")
+    if upgraded:
+        async with get_aconn() as con:
+            cur = await con.cursor()
+            # solo si nadie la cambió mientras tanto
+            await cur.execute("UPDATE users SET password=%s WHERE id=%s AND password=%s",
+                              (upgraded, row["id"], row["password"]))
+
+    user = {"id": row["id"], "email": row["email"], "username": row["username"]}
+    prof = None
+    if row["first_name"] is not None:
+        prof = {k: row[k] for k in ("first_name", "last_name", "gender", "birth_date")}
+    return {"user": user, "profile": prof}
 
 
 @app.put("/profile")
 def update_profile(p: ProfileUpdate):
-    with get_conn() as con:
+    with get_conn(user_id=p.user_id) as con:
         cur = con.cursor()
         # Asegurar que exista el user y su perfil
         cur.execute("SELECT 1 FROM users WHERE id=%s", (p.user_id,))
@@ -497,11 +3491,19 @@ def update_profile(p: ProfileUpdate):
         cur = con.cursor(dictionary=True)
         cur.execute("SELECT first_name, last_name, gender, birth_date FROM profiles WHERE user_id=%s", (p.user_id,))
         prof = cur.fetchone()
-        return {"profile": prof}
+    PROFILE_CACHE.invalidate(p.user_id)
+    VERSIONS.bump(("profile", p.user_id))
+    return {"profile": prof}
 
 # --- Endpoints Hábitos ---
 @app.get("/habits")
-def list_habits(user_id: int = Query(...)):
+def list_habits(request: Request, response: Response, user_id: int = Query(...)):
+    etag = VERSIONS.etag(("habits", user_id), [("habits", user_id)])
+    if _if_none_match(request, etag):
+        return _not_modified(etag)
+    _set_etag(response, etag)
+    # con ETag se lee del primario: una réplica atrasada dejaría datos viejos
+    # cacheados bajo la versión nueva (y 304 para siempre hasta el próximo bump)
     with get_conn() as con:
         cur = con.cursor(dictionary=True)
         cur.execute("SELECT id, name FROM habits WHERE user_id=%s ORDER BY id DESC", (user_id,))
@@ -510,45 +3512,221 @@ def list_habits(user_id: int = Query(...)):
 
 @app.post("/habits")
 def add_habit(p: HabitIn):
-    with get_conn() as con:
+    with get_conn(user_id=p.user_id) as con:
         cur = con.cursor()
         cur.execute("INSERT INTO habits(user_id, name) VALUES (%s,%s)", (p.user_id, p.name))
         habit_id = cur.lastrowid
-        return {"ok": True, "id": habit_id}
+        cur.execute("INSERT INTO habit_streaks (habit_id) VALUES (%s)", (habit_id,))
+    STATS.add_habit(p.user_id, habit_id, p.name)
+    HEATMAP.add_habit(p.user_id, habit_id, p.name)
+    SIMILAR.add_habit(p.user_id, p.name)
+    PROFILE_CACHE.invalidate(p.user_id)
+    VERSIONS.bump(("habits", p.user_id))
+    return {"ok": True, "id": habit_id}
 
 @app.delete("/habits/{habit_id}")
 def delete_habit(habit_id: int, user_id: int = Query(...)):
-    with get_conn() as con:
+    today = datetime.date.today()
+    with get_conn(user_id=user_id) as con:
         cur = con.cursor()
+        cur.execute("SELECT name FROM habits WHERE id=%s AND user_id=%s", (habit_id, user_id))
+        row = cur.fetchone()
+        name = row[0] if row else None
+        # días cumplidos que hay que descontar del ranking
+        cur.execute("""
+            SELECT l.day FROM logs l JOIN habits h ON h.id=l.habit_id
+            WHERE h.id=%s AND h.user_id=%s AND l.value=1 AND l.day BETWEEN %s AND %s
+        """, (habit_id, user_id, today - datetime.timedelta(days=RANK_MAX_WINDOW - 1), today))
+        done_days = [r[0] for r in cur.fetchall()]
+        if name is not None:
+            # descontar del rollup todos sus días cumplidos (no solo la ventana del ranking)
+            cur.execute("""
+                UPDATE user_daily_done d
+                JOIN logs l ON l.day = d.day AND l.habit_id = %s AND l.value = 1
+                SET d.done_count = d.done_count - 1
+                WHERE d.user_id = %s
+            """, (habit_id, user_id))
         # Borrar logs del hábito del usuario + el hábito
         cur.execute(
             "DELETE l FROM logs l JOIN habits h ON h.id=l.habit_id WHERE h.id=%s AND h.user_id=%s",
             (habit_id, user_id)
         )
         cur.execute("DELETE FROM habits WHERE id=%s AND user_id=%s", (habit_id, user_id))
-        return {"ok": True}
+    if name is not None:
+        _on_habit_deleted(user_id, habit_id, name, done_days)
+    return {"ok": True}
 
 # --- Endpoints Logs ---
 @app.post("/logs/mark_today")
-def mark_today(p: MarkToday):
+async def mark_today(p: MarkToday):
     if p.value not in (0,1):
         raise HTTPException(400, "value debe ser 0 o 1")
     today = datetime.date.today()
-    with get_conn() as con:
-        cur = con.cursor()
-        # Validar propiedad del hábito
-        cur.execute("SELECT 1 FROM habits WHERE id=%s AND user_id=%s", (p.habit_id, p.user_id))
-        if not cur.fetchone():
+    async with get_aconn(user_id=p.user_id) as con:
+        cur = await con.cursor()
+        # Validar propiedad del hábito y leer el valor anterior (para los deltas)
+        await cur.execute("""
+            SELECT h.id, l.value
+            FROM habits h
+            LEFT JOIN logs l ON l.habit_id = h.id AND l.day = %s
+            WHERE h.id=%s AND h.user_id=%s
+            FOR UPDATE
+        """, (today, p.habit_id, p.user_id))
+        row = await cur.fetchone()
+        if not row:
             raise HTTPException(403, "No autorizado")
+        old_value = int(row[1] or 0)
         # UPSERT por UNIQUE(habit_id, day)
-        cur.execute(
+        await cur.execute(
             """
             INSERT INTO logs(habit_id, day, value) VALUES (%s,%s,%s)
             ON DUPLICATE KEY UPDATE value=VALUES(value)
             """,
             (p.habit_id, today, p.value)
         )
-        return {"ok": True}
+        await _aupdate_streak(cur, p.habit_id, today, p.value, old_value)
+        await _abump_daily(cur, p.user_id, {today: p.value - old_value})
+    _on_log_written(p.user_id, p.habit_id, today, p.value, old_value)
+    return {"ok": True}
+
+# Carga masiva / backfill: NDJSON (una entrada por línea, se lee en streaming)
+# o un arreglo JSON de {"habit_id", "day", "value"}. Se valida todo en memoria
+# (propiedad de los hábitos con una sola consulta) y se escribe en una
+# transacción con upserts multi-fila de BULK_CHUNK filas.
+BULK_CHUNK = 1000
+BULK_MAX_ROWS = int(os.getenv("BULK_MAX_ROWS", "200000"))
+BULK_MAX_ERRORS = 20
+
+
+async def _bulk_entries(request: Request):
+    ctype = request.headers.get("content-type", "")
+    if "ndjson" in ctype or "jsonl" in ctype:
+        n, buf = 0, b""
+        async for chunk in request.stream():
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                if line.strip():
+                    n += 1
+                    yield n, line
+        if buf.strip():
+            yield n + 1, buf
+        return
+    try:
+        data = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(400, "JSON inválido")
+    if not isinstance(data, list):
+        raise HTTPException(400, "Se esperaba un arreglo JSON o NDJSON")
+    for i, item in enumerate(data, 1):
+        yield i, item
+
+
+def _parse_bulk_entry(item, today: datetime.date):
+    if isinstance(item, (bytes, str)):
+        try:
+            item = json.loads(item)
+        except ValueError:
+            return None, "JSON inválido"
+    if not isinstance(item, dict):
+        return None, "se esperaba un objeto"
+    habit_id, value = item.get("habit_id"), item.get("value")
+    if not isinstance(habit_id, int) or isinstance(habit_id, bool):
+        return None, "habit_id inválido"
+    if value not in (0, 1) or isinstance(value, bool):
+        return None, "value debe ser 0 o 1"
+    try:
+        day = datetime.date.fromisoformat(item.get("day"))
+    except (TypeError, ValueError):
+        return None, "day debe ser YYYY-MM-DD"
+    if day > today:
+        return None, "day no puede ser futuro"
+    return (habit_id, day, value), None
+
+
+@app.post("/logs/bulk")
+async def logs_bulk(request: Request, user_id: int = Query(...)):
+    today = datetime.date.today()
+    entries: Dict[tuple, int] = {}     # (habit_id, day) -> value; gana la última
+    lines: Dict[int, List[int]] = {}   # habit_id -> entradas que lo usan (para rechazarlas)
+    rejected, errors = 0, []
+
+    def reject(n: int, msg: str):
+        nonlocal rejected
+        rejected += 1
+        errors.append({"entry": n, "error": msg})
+        if len(errors) > BULK_MAX_ERRORS:
+            errors.sort(key=lambda e: e["entry"])
+            errors.pop()
+
+    # El cuerpo se lee y valida entero antes de pedir conexión: un cliente
+    # lento no retiene una conexión del pool (ni una transacción abierta).
+    async for n, item in _bulk_entries(request):
+        if n > BULK_MAX_ROWS:
+            raise HTTPException(413, f"Máximo {BULK_MAX_ROWS} entradas por carga")
+        parsed, err = _parse_bulk_entry(item, today)
+        if err:
+            reject(n, err)
+        else:
+            entries[(parsed[0], parsed[1])] = parsed[2]
+            lines.setdefault(parsed[0], []).append(n)
+
+    async with get_aconn(user_id=user_id) as con:
+        cur = await con.cursor()
+        await cur.execute("SELECT id FROM habits WHERE user_id=%s", (user_id,))
+        owned = {r[0] for r in await cur.fetchall()}
+        for habit_id in set(lines) - owned:
+            for n in lines[habit_id]:
+                reject(n, "hábito no encontrado o no autorizado")
+        entries = {k: v for k, v in entries.items() if k[0] in owned}
+        errors.sort(key=lambda e: e["entry"])
+
+        inserted = updated = unchanged = 0
+        changes = []
+        keys = list(entries)
+        for i in range(0, len(keys), BULK_CHUNK):
+            chunk = keys[i:i + BULK_CHUNK]
+            # valores previos del lote (para contar y para los deltas en memoria)
+            await cur.execute(f"""
+                SELECT habit_id, day, value FROM logs
+                WHERE (habit_id, day) IN ({",".join(["(%s,%s)"] * len(chunk))})
+                FOR UPDATE
+            """, [v for k in chunk for v in k])
+            old = {(r[0], r[1]): int(r[2]) for r in await cur.fetchall()}
+            rows = []
+            for k in chunk:
+                value = entries[k]
+                if k not in old:
+                    inserted += 1
+                elif old[k] == value:
+                    unchanged += 1
+                    continue
+                else:
+                    updated += 1
+                rows.append((k[0], k[1], value))
+                changes.append((k[0], k[1], value, old.get(k, 0)))
+            if rows:
+                await cur.execute(f"""
+                    INSERT INTO logs (habit_id, day, value)
+                    VALUES {",".join(["(%s,%s,%s)"] * len(rows))}
+                    ON DUPLICATE KEY UPDATE value=VALUES(value)
+                """, [v for r in rows for v in r])
+
+        # días pasados: se recalculan las rachas de los hábitos tocados
+        touched = sorted({c[0] for c in changes})
+        for i in range(0, len(touched), STREAK_REBUILD_BATCH):
+            await _arebuild_streaks(cur, touched[i:i + STREAK_REBUILD_BATCH])
+
+        per_day: Dict[datetime.date, int] = {}
+        for _, day, value, old_value in changes:
+            per_day[day] = per_day.get(day, 0) + value - old_value
+        await _abump_daily(cur, user_id, per_day)
+
+    _on_logs_written(user_id, changes)
+    return {
+        "inserted": inserted, "updated": updated, "unchanged": unchanged,
+        "rejected": rejected, "errors": errors,
+    }
 
 # @app.get("/posts/by_user")
 # def posts_by_user(
@@ -612,7 +3790,8 @@ def create_post(p: PostIn):
         raise HTTPException(400, "Contenido vacío")
     if p.visibility not in ("public", "friends"):
         raise HTTPException(400, "visibility inválido")
-    with get_conn() as con:
+    friend_ids: List[int] = []
+    with get_conn(user_id=p.author_id) as con:
         cur = con.cursor()
         # validar user
         cur.execute("SELECT 1 FROM users WHERE id=%s", (p.author_id,))
@@ -622,22 +3801,40 @@ def create_post(p: PostIn):
             VALUES (%s,%s,%s,%s)
         """, (p.author_id, p.habit_id, p.content.strip(), p.visibility))
         pid = cur.lastrowid
-        return {"ok": True, "id": pid}
+        cur.execute("SELECT created_at FROM posts WHERE id=%s", (pid,))
+        created_at = cur.fetchone()[0]
+        # fan-out: los de solo amigos van al timeline de cada amigo
+        if p.visibility == "friends":
+            cur.execute("SELECT friend_id FROM friendships WHERE user_id=%s", (p.author_id,))
+            friend_ids = [r[0] for r in cur.fetchall()]
+    TIMELINES.add_post(pid, p.author_id, created_at, p.visibility, friend_ids)
+    RANKED.add_post(pid, p.author_id, created_at, p.visibility)
+    VERSIONS.bump(("posts",))
+    EVENTS.publish("post", {"post_id": pid, "author_id": p.author_id},
+                   None if p.visibility == "public" else [p.author_id, *friend_ids])
+    return {"ok": True, "id": pid}
 
 @app.delete("/posts/{post_id}")
 def delete_post(post_id: int, user_id: int = Query(...)):
-    with get_conn() as con:
+    with get_conn(user_id=user_id) as con:
         cur = con.cursor()
-        cur.execute("DELETE FROM posts WHERE id=%s AND author_id=%s", (post_id, user_id))
-        if cur.rowcount == 0:
+        cur.execute("SELECT visibility, created_at FROM posts WHERE id=%s AND author_id=%s FOR UPDATE",
+                    (post_id, user_id))
+        row = cur.fetchone()
+        if not row:
             raise HTTPException(403, "No autorizado o post inexistente")
-        return {"ok": True}
+        cur.execute("DELETE FROM posts WHERE id=%s AND author_id=%s", (post_id, user_id))
+    TIMELINES.remove_post(post_id, user_id, row[1], row[0])
+    RANKED.remove_post(post_id)
+    COUNTERS.drop(post_id)
+    VERSIONS.bump(("posts",), ("post", post_id))
+    return {"ok": True}
 
 @app.post("/friends/add")
 def friends_add(p: FriendIn):
     if p.user_id == p.target_id:
         raise HTTPException(400, "No puedes agregarte a ti mismo")
-    with get_conn() as con:
+    with get_conn(user_id=p.user_id) as con:
         cur = con.cursor()
         # verifica que ambos usuarios existan
         cur.execute("SELECT 1 FROM users WHERE id=%s", (p.user_id,))
@@ -647,11 +3844,22 @@ def friends_add(p: FriendIn):
         # inserta ambas direcciones (si ya existe, ignora)
         cur.execute("INSERT IGNORE INTO friendships(user_id, friend_id) VALUES (%s,%s)", (p.user_id, p.target_id))
         cur.execute("INSERT IGNORE INTO friendships(user_id, friend_id) VALUES (%s,%s)", (p.target_id, p.user_id))
-        return {"ok": True}
+    TIMELINES.invalidate(p.user_id, p.target_id)
+    ROUTER.touch(p.target_id)      # la amistad también cambió para el otro
+    GRAPH.add_edge(p.user_id, p.target_id)
+    VERSIONS.bump(("friends", p.user_id), ("friends", p.target_id))
+    return {"ok": True}
 
 @app.get("/friends/list")
-def friends_list(user_id: int = Query(...)):
-    with get_conn() as con:
+def friends_list(request: Request, response: Response, user_id: int = Query(...)):
+    # la lista muestra bio/is_public de cada amigo: su versión de perfil entra al ETag
+    _ensure_graph_loaded()
+    keys = [("friends", user_id), *(("profile", f) for f in sorted(GRAPH.friends(user_id)))]
+    etag = VERSIONS.etag(("friends", user_id), keys)
+    if _if_none_match(request, etag):
+        return _not_modified(etag)
+    _set_etag(response, etag)
+    with get_conn() as con:        # primario, como /habits (ETag)
         cur = con.cursor(dictionary=True)
         cur.execute("""
             SELECT u.id, u.username, p.bio, p.is_public
@@ -667,15 +3875,45 @@ def friends_list(user_id: int = Query(...)):
 def friends_remove(user_id: int = Query(...), target_id: int = Query(...)):
     if user_id == target_id:
         raise HTTPException(400, "Operación inválida")
-    with get_conn() as con:
+    with get_conn(user_id=user_id) as con:
         cur = con.cursor()
         cur.execute("DELETE FROM friendships WHERE user_id=%s AND friend_id=%s", (user_id, target_id))
         cur.execute("DELETE FROM friendships WHERE user_id=%s AND friend_id=%s", (target_id, user_id))
-        return {"ok": True}
+    TIMELINES.invalidate(user_id, target_id)
+    ROUTER.touch(target_id)
+    GRAPH.remove_edge(user_id, target_id)
+    VERSIONS.bump(("friends", user_id), ("friends", target_id))
+    return {"ok": True}
+
+@app.get("/friends/mutual")
+def friends_mutual(user_id: int = Query(...), other_id: int = Query(...), limit: int = Query(20, ge=1, le=100)):
+    _ensure_graph_loaded()
+    ids = GRAPH.mutual(user_id, other_id)
+    items = []
+    if ids:
+        with get_conn(read_only=True, user_id=user_id) as con:
+            cur = con.cursor(dictionary=True)
+            cur.execute(f"""
+                SELECT id, username FROM users
+                WHERE id IN ({",".join(["%s"] * len(ids[:limit]))})
+                ORDER BY username
+            """, tuple(ids[:limit]))
+            items = cur.fetchall()
+    return {"count": len(ids), "items": items}
+
+@app.get("/admin/cache/stats")
+def admin_cache_stats():
+    return {"public_profiles": PROFILE_CACHE.stats()}
+
+@app.post("/admin/friends/graph/refresh")
+def admin_refresh_graph():
+    # reconstruye el grafo desde la tabla friendships
+    _ensure_graph_loaded(force=True)
+    return GRAPH.stats()
 
 @app.get("/posts")
 def list_posts(limit: int = 20):
-    with get_conn() as con:
+    with get_conn(read_only=True) as con:
         cur = con.cursor(dictionary=True)
         cur.execute("""
             SELECT p.id, p.content, p.created_at, u.username
@@ -685,51 +3923,112 @@ def list_posts(limit: int = 20):
         """, (limit,))
         return {"posts": cur.fetchall()}
 
-@app.get("/posts/feed")
-def posts_feed(user_id: int = Query(...), page: int = Query(1, ge=1), page_size: int = Query(10, ge=1, le=50)):
-    offset = (page-1)*page_size
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        cur.execute("""
-            SELECT
-              p.id, p.author_id, u.username, p.content, p.habit_id, p.visibility, p.created_at,
-              (SELECT COUNT(*) FROM post_likes    pl WHERE pl.post_id = p.id) AS likes,
-              (SELECT COUNT(*) FROM post_comments pc WHERE pc.post_id = p.id) AS comments,
-              EXISTS(SELECT 1 FROM post_likes pl2 WHERE pl2.post_id = p.id AND pl2.user_id = %s) AS liked_by_me
-            FROM posts p
-            JOIN users u   ON u.id = p.author_id
-            JOIN profiles pr ON pr.user_id = u.id
-            WHERE
-                 (pr.is_public = 1 OR p.visibility = 'public')
-              OR (p.author_id = %s)
-              OR (p.visibility='friends' AND EXISTS (
-                    SELECT 1 FROM friendships f WHERE f.user_id=%s AND f.friend_id=p.author_id
-                 ))
-            ORDER BY p.created_at DESC, p.id DESC
-            LIMIT %s OFFSET %s
-        """, (user_id, user_id, user_id, page_size, offset))
-        return {"items": cur.fetchall(), "page": page, "page_size": page_size}
+_FEED_SQL = """
+    SELECT
+      p.id, p.author_id, u.username, p.content, p.habit_id, p.visibility, p.created_at,
+      COALESCE(pc.likes, 0) AS likes, COALESCE(pc.comments, 0) AS comments
+    FROM posts p
+    JOIN users u   ON u.id = p.author_id
+    LEFT JOIN post_counters pc ON pc.post_id = p.id
+    WHERE (
+         p.visibility = 'public'
+      OR p.author_id = ?
+      OR EXISTS (SELECT 1 FROM friendships f WHERE f.user_id = ? AND f.friend_id = p.author_id)
+    ) {keyset}
+    ORDER BY p.created_at DESC, p.id DESC
+    LIMIT ? OFFSET ?
+"""
+STATEMENTS.define("feed_first", _FEED_SQL.format(keyset=""))
+STATEMENTS.define("feed_after", _FEED_SQL.format(
+    keyset="AND (p.created_at < ? OR (p.created_at = ? AND p.id < ?))"))
 
-    offset = (page-1)*page_size
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        # posts públicos
-        cur.execute("""
-            SELECT p.id, p.author_id, u.username, p.content, p.habit_id, p.visibility, p.created_at,
-                   (SELECT COUNT(*) FROM post_likes pl WHERE pl.post_id=p.id) AS likes,
-                   (SELECT COUNT(*) FROM post_comments pc WHERE pc.post_id=p.id) AS comments
-            FROM posts p
-            JOIN users u ON u.id = p.author_id
-            JOIN profiles pr ON pr.user_id = u.id
-            WHERE (pr.is_public=1 AND p.visibility='public')
-               OR (p.author_id = %s)
-               OR (p.visibility='friends' AND EXISTS (
-                     SELECT 1 FROM friendships f WHERE f.user_id=%s AND f.friend_id=p.author_id
-                  ))
-            ORDER BY p.created_at DESC, p.id DESC
-            LIMIT %s OFFSET %s
-        """, (user_id, user_id, page_size, offset))
-        return {"items": cur.fetchall(), "page": page, "page_size": page_size}
+@app.get("/posts/feed")
+async def posts_feed(
+    request: Request,
+    response: Response,
+    user_id: int = Query(...),
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = None,
+    sort: Literal["recent", "ranked"] = Query("recent"),
+    include: Optional[Literal["comments_preview"]] = Query(None),
+):
+    if sort == "ranked":
+        return await _ranked_feed(request, response, user_id, page, page_size, cursor, include)
+    after = _decode_time_cursor(cursor) if cursor else None
+    offset = 0 if after else (page-1)*page_size
+
+    # ETag: página pedida + posts nuevos/borrados + amistades + versión de cada post mostrado
+    # (un comentario nuevo sube la versión del post: cubre también las vistas previas)
+    parts = ("feed", user_id, page, page_size, cursor, include)
+    keys = [("posts",), ("friends", user_id)]
+    seq = VERSIONS.seq
+    if not any(TIMELINES.needs(user_id)):
+        # timeline en memoria: los ids de la página salen sin ir a MySQL
+        ids = TIMELINES.feed_ids(user_id, after, offset, page_size)
+        if ids is not None:
+            etag = VERSIONS.etag(parts, keys + [("post", i) for i in ids[:page_size]])
+            if _if_none_match(request, etag):
+                return _not_modified(etag)
+
+    async with get_aconn() as con:
+        cur = await con.cursor(aiomysql.DictCursor)
+        await _ensure_timelines(cur, user_id)
+        ids = TIMELINES.feed_ids(user_id, after, offset, page_size)
+        if ids is not None:
+            has_more = len(ids) > page_size
+            items = await _fetch_feed_rows(con, ids[:page_size], user_id)
+            next_cursor = _time_cursor(items[-1]) if has_more and items else None
+        else:
+            # más allá de lo materializado (o timeline recién invalidado): SQL keyset
+            ks_params = _keyset("p", after)[1]
+            await STATEMENTS.run(cur, "feed_after" if after else "feed_first",
+                                 (user_id, user_id, *ks_params, page_size + 1, offset))
+            items, next_cursor = _page_out(list(await cur.fetchall()), page_size)
+            await _adecorate_posts(con, items, user_id)
+        if include:
+            _set_previews(items, await _afetch_previews(con, [r["id"] for r in items], PREVIEW_PER_POST))
+
+    # si hubo escrituras mientras se leía, no se envía ETag (podría ser más nuevo que los datos)
+    etag = VERSIONS.etag(parts, keys + [("post", r["id"]) for r in items])
+    if VERSIONS.seq == seq:
+        if _if_none_match(request, etag):
+            return _not_modified(etag)
+        _set_etag(response, etag)
+    return {"items": items, "page": page, "page_size": page_size, "next_cursor": next_cursor}
+
+async def _ranked_feed(request: Request, response: Response, user_id: int,
+                       page: int, page_size: int, cursor: Optional[str], include: Optional[str]):
+    # los ids de la página salen del índice en memoria; a MySQL solo van los PK lookups
+    after = None
+    if cursor:
+        data = _decode_cursor(cursor)
+        try:
+            after = (float(data["s"]), int(data["id"]))
+        except (KeyError, TypeError, ValueError):
+            raise HTTPException(400, "cursor inválido")
+    offset = 0 if after else (page-1)*page_size
+    if not (GRAPH.loaded and RANKED.loaded):
+        await run_in_threadpool(_ensure_graph_loaded)
+        await run_in_threadpool(_ensure_ranked_loaded)
+
+    seq = VERSIONS.seq
+    keys = RANKED.page(user_id, GRAPH.friends(user_id), after, offset, page_size)
+    ids = [k[1] for k in keys[:page_size]]
+    etag = VERSIONS.etag(("feed", user_id, "ranked", page, page_size, cursor, include),
+                         [("posts",), ("friends", user_id)] + [("post", i) for i in ids])
+    if _if_none_match(request, etag):
+        return _not_modified(etag)
+
+    async with get_aconn() as con:
+        items = await _fetch_feed_rows(con, ids, user_id)
+        if include:
+            _set_previews(items, await _afetch_previews(con, [r["id"] for r in items], PREVIEW_PER_POST))
+    last = keys[page_size - 1] if len(keys) > page_size else None
+    next_cursor = _encode_cursor({"s": last[0], "id": last[1]}) if last else None
+    if VERSIONS.seq == seq:
+        _set_etag(response, etag)
+    return {"items": items, "page": page, "page_size": page_size, "next_cursor": next_cursor}
 
 # Posts de un usuario (para perfil público o si es amigo, o si es su propio perfil)
 @app.get("/posts/by_user")
@@ -739,12 +4038,16 @@ def posts_by_user(
     page: int = Query(1, ge=1),
     page_size: int = Query(10, ge=1, le=50),
     require_owner: bool = Query(False),
+    cursor: Optional[str] = None,
+    include: Optional[Literal["comments_preview"]] = Query(None),
 ):
     if require_owner and author_id != viewer_id:
         raise HTTPException(403, "Solo puedes ver tus propias publicaciones en 'Mis Posts'.")
 
-    offset = (page - 1) * page_size
-    with get_conn() as con:
+    after = _decode_time_cursor(cursor) if cursor else None
+    offset = 0 if after else (page - 1) * page_size
+    ks_sql, ks_params = _keyset("p", after)
+    with get_conn(read_only=True, user_id=viewer_id) as con:
         cur = con.cursor(dictionary=True)
 
         # ¿existe el autor? (si no hay profile, trátalo como no público)
@@ -763,43 +4066,74 @@ def posts_by_user(
 
         if friend or viewer_id == author_id:
             vis_sql = ""  # ve todo
-            params = (author_id, page_size, offset)
         else:
             if not is_public:
-                return {"items": [], "page": page, "page_size": page_size}
+                return {"items": [], "page": page, "page_size": page_size, "next_cursor": None}
             vis_sql = "AND p.visibility='public'"
-            params = (author_id, page_size, offset)
+        params = (author_id, *ks_params, page_size + 1, offset)
 
         cur.execute(f"""
             SELECT p.id, p.author_id, u.username, p.content, p.habit_id, p.visibility, p.created_at,
-                   (SELECT COUNT(*) FROM post_likes    pl WHERE pl.post_id = p.id) AS likes,
-                   (SELECT COUNT(*) FROM post_comments pc WHERE pc.post_id = p.id) AS comments
+                   COALESCE(pc.likes, 0) AS likes, COALESCE(pc.comments, 0) AS comments
             FROM posts p
             JOIN users u ON u.id = p.author_id
-            WHERE p.author_id = %s {vis_sql}
+            LEFT JOIN post_counters pc ON pc.post_id = p.id
+            WHERE p.author_id = %s {vis_sql} {ks_sql}
             ORDER BY p.created_at DESC, p.id DESC
             LIMIT %s OFFSET %s
         """, params)
-        items = cur.fetchall()
+        items, next_cursor = _page_out(cur.fetchall(), page_size)
+        _decorate_posts(con, items)
+        if include:
+            _set_previews(items, _fetch_previews(con, [r["id"] for r in items], PREVIEW_PER_POST))
 
-    return {"items": items, "page": page, "page_size": page_size, "self": viewer_id == author_id}
+    return {"items": items, "page": page, "page_size": page_size, "self": viewer_id == author_id,
+            "next_cursor": next_cursor}
 
 
 
+# últimos comentarios de varios posts a la vez (p. ej. una página del feed)
+@app.get("/posts/comments/batch")
+def comments_batch(
+    post_ids: str = Query(..., description="ids separados por coma"),
+    per_post: int = Query(PREVIEW_PER_POST, ge=1, le=20),
+):
+    try:
+        ids = list(dict.fromkeys(int(x) for x in post_ids.split(",") if x.strip()))
+    except ValueError:
+        raise HTTPException(400, "post_ids inválido")
+    if not ids or len(ids) > PREVIEW_MAX_POSTS:
+        raise HTTPException(400, f"Entre 1 y {PREVIEW_MAX_POSTS} post_ids")
+    with get_conn(read_only=True) as con:
+        previews = _fetch_previews(con, ids, per_post)
+    return {"per_post": per_post, "items": previews}
+
+# la respuesta sigue siendo una lista; el cursor siguiente va en X-Next-Cursor
 @app.get("/posts/{post_id}/comments", response_model=List[CommentOut])
-def list_comments(post_id: int, page: int = Query(1, ge=1), page_size: int = Query(10, ge=1, le=50)):
-    offset = (page-1)*page_size
+def list_comments(
+    post_id: int,
+    response: Response,
+    page: int = Query(1, ge=1),
+    page_size: int = Query(10, ge=1, le=50),
+    cursor: Optional[str] = None,
+):
+    after = _decode_time_cursor(cursor) if cursor else None
+    offset = 0 if after else (page-1)*page_size
+    ks_sql, ks_params = _keyset("c", after, ">")
     with get_conn() as con:
         cur = con.cursor(dictionary=True)
-        cur.execute("""
+        cur.execute(f"""
             SELECT c.id, c.content, c.created_at, u.username
             FROM post_comments c
             JOIN users u ON u.id = c.user_id
-            WHERE c.post_id = %s
+            WHERE c.post_id = %s {ks_sql}
             ORDER BY c.created_at ASC, c.id ASC
             LIMIT %s OFFSET %s
-        """, (post_id, page_size, offset))
-        return cur.fetchall()
+        """, (post_id, *ks_params, page_size + 1, offset))
+        items, next_cursor = _page_out(cur.fetchall(), page_size)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return items
 
 @app.post("/posts/{post_id}/comments", status_code=201)
 def create_comment(post_id: int, p: CommentIn):
@@ -809,11 +4143,12 @@ def create_comment(post_id: int, p: CommentIn):
     if len(content) > 600:
         raise HTTPException(400, "Máximo 600 caracteres")
 
-    with get_conn() as con:
+    with get_conn(user_id=p.user_id) as con:
         cur = con.cursor()
         # validar post
-        cur.execute("SELECT 1 FROM posts WHERE id=%s", (post_id,))
-        if not cur.fetchone():
+        cur.execute("SELECT author_id, visibility FROM posts WHERE id=%s", (post_id,))
+        post = cur.fetchone()
+        if not post:
             raise HTTPException(404, "Post no existe")
 
         # insertar
@@ -821,25 +4156,51 @@ def create_comment(post_id: int, p: CommentIn):
             INSERT INTO post_comments (post_id, user_id, content)
             VALUES (%s, %s, %s)
         """, (post_id, p.user_id, content))
-        return {"ok": True, "id": cur.lastrowid}
+        comment_id = cur.lastrowid
+    COUNTERS.add(post_id, "comments", 1)
+    RANKED.bump(post_id, comments=1)
+    VERSIONS.bump(("post", post_id))
+    EVENTS.publish("comment", {"post_id": post_id, "comment_id": comment_id, "user_id": p.user_id},
+                   _post_audience(*post))
+    return {"ok": True, "id": comment_id}
 
 @app.post("/posts/{post_id}/like", response_model=LikeToggleOut)
-def toggle_like(post_id: int, user_id: int = Query(...)):
-    with get_conn() as con:
-        cur = con.cursor()
+async def toggle_like(post_id: int, user_id: int = Query(...)):
+    async with get_aconn(user_id=user_id) as con:
+        cur = await con.cursor()
         # 1) intento borrar (si había like)
-        cur.execute("DELETE FROM post_likes WHERE post_id=%s AND user_id=%s", (post_id, user_id))
+        await cur.execute("DELETE FROM post_likes WHERE post_id=%s AND user_id=%s", (post_id, user_id))
         if cur.rowcount == 0:
             # 2) si no había, inserto
-            cur.execute("INSERT INTO post_likes (post_id, user_id) VALUES (%s,%s)", (post_id, user_id))
+            await cur.execute("INSERT INTO post_likes (post_id, user_id) VALUES (%s,%s)", (post_id, user_id))
             status = "liked"
         else:
             status = "unliked"
 
-        cur = con.cursor(dictionary=True)
-        cur.execute("SELECT COUNT(*) AS like_count FROM post_likes WHERE post_id=%s", (post_id,))
-        like_count = cur.fetchone()["like_count"]
-
+        # contador denormalizado (PK) + lo que aún está en el buffer, en vez de
+        # COUNT(*) sobre post_likes; este like todavía no está en el buffer
+        own = 1 if status == "liked" else -1
+        seq = COUNTERS.seq
+        await cur.execute("""
+            SELECT p.author_id, p.visibility, pc.likes
+            FROM posts p LEFT JOIN post_counters pc ON pc.post_id = p.id
+            WHERE p.id=%s
+        """, (post_id,))
+        post = await cur.fetchone()
+        delta = COUNTERS.snapshot(post_id, seq)
+        if delta is not None:
+            like_count = ((post[2] or 0) if post else 0) + delta["likes"] + own
+        else:
+            # un flush se cruzó con la lectura: conteo exacto (incluye este like)
+            await cur.execute("SELECT COUNT(*) FROM post_likes WHERE post_id=%s", (post_id,))
+            like_count = (await cur.fetchone())[0]
+
+    COUNTERS.add(post_id, "likes", own)
+    RANKED.bump(post_id, likes=own)
+    VERSIONS.bump(("post", post_id))
+    like_count = max(0, like_count)
+    if post:
+        EVENTS.publish("like", {"post_id": post_id, "likes": like_count}, _post_audience(post[0], post[1]))
     return {"status": status, "like_count": like_count}
 
 
@@ -847,7 +4208,7 @@ def toggle_like(post_id: int, user_id: int = Query(...)):
 # por si agrego reacciones al frontend
 @app.post("/posts/{post_id}/reactions/{rx_type}", response_model=ReactionToggleOut)
 def toggle_reaction(post_id: int, rx_type: ReactionType, user_id: int = Query(...)):
-    with get_conn() as con:
+    with get_conn(user_id=user_id) as con:
         cur = con.cursor()
         # toggle por (post_id, user_id, type)
         cur.execute("DELETE FROM post_reactions WHERE post_id=%s AND user_id=%s AND type=%s",
@@ -859,21 +4220,54 @@ def toggle_reaction(post_id: int, rx_type: ReactionType, user_id: int = Query(..
         else:
             status = "removed"
 
-        # devolver conteos por tipo
+        # conteos por tipo desde el contador denormalizado + el buffer (como toggle_like)
+        field = "rx_" + rx_type.value
+        own = 1 if status == "added" else -1
+        seq = COUNTERS.seq
         cur = con.cursor(dictionary=True)
         cur.execute("""
-            SELECT type, COUNT(*) AS n
-            FROM post_reactions
-            WHERE post_id=%s
-            GROUP BY type
+            SELECT p.author_id, p.visibility, pc.rx_like, pc.rx_clap, pc.rx_star
+            FROM posts p LEFT JOIN post_counters pc ON pc.post_id = p.id
+            WHERE p.id=%s
         """, (post_id,))
-        counts = {row["type"]: int(row["n"]) for row in cur.fetchall()}
-
+        post = cur.fetchone()
+        delta = COUNTERS.snapshot(post_id, seq)
+        if delta is not None:
+            totals = {k: (post or {}).get(k) or 0 for k in ("rx_like", "rx_clap", "rx_star")}
+            for k in totals:
+                totals[k] += delta[k]
+            totals[field] += own
+        else:
+            cur.execute("SELECT type, COUNT(*) AS n FROM post_reactions WHERE post_id=%s GROUP BY type",
+                        (post_id,))
+            totals = {"rx_" + r["type"]: r["n"] for r in cur.fetchall()}
+
+    COUNTERS.add(post_id, field, own)
+    VERSIONS.bump(("post", post_id))
+    counts = {}
+    for t in ReactionType:
+        n = totals.get("rx_" + t.value, 0)
+        if n > 0:
+            counts[t.value] = n
+    if post:
+        EVENTS.publish("reaction", {"post_id": post_id, "counts": counts},
+                       _post_audience(post["author_id"], post["visibility"]))
     return {"status": status, "counts": counts}
 
 
+@app.post("/admin/counters/reconcile")
+def admin_reconcile_counters():
+    COUNTERS.flush()
+    return reconcile_counters()
+
+
 @app.get("/friends/suggested")
-def friends_suggested(user_id: int = Query(...), limit: int = 20, window: int = 30):
+def friends_suggested(
+    user_id: int = Query(...),
+    limit: int = 20,
+    window: int = 30,
+    similarity: Literal["auto", "exact", "approx"] = Query("auto"),
+):
     if limit <= 0 or limit > 100:
         raise HTTPException(400, "limit inválido (1..100)")
     if window not in (7, 30):
@@ -888,67 +4282,28 @@ def friends_suggested(user_id: int = Query(...), limit: int = 20, window: int =
     n_trend  = max(1, round(limit * 0.20))
     n_fill   = max(0, limit - (n_foaf + n_sim + n_trend))
 
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
+    _ensure_graph_loaded()
+    _ensure_public_loaded()
 
-        # 0) conjunto de amigos actuales + yo (para excluir)
-        cur.execute("SELECT friend_id FROM friendships WHERE user_id=%s", (user_id,))
-        exclude_ids = {user_id} | {row["friend_id"] for row in cur.fetchall()}
+    # 0) conjunto de amigos actuales + yo (para excluir)
+    exclude_ids = {user_id} | set(GRAPH.friends(user_id))
 
-        # 1) FOAF (amigos de mis amigos) con conteo de mutuos
-        #    - públicos
-        #    - no en exclude
-        cur.execute("""
-            SELECT f2.friend_id AS candidate, COUNT(*) AS mutuals
-            FROM friendships f1
-            JOIN friendships f2 ON f1.friend_id = f2.user_id
-            JOIN profiles   p   ON p.user_id = f2.friend_id AND p.is_public=1
-            WHERE f1.user_id = %s
-              AND f2.friend_id <> %s
-              AND f2.friend_id NOT IN (
-                    SELECT friend_id FROM friendships WHERE user_id=%s
-              )
-            GROUP BY candidate
-            ORDER BY mutuals DESC, candidate ASC
-            LIMIT %s
-        """, (user_id, user_id, user_id, n_foaf))
-        foaf = cur.fetchall()
+    # 1) FOAF (amigos de mis amigos) con conteo de mutuos, solo públicos, desde el grafo
+    foaf = [
+        {"candidate": c, "mutuals": n}
+        for c, n in GRAPH.foaf(user_id, n_foaf, accept=lambda c: PUBLIC.get(c) is not None)
+    ]
+
+    # 2) Similares por hábitos (Jaccard por nombre normalizado, exacto o MinHash)
+    _ensure_similar_loaded()
+    sim = SIMILAR.similar(
+        user_id, n_sim, similarity,
+        accept=lambda c: c not in exclude_ids and PUBLIC.get(c) is not None,
+    )
+
+    with get_conn(read_only=True, user_id=user_id) as con:
+        cur = con.cursor(dictionary=True)
 
-        # 2) Similares por hábitos (Jaccard aprox usando nombres de hábitos)
-        #    candidatos: comparten al menos un nombre de hábito conmigo, públicos
-        cur.execute("""
-            WITH my_habits AS (
-                SELECT DISTINCT name FROM habits WHERE user_id=%s
-            ),
-            cand AS (
-                SELECT DISTINCT h.user_id AS candidate
-                FROM habits h
-                JOIN my_habits mh ON mh.name = h.name
-                JOIN profiles p   ON p.user_id = h.user_id AND p.is_public=1
-                WHERE h.user_id <> %s
-            ),
-            A AS (SELECT COUNT(*) AS ca FROM my_habits),
-            I AS (
-                SELECT h.user_id AS candidate, COUNT(*) AS inters
-                FROM habits h
-                JOIN my_habits mh ON mh.name = h.name
-                WHERE h.user_id IN (SELECT candidate FROM cand)
-                GROUP BY h.user_id
-            ),
-            B AS (
-                SELECT h.user_id AS candidate, COUNT(DISTINCT name) AS cb
-                FROM habits h
-                WHERE h.user_id IN (SELECT candidate FROM cand)
-                GROUP BY h.user_id
-            )
-            SELECT i.candidate,
-                   i.inters / (a.ca + b.cb - i.inters) AS jaccard
-            FROM I i CROSS JOIN A a
-            JOIN B b ON b.candidate = i.candidate
-            ORDER BY jaccard DESC, candidate ASC
-            LIMIT %s
-        """, (user_id, user_id, n_sim))
-        sim = cur.fetchall()
 
         # 3) Trending: score = (amigos_count * 2) + done_days_window
         #    - públicos, excluidos fuera
@@ -959,11 +4314,10 @@ def friends_suggested(user_id: int = Query(...), limit: int = 20, window: int =
               GROUP BY user_id
             ),
             done30 AS (
-              SELECT h.user_id, COALESCE(SUM(CASE WHEN l.value=1 THEN 1 ELSE 0 END),0) AS done_days
-              FROM habits h
-              LEFT JOIN logs l ON l.habit_id = h.id
-                               AND l.day BETWEEN %s AND %s
-              GROUP BY h.user_id
+              SELECT user_id, SUM(done_count) AS done_days
+              FROM user_daily_done
+              WHERE day BETWEEN %s AND %s
+              GROUP BY user_id
             )
             SELECT u.id AS candidate,
                    COALESCE(fc.fc,0)*2 + COALESCE(d.done_days,0) AS score
@@ -1035,37 +4389,236 @@ def friends_suggested(user_id: int = Query(...), limit: int = 20, window: int =
     }
 
 @app.get("/stats/weekly")
-def stats_weekly(user_id: int = Query(...)):
+async def stats_weekly(
+    user_id: int = Query(...),
+    window: int = Query(7, ge=1, le=STATS_MAX_WINDOW),
+):
     today = datetime.date.today()
-    start = today - datetime.timedelta(days=6)
 
-    with get_conn() as con:
-        cur = con.cursor(dictionary=True)
-        cur.execute("SELECT id, name FROM habits WHERE user_id=%s", (user_id,))
-        habits = cur.fetchall()
+    # una sola consulta la primera vez; luego se responde desde los bitmaps
+    ub = STATS.get(user_id)
+    if ub is None:
+        token = STATS.begin_load(user_id)
+        start = today - datetime.timedelta(days=STATS_MAX_WINDOW - 1)
+        try:
+            async with get_aconn() as con:
+                cur = await con.cursor(aiomysql.DictCursor)
+                await cur.execute("""
+                    SELECT h.id, h.name, l.day
+                    FROM habits h
+                    LEFT JOIN logs l ON l.habit_id = h.id AND l.value = 1
+                                    AND l.day BETWEEN %s AND %s
+                    WHERE h.user_id = %s
+                    ORDER BY h.id
+                """, (start, today, user_id))
+                rows = await cur.fetchall()
+        except BaseException:
+            STATS.end_load(user_id)
+            raise
+        ub = STATS.load_user(user_id, rows, token)
+
+    items = STATS.window(ub, window, today)
+    if items:
+        async with get_aconn(read_only=True, user_id=user_id) as con:
+            cur = await con.cursor()
+            await cur.execute(f"""
+                SELECT habit_id, last_done, current_len, longest_len FROM habit_streaks
+                WHERE habit_id IN ({",".join(["%s"] * len(items))})
+            """, tuple(it["habit_id"] for it in items))
+            streaks = {r[0]: _streak_view(r[1], r[2], r[3], today) for r in await cur.fetchall()}
+        for it in items:
+            it["streak"] = streaks.get(it["habit_id"], _streak_view(None, 0, 0, today))
+    return {"today": today.isoformat(), "window": window, "items": items}
+
+
+@app.get("/stats/heatmap")
+async def stats_heatmap(
+    user_id: int = Query(...),
+    year: Optional[int] = Query(None, ge=1970, le=9999),
+    per_habit: bool = Query(False, description="Incluye la serie diaria de cada hábito"),
+):
+    year = year or datetime.date.today().year
+    yb = HEATMAP.get(user_id, year)
+    if yb is None:
+        token = HEATMAP.begin_load(user_id)
+        try:
+            async with get_aconn() as con:
+                cur = await con.cursor()
+                await cur.execute("""
+                    SELECT h.id, h.name, l.day
+                    FROM habits h
+                    LEFT JOIN logs l ON l.habit_id = h.id AND l.value = 1
+                                    AND l.day BETWEEN %s AND %s
+                    WHERE h.user_id = %s
+                    ORDER BY h.id
+                """, (datetime.date(year, 1, 1), datetime.date(year, 12, 31), user_id))
+                rows = await cur.fetchall()
+        except BaseException:
+            HEATMAP.end_load(user_id)
+            raise
+        yb = HEATMAP.load(user_id, year, rows, token)
+    return {
+        "year": year,
+        "start": datetime.date(year, 1, 1).isoformat(),
+        **HEATMAP.aggregate(yb, year, per_habit),
+    }
 
-        items = []
-        for h in habits:
-            cur.execute(
-                "SELECT day, value FROM logs WHERE habit_id=%s AND day BETWEEN %s AND %s",
-                (h["id"], start, today)
-            )
-            vals = cur.fetchall()
-            day_map = {row["day"]: int(row["value"]) for row in vals}
-
-            done = sum(day_map.get(start + datetime.timedelta(days=i), 0) for i in range(7))
-            today_done = bool(day_map.get(today, 0))
-
-            items.append({
-                "habit_id": h["id"],
-                "habit_name": h["name"],
-                "done": done,
-                "total_days": 7,
-                "today_done": today_done
-            })
-            
-
-    return {"today": today.isoformat(), "items": items}
+
+@app.get("/streaks")
+async def streaks(user_id: int = Query(...)):
+    today = datetime.date.today()
+    async with get_aconn(read_only=True, user_id=user_id) as con:
+        cur = await con.cursor(aiomysql.DictCursor)
+        await cur.execute("""
+            SELECT h.id AS habit_id, h.name, s.last_done,
+                   COALESCE(s.current_len, 0) AS current_len, COALESCE(s.longest_len, 0) AS longest_len
+            FROM habits h
+            LEFT JOIN habit_streaks s ON s.habit_id = h.id
+            WHERE h.user_id = %s
+            ORDER BY h.id
+        """, (user_id,))
+        rows = await cur.fetchall()
+    return {
+        "today": today.isoformat(),
+        "items": [
+            {"habit_id": r["habit_id"], "habit_name": r["name"],
+             **_streak_view(r["last_done"], r["current_len"], r["longest_len"], today)}
+            for r in rows
+        ],
+    }
+
+
+@app.post("/admin/streaks/rebuild")
+async def admin_rebuild_streaks():
+    # reconstrucción completa desde logs, por lotes de hábitos (una transacción por lote)
+    last_id, total = 0, 0
+    while True:
+        async with get_aconn() as con:
+            cur = await con.cursor()
+            await cur.execute("SELECT id FROM habits WHERE id > %s ORDER BY id LIMIT %s",
+                              (last_id, STREAK_REBUILD_BATCH))
+            ids = [r[0] for r in await cur.fetchall()]
+            if not ids:
+                break
+            await _arebuild_streaks(cur, ids)
+        last_id = ids[-1]
+        total += len(ids)
+    PROFILE_CACHE.invalidate_all()
+    return {"habits": total}
+
+
+@app.post("/admin/rollup/rebuild")
+async def admin_rebuild_rollup():
+    # backfill / reparación de user_daily_done desde logs, por lotes de usuarios
+    last_id, total = 0, 0
+    while True:
+        async with get_aconn() as con:
+            cur = await con.cursor()
+            await cur.execute("SELECT id FROM users WHERE id > %s ORDER BY id LIMIT %s",
+                              (last_id, ROLLUP_REBUILD_BATCH))
+            ids = [r[0] for r in await cur.fetchall()]
+            if not ids:
+                break
+            await _arebuild_daily(cur, ids)
+        last_id = ids[-1]
+        total += len(ids)
+    PROFILE_CACHE.invalidate_all()
+    return {"users": total}
+
+# --- Exportación (streaming) ---
+# Cursor del lado del servidor (SSDictCursor): las filas se leen de a
+# EXPORT_FETCH y se van escribiendo en trozos de ~EXPORT_CHUNK bytes, así la
+# memoria no depende del tamaño del historial.
+EXPORT_FETCH = 500
+EXPORT_CHUNK = 64 * 1024
+EXPORT_COLUMNS = ["type", "id", "habit_id", "name", "day", "value", "content", "visibility", "created_at"]
+EXPORT_QUERIES = (
+    ("habit", """
+        SELECT id, name FROM habits WHERE user_id = %s ORDER BY id
+    """),
+    ("log", """
+        SELECT l.id, l.habit_id, l.day, l.value
+        FROM logs l JOIN habits h ON h.id = l.habit_id
+        WHERE h.user_id = %s
+        ORDER BY l.habit_id, l.day
+    """),
+    ("post", """
+        SELECT id, habit_id, content, visibility, created_at
+        FROM posts WHERE author_id = %s ORDER BY created_at, id
+    """),
+)
+
+
+def _export_value(v):
+    if isinstance(v, (datetime.date, datetime.datetime)):
+        return v.isoformat()
+    return v
+
+
+async def _export_rows(user_id: int):
+    async with get_aconn(read_only=True, user_id=user_id) as con:
+        cur = await con.cursor(aiomysql.SSDictCursor)
+        for kind, sql in EXPORT_QUERIES:
+            await cur.execute(sql, (user_id,))
+            while True:
+                rows = await cur.fetchmany(EXPORT_FETCH)
+                if not rows:
+                    break
+                for r in rows:
+                    yield kind, {k: _export_value(v) for k, v in r.items()}
+        await cur.close()
+
+
+async def _export_stream(user_id: int, fmt: str, compress: bool):
+    gz = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None   # 31 = formato gzip
+    buf = io.StringIO()
+    writer = None
+    if fmt == "csv":
+        writer = csv.DictWriter(buf, fieldnames=EXPORT_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+
+    def take() -> bytes:
+        data = buf.getvalue().encode()
+        buf.seek(0)
+        buf.truncate()
+        return gz.compress(data) if gz else data
+
+    async for kind, row in _export_rows(user_id):
+        if writer:
+            writer.writerow({"type": kind, **row})
+        else:
+            buf.write(json.dumps({"type": kind, **row}, ensure_ascii=False) + "\n")
+        if buf.tell() >= EXPORT_CHUNK:
+            out = take()
+            if out:
+                yield out
+    out = take()
+    if gz:
+        out += gz.flush()
+    if out:
+        yield out
+
+
+@app.get("/export")
+async def export_user(
+    user_id: int = Query(...),
+    format: Literal["ndjson", "csv"] = Query("ndjson"),
+    gzip: bool = Query(False, description="Comprimir la descarga (.gz)"),
+):
+    # validar antes de empezar a transmitir: luego ya no se puede cambiar el status
+    async with get_aconn(read_only=True, user_id=user_id) as con:
+        cur = await con.cursor()
+        await cur.execute("SELECT 1 FROM users WHERE id=%s", (user_id,))
+        if not await cur.fetchone():
+            raise HTTPException(404, "Usuario no encontrado")
+
+    filename = f"export_{user_id}.{format}" + (".gz" if gzip else "")
+    media = "application/gzip" if gzip else ("text/csv" if format == "csv" else "application/x-ndjson")
+    return StreamingResponse(
+        _export_stream(user_id, format, gzip),
+        media_type=media,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
 # --- Servir frontend estático ---
 app.mount("/", StaticFiles(directory=FRONTEND_DIR, html=True), name="static")
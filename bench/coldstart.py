@@ -0,0 +1,120 @@
+"""Tiempo de arranque en frío de la API, con y sin precalentamiento.
+
+Lanza `uvicorn app:app` desde backend/ (con la base ya levantada; la app corre con un
+solo worker) con DB_WARMUP=1 y DB_WARMUP=0, y mide desde el spawn:
+  - first_health_s:   primer 200 de /healthz (el proceso escucha),
+  - first_ready_s:    primer 200 de /readyz (con warmup: pools e índices listos),
+  - first_request_ms: suma de las latencias de los primeros requests reales ya listo
+                      (/public/rank, /posts/feed, /habits): el costo que el warmup adelanta,
+  - shutdown_s:       desde SIGTERM hasta que el proceso termina (drenaje).
+Repite --runs veces por modo y guarda el JSON en bench/results/.
+
+    MYSQL_PORT=3406 MYSQL_PASSWORD=habitos_pass python bench/coldstart.py --runs 5
+"""
+import os, sys, json, time, signal, argparse, datetime, subprocess, statistics
+import urllib.request, urllib.error
+
+from run import git_rev
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def probe(url: str, timeout: float = 1):
+    try:
+        with urllib.request.urlopen(url, timeout=timeout) as r:
+            return r.status, json.loads(r.read() or b"null")
+    except urllib.error.HTTPError as e:
+        return e.code, None
+    except (OSError, ValueError):
+        return 0, None
+
+
+FIRST_REQUESTS = ("/public/rank", "/posts/feed?user_id={u}", "/habits?user_id={u}")
+
+
+def one_run(warmup: bool, port: int, timeout: float, user_id: int) -> dict:
+    base = f"http://127.0.0.1:{port}"
+    cmd = [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+           "--timeout-graceful-shutdown", "5"]
+    env = {**os.environ, "DB_WARMUP": "1" if warmup else "0"}
+    t0 = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=os.path.join(ROOT, "backend"), env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    out = {"warmup": warmup, "first_health_s": None, "first_ready_s": None,
+           "first_request_ms": None, "requests_ms": {}, "shutdown_s": None, "startup": None}
+    try:
+        deadline = t0 + timeout
+        while time.perf_counter() < deadline and proc.poll() is None:
+            if out["first_health_s"] is None:
+                if probe(base + "/healthz")[0] == 200:
+                    out["first_health_s"] = round(time.perf_counter() - t0, 3)
+                else:
+                    time.sleep(0.01)
+                    continue
+            status, body = probe(base + "/readyz")
+            if status != 200:
+                time.sleep(0.01)
+                continue
+            out["first_ready_s"] = round(time.perf_counter() - t0, 3)
+            out["startup"] = body["startup"]
+            for path in FIRST_REQUESTS:
+                path = path.format(u=user_id)
+                t1 = time.perf_counter()
+                probe(base + path, timeout=30)
+                out["requests_ms"][path] = round((time.perf_counter() - t1) * 1000, 2)
+            out["first_request_ms"] = round(sum(out["requests_ms"].values()), 2)
+            break
+    finally:
+        t2 = time.perf_counter()
+        proc.send_signal(signal.SIGTERM)
+        try:
+            proc.wait(30)
+            out["shutdown_s"] = round(time.perf_counter() - t2, 3)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.wait()
+    return out
+
+
+def summary(runs, key):
+    vals = sorted(r[key] for r in runs if r[key] is not None)
+    if not vals:
+        return None
+    return {"min": vals[0], "p50": round(statistics.median(vals), 3), "max": vals[-1]}
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--runs", type=int, default=3)
+    ap.add_argument("--user-id", type=int, default=1, help="usuario para /posts/feed y /habits")
+    ap.add_argument("--port", type=int, default=8099)
+    ap.add_argument("--timeout", type=float, default=60, help="segundos máximos hasta estar listo")
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results"))
+    args = ap.parse_args()
+
+    keys = ("first_health_s", "first_ready_s", "first_request_ms", "shutdown_s")
+    results = {}
+    for mode, warmup in (("warmup", True), ("cold", False)):
+        runs = [one_run(warmup, args.port, args.timeout, args.user_id) for _ in range(args.runs)]
+        results[mode] = {"runs": runs, **{k: summary(runs, k) for k in keys}}
+    result = {
+        "meta": {"git": git_rev(), "at": datetime.datetime.now().isoformat(timespec="seconds"),
+                 "runs": args.runs, "mysql_port": os.getenv("MYSQL_PORT")},
+        "coldstart": results,
+    }
+
+    os.makedirs(args.out, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(args.out, f"coldstart-{stamp}-{result['meta']['git'] or 'nogit'}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+
+    print(f"{'modo':>7} {'health':>8} {'ready':>8} {'1os req':>8} {'apagado':>8}")
+    for mode, r in results.items():
+        cols = [r[k]["p50"] if r[k] else "-" for k in keys]
+        print(f"{mode:>7} " + " ".join(f"{c:>8}" for c in cols))
+    print(f"(medianas; segundos salvo 1os req = suma en ms de {len(FIRST_REQUESTS)} requests) -> {path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,247 @@
+"""Generador de datos sintéticos para pruebas de carga.
+
+Crea una población reproducible (misma --seed => mismos datos) sobre la base
+configurada en backend/.env o en las variables MYSQL_*:
+
+  - usuarios con perfil (una fracción pública)
+  - grafo de amistades de ley de potencias (Barabási–Albert, m aristas por nodo)
+  - hábitos con nombres de popularidad Zipf y años de logs diarios
+  - posts con likes / comentarios / reacciones muy sesgados (Pareto)
+
+Al final escribe un manifiesto JSON que usa bench/run.py.
+
+    python bench/generate.py --users 20000 --days 730 --out bench/dataset.json
+"""
+import os, sys, json, random, argparse, datetime, time
+
+import mysql.connector
+from dotenv import load_dotenv
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+load_dotenv(os.path.join(ROOT, "backend", ".env"))
+
+HABIT_NAMES = [
+    "Leer 30 min", "Meditar", "Ir al gimnasio", "Correr 5km", "Beber 2L de agua",
+    "Dormir 8 horas", "Estudiar inglés", "Caminar 10.000 pasos", "Escribir diario",
+    "No azúcar", "Yoga", "Programar 1 hora", "Estirar", "Cocinar en casa",
+    "Leer artículos de ciberseguridad", "Meditar 10 min", "Practicar guitarra",
+    "Ordenar el cuarto", "Sin redes sociales", "Aprender algo nuevo", "Nadar",
+    "Bicicleta", "Tomar vitaminas", "Llamar a la familia", "Ahorrar", "Dibujar",
+    "Flexiones", "Abdominales", "Ducha fría", "Levantarse temprano", "Planificar el día",
+    "Repasar apuntes", "Ajedrez", "Fruta al desayuno", "Cero alcohol", "Pasear al perro",
+]
+BIOS = ["Fan del gimnasio", "Me gusta leer", "Aprendiendo a meditar", "Corredor amateur", None]
+WORDS = "hoy logré mi meta semana racha hábito nuevo feliz cansado pero seguimos vamos equipo".split()
+
+BATCH = 5000
+
+
+def connect():
+    return mysql.connector.connect(
+        host=os.getenv("MYSQL_HOST", "localhost"),
+        port=int(os.getenv("MYSQL_PORT", "3306")),
+        database=os.getenv("MYSQL_DB", "habitos_db"),
+        user=os.getenv("MYSQL_USER", "habitos_user"),
+        password=os.getenv("MYSQL_PASSWORD", ""),
+        charset="utf8mb4",
+        autocommit=False,
+    )
+
+
+def insert_many(con, sql, rows):
+    # executemany de mysql.connector reescribe INSERT ... VALUES en multi-fila
+    cur = con.cursor()
+    for i in range(0, len(rows), BATCH):
+        cur.executemany(sql, rows[i:i + BATCH])
+    con.commit()
+    cur.close()
+
+
+def zipf_choice(rng, n):
+    # índice 0..n-1 con probabilidad ~ 1/(k+1) (log-uniforme)
+    return min(n - 1, int(n ** rng.random()) - 1)
+
+
+def pareto_int(rng, alpha, scale, cap):
+    return min(cap, int(scale * (rng.paretovariate(alpha) - 1)))
+
+
+def ba_edges(rng, n, m):
+    # preferential attachment: cada nodo nuevo se une a m nodos elegidos con
+    # probabilidad proporcional a su grado -> grados con cola de ley de potencias
+    edges = set()
+    seeds = list(range(min(n, m + 1)))
+    for a in seeds:
+        for b in seeds:
+            if a < b:
+                edges.add((a, b))
+    repeated = [v for e in edges for v in e]
+    for v in range(len(seeds), n):
+        targets = set()
+        while len(targets) < min(m, v):
+            targets.add(rng.choice(repeated) if repeated else rng.randrange(v))
+        for t in targets:
+            edges.add((t, v))
+            repeated += (t, v)
+    return edges
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--users", type=int, default=5000)
+    ap.add_argument("--public-ratio", type=float, default=0.7)
+    ap.add_argument("--friends-m", type=int, default=4, help="aristas por nodo nuevo (grado medio ~2m)")
+    ap.add_argument("--habits", type=float, default=3.0, help="hábitos promedio por usuario")
+    ap.add_argument("--days", type=int, default=365, help="días de historial de logs")
+    ap.add_argument("--posts", type=float, default=4.0, help="posts promedio por usuario")
+    ap.add_argument("--prefix", default="bench")
+    ap.add_argument("--password", default="bench123")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "dataset.json"))
+    ap.add_argument("--sample", type=int, default=2000, help="usuarios que se guardan en el manifiesto")
+    args = ap.parse_args()
+
+    rng = random.Random(args.seed)
+    today = datetime.date.today()
+    t0 = time.perf_counter()
+    con = connect()
+    cur = con.cursor()
+
+    cur.execute("SELECT COUNT(*) FROM users WHERE username LIKE %s", (args.prefix + "\\_%",))
+    if cur.fetchone()[0]:
+        sys.exit(f"ya hay usuarios con prefijo '{args.prefix}_'; usa otro --prefix o limpia la base")
+
+    # 1) usuarios + perfiles
+    names = [f"{args.prefix}_{i:07d}" for i in range(args.users)]
+    insert_many(con, "INSERT INTO users (email, username, password) VALUES (%s,%s,%s)",
+                [(f"{u}@example.com", u, args.password) for u in names])
+    cur.execute("SELECT id, username FROM users WHERE username LIKE %s ORDER BY username", (args.prefix + "\\_%",))
+    uid = {u: i for i, u in cur.fetchall()}
+    ids = [uid[u] for u in names]
+    public = [rng.random() < args.public_ratio for _ in ids]
+    insert_many(con, """
+        INSERT INTO profiles (user_id, first_name, last_name, gender, birth_date, is_public, bio)
+        VALUES (%s,%s,%s,%s,%s,%s,%s)
+    """, [
+        (u, "Nombre", f"Apellido{i}", rng.choice(["F", "M", "Otro"]),
+         datetime.date(rng.randint(1970, 2010), rng.randint(1, 12), rng.randint(1, 28)),
+         int(public[i]), rng.choice(BIOS))
+        for i, u in enumerate(ids)
+    ])
+    print(f"usuarios: {len(ids)}  ({sum(public)} públicos)")
+
+    # 2) amistades (dos filas por amistad, como friends_add)
+    edges = ba_edges(rng, len(ids), args.friends_m)
+    insert_many(con, "INSERT IGNORE INTO friendships (user_id, friend_id) VALUES (%s,%s)",
+                [(ids[a], ids[b]) for a, b in edges] + [(ids[b], ids[a]) for a, b in edges])
+    print(f"amistades: {len(edges)}")
+
+    # 3) hábitos
+    habit_rows = []
+    for u in ids:
+        k = max(1, min(12, int(rng.expovariate(1 / args.habits)) + 1))
+        chosen = {HABIT_NAMES[zipf_choice(rng, len(HABIT_NAMES))] for _ in range(k)}
+        habit_rows += [(u, n) for n in sorted(chosen)]
+    insert_many(con, "INSERT INTO habits (user_id, name) VALUES (%s,%s)", habit_rows)
+    cur.execute("SELECT id, user_id FROM habits WHERE user_id BETWEEN %s AND %s ORDER BY id", (min(ids), max(ids)))
+    habits = cur.fetchall()
+    habits_by_user = {}
+    for hid, u in habits:
+        habits_by_user.setdefault(u, []).append(hid)
+    print(f"hábitos: {len(habits)}")
+
+    # 4) logs diarios: cada hábito empieza un día al azar y se cumple con su propia adherencia
+    n_logs = 0
+    cur_logs = []
+    for hid, _ in habits:
+        p = rng.betavariate(2, 2)
+        start = rng.randrange(args.days)
+        for back in range(start, -1, -1):
+            r = rng.random()
+            if r < p:
+                cur_logs.append((hid, today - datetime.timedelta(days=back), 1))
+            elif r < p + 0.05:
+                cur_logs.append((hid, today - datetime.timedelta(days=back), 0))
+        if len(cur_logs) >= 50 * BATCH:
+            insert_many(con, "INSERT INTO logs (habit_id, day, value) VALUES (%s,%s,%s)", cur_logs)
+            n_logs += len(cur_logs)
+            cur_logs = []
+    insert_many(con, "INSERT INTO logs (habit_id, day, value) VALUES (%s,%s,%s)", cur_logs)
+    n_logs += len(cur_logs)
+    print(f"logs: {n_logs}")
+
+    # 5) posts (cantidad por autor con cola pesada)
+    post_rows = []
+    now = datetime.datetime.now().replace(microsecond=0)
+    for u in ids:
+        for _ in range(pareto_int(rng, 1.5, args.posts / 2, 500)):
+            hs = habits_by_user.get(u)
+            post_rows.append((
+                u, rng.choice(hs) if hs and rng.random() < 0.5 else None,
+                " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 20))),
+                "public" if rng.random() < 0.85 else "friends",
+                now - datetime.timedelta(seconds=rng.randrange(args.days * 86400)),
+            ))
+    post_rows.sort(key=lambda r: r[4])
+    insert_many(con, """
+        INSERT INTO posts (author_id, habit_id, content, visibility, created_at)
+        VALUES (%s,%s,%s,%s,%s)
+    """, post_rows)
+    cur.execute("SELECT id FROM posts WHERE author_id BETWEEN %s AND %s ORDER BY id", (min(ids), max(ids)))
+    post_ids = [r[0] for r in cur.fetchall()]
+    print(f"posts: {len(post_ids)}")
+
+    # 6) likes / comentarios / reacciones: popularidad por post ~ Pareto
+    likes, comments, reactions, counters = [], [], [], []
+    for pid in post_ids:
+        n_likes = pareto_int(rng, 1.2, 2, len(ids) - 1)
+        likers = rng.sample(ids, n_likes) if n_likes else []
+        likes += [(pid, u) for u in likers]
+        n_comments = pareto_int(rng, 1.6, 1, 200)
+        comments += [
+            (pid, rng.choice(ids), " ".join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))))
+            for _ in range(n_comments)
+        ]
+        rx = {"like": 0, "clap": 0, "star": 0}
+        for u in likers[: max(0, n_likes // 3)]:
+            t = rng.choice(("like", "clap", "star"))
+            rx[t] += 1
+            reactions.append((pid, u, t))
+        counters.append((pid, n_likes, n_comments, rx["like"], rx["clap"], rx["star"]))
+    insert_many(con, "INSERT INTO post_likes (post_id, user_id) VALUES (%s,%s)", likes)
+    insert_many(con, "INSERT INTO post_comments (post_id, user_id, content) VALUES (%s,%s,%s)", comments)
+    insert_many(con, "INSERT INTO post_reactions (post_id, user_id, type) VALUES (%s,%s,%s)", reactions)
+    insert_many(con, """
+        INSERT INTO post_counters (post_id, likes, comments, rx_like, rx_clap, rx_star)
+        VALUES (%s,%s,%s,%s,%s,%s)
+        ON DUPLICATE KEY UPDATE likes=VALUES(likes), comments=VALUES(comments),
+          rx_like=VALUES(rx_like), rx_clap=VALUES(rx_clap), rx_star=VALUES(rx_star)
+    """, counters)
+    print(f"likes: {len(likes)}  comentarios: {len(comments)}  reacciones: {len(reactions)}")
+    con.close()
+
+    sample = rng.sample(range(len(ids)), min(args.sample, len(ids)))
+    manifest = {
+        "generated_at": datetime.datetime.now().isoformat(timespec="seconds"),
+        "seed": args.seed,
+        "params": vars(args),
+        "counts": {
+            "users": len(ids), "public": sum(public), "friendships": len(edges),
+            "habits": len(habits), "logs": n_logs, "posts": len(post_ids),
+            "likes": len(likes), "comments": len(comments), "reactions": len(reactions),
+        },
+        "password": args.password,
+        "users": [
+            {"id": ids[i], "username": names[i], "public": public[i], "habits": habits_by_user.get(ids[i], [])}
+            for i in sample
+        ],
+        "posts": rng.sample(post_ids, min(len(post_ids), 5000)),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(args.out)), exist_ok=True)
+    with open(args.out, "w") as f:
+        json.dump(manifest, f, default=str)
+    print(f"listo en {time.perf_counter() - t0:.1f}s -> {args.out}")
+
+
+if __name__ == "__main__":
+    main()
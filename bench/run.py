@@ -0,0 +1,337 @@
+"""Benchmark de carga de la API.
+
+Recorre todos los endpoints de backend/app.py con una mezcla ponderada de
+lecturas y escrituras desde N hilos concurrentes durante --duration segundos,
+usando los usuarios/posts del manifiesto de bench/generate.py. Reporta por
+endpoint p50/p95/p99, throughput, errores y consultas SQL por request (leídas
+de /metrics antes y después) y guarda todo en JSON para comparar commits.
+
+    python bench/run.py --base http://localhost:8000 --duration 60 --concurrency 32
+    python bench/run.py --baseline bench/results/<anterior>.json
+    python bench/run.py --only login,signup,public_user_detail --weights login=20,signup=10 --concurrency 64
+"""
+import os, sys, json, time, random, argparse, datetime, subprocess, threading, string
+import urllib.request, urllib.error
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Client:
+    def __init__(self, base: str, timeout: float):
+        self.base = base.rstrip("/")
+        self.timeout = timeout
+
+    def call(self, method: str, path: str, body=None, raw: bytes = None, ctype="application/json"):
+        data = raw if raw is not None else (json.dumps(body).encode() if body is not None else None)
+        req = urllib.request.Request(self.base + path, data=data, method=method)
+        if data is not None:
+            req.add_header("Content-Type", ctype)
+        try:
+            with urllib.request.urlopen(req, timeout=self.timeout) as r:
+                payload = r.read()          # se consume todo (p. ej. /export)
+                return r.status, payload
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class Scenario:
+    """Un endpoint: nombre, plantilla de ruta (como en /metrics), peso y acción."""
+
+    def __init__(self, name, method, route, weight, action):
+        self.name, self.method, self.route, self.weight, self.action = name, method, route, weight, action
+
+
+def build_scenarios(m, lock):
+    users = m["users"]
+    public = [u for u in users if u["public"]] or users
+    posts = m["posts"]
+    pwd = m["password"]
+    created_posts, created_habits, created_friends = [], [], []
+    q = lambda: "".join(random.choice(string.ascii_lowercase + "_0") for _ in range(random.randint(1, 4)))
+
+    def U():
+        return random.choice(users)
+
+    def with_habit():
+        for _ in range(10):
+            u = U()
+            if u["habits"]:
+                return u, random.choice(u["habits"])
+        return None, None
+
+    # --- acciones: cada una hace su request y devuelve (status, body) ---
+    def mark_today(c):
+        u, h = with_habit()
+        return c.call("POST", "/logs/mark_today", {"user_id": u["id"], "habit_id": h, "value": random.randint(0, 1)})
+
+    def logs_bulk(c):
+        u, h = with_habit()
+        today = datetime.date.today()
+        lines = "\n".join(json.dumps({"habit_id": h, "day": (today - datetime.timedelta(days=d)).isoformat(),
+                                      "value": random.randint(0, 1)}) for d in range(1, 51))
+        return c.call("POST", f"/logs/bulk?user_id={u['id']}", raw=lines.encode(), ctype="application/x-ndjson")
+
+    def create_post(c):
+        u = U()
+        st, body = c.call("POST", "/posts", {"author_id": u["id"], "content": "bench " + q(),
+                                             "visibility": random.choice(["public", "public", "friends"])})
+        if st == 200:
+            with lock:
+                created_posts.append((json.loads(body).get("id"), u["id"]))
+        return st, body
+
+    def delete_post(c):
+        with lock:
+            item = created_posts.pop() if created_posts else None
+        if item is None:
+            return create_post(c)
+        return c.call("DELETE", f"/posts/{item[0]}?user_id={item[1]}")
+
+    def add_habit(c):
+        u = U()
+        st, body = c.call("POST", "/habits", {"user_id": u["id"], "name": "Bench " + q()})
+        if st == 200:
+            with lock:
+                created_habits.append((json.loads(body).get("id"), u["id"]))
+        return st, body
+
+    def delete_habit(c):
+        with lock:
+            item = created_habits.pop() if created_habits else None
+        if item is None:
+            return add_habit(c)
+        return c.call("DELETE", f"/habits/{item[0]}?user_id={item[1]}")
+
+    def friends_add(c):
+        a, b = U(), U()
+        if a["id"] == b["id"]:
+            return friends_list(c)
+        with lock:
+            created_friends.append((a["id"], b["id"]))
+        return c.call("POST", "/friends/add", {"user_id": a["id"], "target_id": b["id"]})
+
+    def friends_remove(c):
+        with lock:
+            item = created_friends.pop() if created_friends else None
+        if item is None:
+            return friends_add(c)
+        return c.call("DELETE", f"/friends/remove?user_id={item[0]}&target_id={item[1]}")
+
+    def friends_list(c):
+        return c.call("GET", f"/friends/list?user_id={U()['id']}")
+
+    def signup(c):
+        name = "bsu_" + "".join(random.choice(string.ascii_lowercase) for _ in range(12))
+        return c.call("POST", "/signup", {"email": name + "@example.com", "username": name, "password": pwd,
+                                          "first_name": "B", "last_name": "S", "birth_date": "1999-01-01"})
+
+    def visibility(c):
+        u = random.choice(public)
+        return c.call("PUT", "/profile/visibility", {"user_id": u["id"], "is_public": True, "bio": "bench"})
+
+    s = Scenario
+    return [
+        # lecturas
+        s("public_users", "GET", "/public/users", 8, lambda c: c.call("GET", f"/public/users?q={q()}&page_size=20")),
+        s("public_user_detail", "GET", "/public/user/{username}", 8,
+          lambda c: c.call("GET", f"/public/user/{random.choice(public)['username']}")),
+        s("public_rank", "GET", "/public/rank", 6,
+          lambda c: c.call("GET", f"/public/rank?window={random.choice([7, 30])}&user_id={U()['id']}")),
+        s("posts_feed", "GET", "/posts/feed", 15, lambda c: c.call("GET", f"/posts/feed?user_id={U()['id']}")),
+        s("posts_feed_ranked", "GET", "/posts/feed", 5,
+          lambda c: c.call("GET", f"/posts/feed?user_id={U()['id']}&sort=ranked")),
+        s("posts_by_user", "GET", "/posts/by_user", 6,
+          lambda c: c.call("GET", f"/posts/by_user?author_id={U()['id']}&viewer_id={U()['id']}")),
+        s("list_posts", "GET", "/posts", 2, lambda c: c.call("GET", "/posts?limit=20")),
+        s("list_comments", "GET", "/posts/{post_id}/comments", 6,
+          lambda c: c.call("GET", f"/posts/{random.choice(posts)}/comments")),
+        s("comments_batch", "GET", "/posts/comments/batch", 3,
+          lambda c: c.call("GET", "/posts/comments/batch?post_ids="
+                           + ",".join(str(random.choice(posts)) for _ in range(8)))),
+        s("stats_weekly", "GET", "/stats/weekly", 8,
+          lambda c: c.call("GET", f"/stats/weekly?user_id={U()['id']}&window={random.choice([7, 30])}")),
+        s("list_habits", "GET", "/habits", 4, lambda c: c.call("GET", f"/habits?user_id={U()['id']}")),
+        s("friends_list", "GET", "/friends/list", 3, friends_list),
+        s("friends_suggested", "GET", "/friends/suggested", 3,
+          lambda c: c.call("GET", f"/friends/suggested?user_id={U()['id']}&limit=12&window=30")),
+        s("friends_mutual", "GET", "/friends/mutual", 2,
+          lambda c: c.call("GET", f"/friends/mutual?user_id={U()['id']}&other_id={U()['id']}")),
+        s("export", "GET", "/export", 0.2,
+          lambda c: c.call("GET", f"/export?user_id={U()['id']}&format={random.choice(['ndjson', 'csv'])}")),
+        s("login", "POST", "/login", 2, lambda c: c.call("POST", "/login", {"username": U()["username"], "password": pwd})),
+        s("metrics", "GET", "/metrics", 0.2, lambda c: c.call("GET", "/metrics")),
+        s("cache_stats", "GET", "/admin/cache/stats", 0.2, lambda c: c.call("GET", "/admin/cache/stats")),
+        # escrituras
+        s("mark_today", "POST", "/logs/mark_today", 8, mark_today),
+        s("logs_bulk", "POST", "/logs/bulk", 0.5, logs_bulk),
+        s("toggle_like", "POST", "/posts/{post_id}/like", 6,
+          lambda c: c.call("POST", f"/posts/{random.choice(posts)}/like?user_id={U()['id']}")),
+        s("toggle_reaction", "POST", "/posts/{post_id}/reactions/{rx_type}", 2,
+          lambda c: c.call("POST", f"/posts/{random.choice(posts)}/reactions/"
+                                   f"{random.choice(['like', 'clap', 'star'])}?user_id={U()['id']}")),
+        s("create_comment", "POST", "/posts/{post_id}/comments", 2,
+          lambda c: c.call("POST", f"/posts/{random.choice(posts)}/comments", {"user_id": U()["id"], "content": "bench"})),
+        s("create_post", "POST", "/posts", 2, create_post),
+        s("delete_post", "DELETE", "/posts/{post_id}", 1, delete_post),
+        s("add_habit", "POST", "/habits", 1, add_habit),
+        s("delete_habit", "DELETE", "/habits/{habit_id}", 1, delete_habit),
+        s("friends_add", "POST", "/friends/add", 1, friends_add),
+        s("friends_remove", "DELETE", "/friends/remove", 1, friends_remove),
+        s("signup", "POST", "/signup", 0.5, signup),
+        s("update_profile", "PUT", "/profile", 0.5,
+          lambda c: c.call("PUT", "/profile", {"user_id": U()["id"], "first_name": "Nombre", "last_name": "Bench"})),
+        s("profile_visibility", "PUT", "/profile/visibility", 0.5, visibility),
+        s("counters_reconcile", "POST", "/admin/counters/reconcile", 0.02,
+          lambda c: c.call("POST", "/admin/counters/reconcile")),
+        s("graph_refresh", "POST", "/admin/friends/graph/refresh", 0.02,
+          lambda c: c.call("POST", "/admin/friends/graph/refresh")),
+    ]
+
+
+def read_metrics(client):
+    # {(metric, method, route): valor} para los contadores que usamos
+    st, body = client.call("GET", "/metrics")
+    out = defaultdict(float)
+    if st != 200:
+        return out
+    for line in body.decode().splitlines():
+        if line.startswith("#") or "{" not in line:
+            continue
+        name, rest = line.split("{", 1)
+        if name not in ("habitos_requests_total", "habitos_db_queries_total", "habitos_db_seconds_total"):
+            continue
+        labels, value = rest.rsplit("}", 1)
+        lab = dict(p.split("=", 1) for p in labels.split(",") if "=" in p)
+        key = (name, lab.get("method", "").strip('"'), lab.get("route", "").strip('"'))
+        out[key] += float(value)
+    return out
+
+
+def pct(sorted_vals, p):
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, int(round(p / 100 * len(sorted_vals) + 0.5)) - 1))
+    return round(sorted_vals[k] * 1000, 2)
+
+
+def git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument("--base", default="http://localhost:8000")
+    ap.add_argument("--manifest", default=os.path.join(ROOT, "bench", "dataset.json"))
+    ap.add_argument("--duration", type=float, default=30)
+    ap.add_argument("--concurrency", type=int, default=16)
+    ap.add_argument("--timeout", type=float, default=30)
+    ap.add_argument("--only", default="", help="lista de escenarios separados por coma")
+    ap.add_argument("--weights", default="", help="pesos a reemplazar, p. ej. login=20,signup=5")
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--out", default=os.path.join(ROOT, "bench", "results"))
+    ap.add_argument("--baseline", help="JSON de una corrida anterior para comparar")
+    args = ap.parse_args()
+
+    with open(args.manifest) as f:
+        manifest = json.load(f)
+    random.seed(args.seed)
+    lock = threading.Lock()
+    scenarios = build_scenarios(manifest, lock)
+    if args.only:
+        keep = set(args.only.split(","))
+        scenarios = [s for s in scenarios if s.name in keep]
+    for item in filter(None, args.weights.split(",")):
+        name, w = item.split("=")
+        for s in scenarios:
+            if s.name == name:
+                s.weight = float(w)
+    weights = [s.weight for s in scenarios]
+    client = Client(args.base, args.timeout)
+
+    lat = defaultdict(list)
+    errors = defaultdict(int)
+    before = read_metrics(client)
+    deadline = time.perf_counter() + args.duration
+
+    def worker():
+        while time.perf_counter() < deadline:
+            sc = random.choices(scenarios, weights)[0]
+            t0 = time.perf_counter()
+            try:
+                status, _ = sc.action(client)
+            except Exception:
+                status = 0
+            dt = time.perf_counter() - t0
+            with lock:
+                lat[sc.name].append(dt)
+                if status == 0 or status >= 500:
+                    errors[sc.name] += 1
+
+    t_start = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as ex:
+        for f in [ex.submit(worker) for _ in range(args.concurrency)]:
+            f.result()
+    elapsed = time.perf_counter() - t_start
+    after = read_metrics(client)
+
+    def delta(metric, sc):
+        return after[(metric, sc.method, sc.route)] - before[(metric, sc.method, sc.route)]
+
+    endpoints = {}
+    for sc in scenarios:
+        vals = sorted(lat.get(sc.name, []))
+        if not vals:
+            continue
+        reqs = delta("habitos_requests_total", sc)
+        endpoints[sc.name] = {
+            "method": sc.method, "route": sc.route, "count": len(vals), "errors": errors[sc.name],
+            "rps": round(len(vals) / elapsed, 2),
+            "mean_ms": round(sum(vals) / len(vals) * 1000, 2),
+            "p50_ms": pct(vals, 50), "p95_ms": pct(vals, 95), "p99_ms": pct(vals, 99),
+            # por ruta (si dos escenarios comparten ruta, se reparten el mismo número)
+            "queries_per_request": round(delta("habitos_db_queries_total", sc) / reqs, 2) if reqs else None,
+            "db_ms_per_request": round(delta("habitos_db_seconds_total", sc) / reqs * 1000, 2) if reqs else None,
+        }
+    all_vals = sorted(v for vs in lat.values() for v in vs)
+    result = {
+        "meta": {
+            "git": git_rev(), "at": datetime.datetime.now().isoformat(timespec="seconds"),
+            "base": args.base, "duration_s": round(elapsed, 2), "concurrency": args.concurrency,
+            "seed": args.seed, "dataset": manifest.get("counts"),
+        },
+        "total": {
+            "count": len(all_vals), "errors": sum(errors.values()),
+            "rps": round(len(all_vals) / elapsed, 2),
+            "p50_ms": pct(all_vals, 50), "p95_ms": pct(all_vals, 95), "p99_ms": pct(all_vals, 99),
+        },
+        "endpoints": endpoints,
+    }
+
+    os.makedirs(args.out, exist_ok=True)
+    stamp = datetime.datetime.now().strftime("%Y%m%d-%H%M%S")
+    path = os.path.join(args.out, f"{stamp}-{result['meta']['git'] or 'nogit'}.json")
+    with open(path, "w") as f:
+        json.dump(result, f, indent=2)
+
+    base = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            base = json.load(f)["endpoints"]
+    print(f"{'endpoint':24} {'n':>6} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8} {'q/req':>6}" + ("  Δp95" if base else ""))
+    for name, e in sorted(endpoints.items()):
+        line = (f"{name:24} {e['count']:>6} {e['rps']:>8} {e['p50_ms']:>8} {e['p95_ms']:>8} {e['p99_ms']:>8} "
+                f"{e['queries_per_request'] if e['queries_per_request'] is not None else '-':>6}")
+        if base and name in base and base[name]["p95_ms"]:
+            line += f"  {(e['p95_ms'] - base[name]['p95_ms']) / base[name]['p95_ms'] * 100:+.0f}%"
+        print(line)
+    t = result["total"]
+    print(f"total: {t['count']} req, {t['rps']} rps, p95 {t['p95_ms']} ms, errores {t['errors']} -> {path}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
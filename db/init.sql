@@ -42,6 +42,27 @@ CREATE TABLE IF NOT EXISTS logs (
 
 
 
+-- Rachas por hábito (las mantiene el backend; se reconstruyen desde logs)
+CREATE TABLE IF NOT EXISTS habit_streaks (
+  habit_id     INT PRIMARY KEY,
+  last_done    DATE NULL,                  -- último día cumplido
+  current_len  INT NOT NULL DEFAULT 0,     -- largo de la racha que termina en last_done
+  longest_len  INT NOT NULL DEFAULT 0,
+  CONSTRAINT fk_streaks_habit FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Hábitos cumplidos por usuario y día (la mantiene el backend junto con logs)
+CREATE TABLE IF NOT EXISTS user_daily_done (
+  user_id     INT NOT NULL,
+  day         DATE NOT NULL,
+  done_count  INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, day),
+  KEY idx_udd_day (day, user_id),
+  CONSTRAINT fk_udd_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+
+
 -- refactorizaciones agregadas
 CREATE INDEX idx_profiles_is_public ON profiles(is_public);
 CREATE INDEX idx_habits_user      ON habits(user_id);
@@ -85,6 +106,30 @@ CREATE TABLE IF NOT EXISTS post_comments (
   CONSTRAINT fk_comments_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
 ) ENGINE=InnoDB;
 
+-- Reacciones múltiples (like / clap / star)
+CREATE TABLE IF NOT EXISTS post_reactions (
+  post_id  INT NOT NULL,
+  user_id  INT NOT NULL,
+  type     ENUM('like','clap','star') NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (post_id, user_id, type),
+  INDEX idx_reactions_user (user_id),
+  CONSTRAINT fk_reactions_post FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+  CONSTRAINT fk_reactions_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Contadores denormalizados por post (los escribe el buffer write-behind del
+-- backend y los repara la reconciliación contra las tablas fuente)
+CREATE TABLE IF NOT EXISTS post_counters (
+  post_id   INT PRIMARY KEY,
+  likes     INT NOT NULL DEFAULT 0,
+  comments  INT NOT NULL DEFAULT 0,
+  rx_like   INT NOT NULL DEFAULT 0,
+  rx_clap   INT NOT NULL DEFAULT 0,
+  rx_star   INT NOT NULL DEFAULT 0,
+  CONSTRAINT fk_counters_post FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
 
 
 -- Amistades no dirigidas (guardaremos dos filas: A->B y B->A)
@@ -189,3 +234,30 @@ SELECT h.id, CURDATE() - INTERVAL 2 DAY, 1
 FROM habits h
 JOIN profiles p ON p.user_id = h.user_id AND p.is_public = 1
 ON DUPLICATE KEY UPDATE value=VALUES(value);
+
+-- Rachas iniciales (gaps-and-islands: día - n° de fila es constante dentro de una racha)
+INSERT INTO habit_streaks (habit_id, last_done, current_len, longest_len)
+SELECT r.habit_id,
+       MAX(r.run_end),
+       CAST(SUBSTRING_INDEX(GROUP_CONCAT(r.run_len ORDER BY r.run_end DESC), ',', 1) AS UNSIGNED),
+       MAX(r.run_len)
+FROM (
+  SELECT habit_id, MAX(day) AS run_end, COUNT(*) AS run_len
+  FROM (
+    SELECT habit_id, day,
+           DATE_SUB(day, INTERVAL ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY day) DAY) AS grp
+    FROM logs WHERE value = 1
+  ) d
+  GROUP BY habit_id, grp
+) r
+GROUP BY r.habit_id;
+
+INSERT IGNORE INTO habit_streaks (habit_id) SELECT id FROM habits;
+
+-- Rollup diario inicial
+INSERT INTO user_daily_done (user_id, day, done_count)
+SELECT h.user_id, l.day, COUNT(*)
+FROM logs l JOIN habits h ON h.id = l.habit_id
+WHERE l.value = 1
+GROUP BY h.user_id, l.day
+ON DUPLICATE KEY UPDATE done_count = VALUES(done_count);
@@ -0,0 +1,95 @@
+-- Migraciones para bases creadas con una versión anterior de init.sql
+-- (init.sql solo corre la primera vez que se crea el volumen de MySQL).
+-- Es idempotente: se puede correr sobre una base nueva o ya migrada.
+--
+--   docker compose exec -T mysql mysql -uroot -prootpass < db/migrate.sql
+
+USE habitos_db;
+
+-- Reacciones múltiples (like / clap / star)
+CREATE TABLE IF NOT EXISTS post_reactions (
+  post_id  INT NOT NULL,
+  user_id  INT NOT NULL,
+  type     ENUM('like','clap','star') NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY (post_id, user_id, type),
+  INDEX idx_reactions_user (user_id),
+  CONSTRAINT fk_reactions_post FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE,
+  CONSTRAINT fk_reactions_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Contadores denormalizados por post
+CREATE TABLE IF NOT EXISTS post_counters (
+  post_id   INT PRIMARY KEY,
+  likes     INT NOT NULL DEFAULT 0,
+  comments  INT NOT NULL DEFAULT 0,
+  rx_like   INT NOT NULL DEFAULT 0,
+  rx_clap   INT NOT NULL DEFAULT 0,
+  rx_star   INT NOT NULL DEFAULT 0,
+  CONSTRAINT fk_counters_post FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Contadores desde las tablas fuente (lo mismo que hace reconcile_counters)
+INSERT INTO post_counters (post_id, likes, comments, rx_like, rx_clap, rx_star)
+SELECT p.id,
+       COALESCE(l.n, 0), COALESCE(c.n, 0),
+       COALESCE(r.rx_like, 0), COALESCE(r.rx_clap, 0), COALESCE(r.rx_star, 0)
+FROM posts p
+LEFT JOIN (SELECT post_id, COUNT(*) AS n FROM post_likes GROUP BY post_id) l ON l.post_id = p.id
+LEFT JOIN (SELECT post_id, COUNT(*) AS n FROM post_comments GROUP BY post_id) c ON c.post_id = p.id
+LEFT JOIN (
+  SELECT post_id,
+         SUM(type = 'like') AS rx_like, SUM(type = 'clap') AS rx_clap, SUM(type = 'star') AS rx_star
+  FROM post_reactions GROUP BY post_id
+) r ON r.post_id = p.id
+ON DUPLICATE KEY UPDATE
+  likes=VALUES(likes), comments=VALUES(comments),
+  rx_like=VALUES(rx_like), rx_clap=VALUES(rx_clap), rx_star=VALUES(rx_star);
+
+-- Rachas por hábito
+CREATE TABLE IF NOT EXISTS habit_streaks (
+  habit_id     INT PRIMARY KEY,
+  last_done    DATE NULL,                  -- último día cumplido
+  current_len  INT NOT NULL DEFAULT 0,     -- largo de la racha que termina en last_done
+  longest_len  INT NOT NULL DEFAULT 0,
+  CONSTRAINT fk_streaks_habit FOREIGN KEY (habit_id) REFERENCES habits(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Rachas desde logs (gaps-and-islands, igual que init.sql)
+INSERT INTO habit_streaks (habit_id, last_done, current_len, longest_len)
+SELECT r.habit_id,
+       MAX(r.run_end),
+       CAST(SUBSTRING_INDEX(GROUP_CONCAT(r.run_len ORDER BY r.run_end DESC), ',', 1) AS UNSIGNED),
+       MAX(r.run_len)
+FROM (
+  SELECT habit_id, MAX(day) AS run_end, COUNT(*) AS run_len
+  FROM (
+    SELECT habit_id, day,
+           DATE_SUB(day, INTERVAL ROW_NUMBER() OVER (PARTITION BY habit_id ORDER BY day) DAY) AS grp
+    FROM logs WHERE value = 1
+  ) d
+  GROUP BY habit_id, grp
+) r
+GROUP BY r.habit_id
+ON DUPLICATE KEY UPDATE
+  last_done=VALUES(last_done), current_len=VALUES(current_len), longest_len=VALUES(longest_len);
+
+INSERT IGNORE INTO habit_streaks (habit_id) SELECT id FROM habits;
+
+-- Hábitos cumplidos por usuario y día
+CREATE TABLE IF NOT EXISTS user_daily_done (
+  user_id     INT NOT NULL,
+  day         DATE NOT NULL,
+  done_count  INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (user_id, day),
+  KEY idx_udd_day (day, user_id),
+  CONSTRAINT fk_udd_user FOREIGN KEY (user_id) REFERENCES users(id) ON DELETE CASCADE
+) ENGINE=InnoDB;
+
+-- Rollup diario desde logs
+INSERT INTO user_daily_done (user_id, day, done_count)
+SELECT h.user_id, l.day, COUNT(*)
+FROM logs l JOIN habits h ON h.id = l.habit_id
+WHERE l.value = 1
+GROUP BY h.user_id, l.day
+ON DUPLICATE KEY UPDATE done_count = VALUES(done_count);
@@ -0,0 +1,28 @@
+#!/bin/bash
+# Inicializa esta instancia como réplica del primario ($SOURCE_HOST). El entrypoint
+# de la imagen de MySQL lo corre una sola vez, con el volumen vacío: copia habitos_db
+# con mysqldump (incluye el GTID_PURGED del primario) y arranca la replicación con
+# auto-posición desde ahí.
+set -euo pipefail
+
+LOCAL=(mysql --protocol=socket -uroot -p"${MYSQL_ROOT_PASSWORD}")
+
+until mysqladmin ping -h"${SOURCE_HOST}" -uroot -p"${SOURCE_ROOT_PASSWORD}" --silent; do
+  echo "replica-init: esperando al primario ${SOURCE_HOST}..."
+  sleep 2
+done
+
+# los GTID locales (usuarios creados por el entrypoint) no deben chocar con los del primario
+"${LOCAL[@]}" -e "RESET MASTER;"
+
+mysqldump -h"${SOURCE_HOST}" -uroot -p"${SOURCE_ROOT_PASSWORD}" \
+  --databases "${MYSQL_DATABASE}" --single-transaction --set-gtid-purged=ON \
+  --routines --events --triggers \
+  | "${LOCAL[@]}"
+
+"${LOCAL[@]}" -e "
+  CHANGE REPLICATION SOURCE TO
+    SOURCE_HOST='${SOURCE_HOST}', SOURCE_USER='root', SOURCE_PASSWORD='${SOURCE_ROOT_PASSWORD}',
+    SOURCE_AUTO_POSITION=1, GET_SOURCE_PUBLIC_KEY=1;
+  START REPLICA;"
+echo "replica-init: replicando desde ${SOURCE_HOST}"
@@ -124,7 +124,6 @@ $('#post-create')?.addEventListener('click', async ()=>{
     })});
     $('#post-content').value = '';
     showToast?.('Publicado','success');
-    feedPage = 1;
     loadFeed(true);
   }catch(e){ showToast?.(e.message,'error'); }
 });
@@ -132,7 +131,7 @@ $('#post-create')?.addEventListener('click', async ()=>{
 
 /* codigo para ver perfil de alguien que aparecio en recomendados */
 // ---- Perfil público (página "view") ----
-const viewState = { authorId:null, username:null, page:1, pageSize:6, loading:false };
+const viewState = { authorId:null, username:null, cursor:null, pageSize:6, loading:false };
 
 function openView(){
   goto('view');
@@ -143,7 +142,7 @@ function closeView(){
   // limpia estado de la página
   viewState.authorId = null;
   viewState.username = null;
-  viewState.page = 1;
+  viewState.cursor = null;
   viewState.loading = false;
   const p = $('#view-posts'); if(p) p.innerHTML = '';
   $('#view-more')?.style && ($('#view-more').style.display = 'none');
@@ -154,7 +153,6 @@ $('#viewBackBtn')?.addEventListener('click', closeView);
 
 // Cargar más
 $('#view-load')?.addEventListener('click', ()=>{
-  viewState.page += 1;
   loadViewPosts();
 });
 
@@ -184,7 +182,7 @@ async function showProfilePage(username){
     const info = await api(`/public/user/${encodeURIComponent(username)}`);
     viewState.username = info?.user?.username || username;
     viewState.authorId = info?.user?.id;
-    viewState.page = 1;
+    viewState.cursor = null;
 
     $('#view-username').textContent = '@' + viewState.username;
     $('#view-bio').textContent = info?.user?.bio || '—';
@@ -230,11 +228,14 @@ async function loadViewPosts(){
   viewState.loading = true;
 
   try{
-    const url = `/posts/by_user?author_id=${viewState.authorId}&viewer_id=${state.user.id}&page=${viewState.page}&page_size=${viewState.pageSize}`;
+    const first = !viewState.cursor;
+    const url = `/posts/by_user?author_id=${viewState.authorId}&viewer_id=${state.user.id}&page_size=${viewState.pageSize}`
+      + (viewState.cursor ? `&cursor=${encodeURIComponent(viewState.cursor)}` : '');
     const data = await api(url);
     const items = Array.isArray(data?.items) ? data.items : [];
+    viewState.cursor = data?.next_cursor || null;
 
-    if(viewState.page===1 && items.length===0){
+    if(first && items.length===0){
       $('#view-posts').innerHTML = '<div class="muted">No hay publicaciones disponibles.</div>';
     }else{
       const wrap = $('#view-posts');
@@ -260,7 +261,7 @@ async function loadViewPosts(){
       }
     }
     // paginación
-    $('#view-more').style.display = (items.length === viewState.pageSize) ? 'flex' : 'none';
+    $('#view-more').style.display = viewState.cursor ? 'flex' : 'none';
 
   }catch(e){
     showToast?.(e.message || 'Error al cargar publicaciones','error');
@@ -275,13 +276,14 @@ async function loadViewPosts(){
 // let feedPage = 1;
 async function loadFeed(clear=false){
   try{
-    const res = await api(`/posts/feed?user_id=${state.user.id}&page=${feedPage}&page_size=8`);
+    if(clear) feedCursor = null;
+    const res = await api(`/posts/feed?user_id=${state.user.id}&page_size=8&include=comments_preview${feedCursor ? `&cursor=${encodeURIComponent(feedCursor)}` : ''}`);
     const list = res.items || [];
     const box = $('#feedList'); if(!box) return;
     if(clear) box.innerHTML = '';
     list.forEach(p => drawPostCard(p, box));  // <- aquí (no agrego can delete para evitar que en el feed se borren los posts)
     if(list.length===0 && clear){ box.innerHTML='<div class="muted">Sin publicaciones aún.</div>'; }
-    feedPage++;
+    feedCursor = res.next_cursor || null;
   }catch(e){ showToast?.(e.message,'error'); }
 }
 
@@ -291,7 +293,7 @@ async function loadPosts(clear=false){
   if (loadingPosts) return;
   loadingPosts = true;
   try{
-    const res = await api(`/posts/by_user?author_id=${state.user.id}&viewer_id=${state.user.id}&require_owner=1&page=1&page_size=10`);
+    const res = await api(`/posts/by_user?author_id=${state.user.id}&viewer_id=${state.user.id}&require_owner=1&page=1&page_size=10&include=comments_preview`);
     const list = res.items || [];
     const box = $('#myPostsFeedList'); if(!box) return;
     if(clear) box.innerHTML = '';
@@ -335,7 +337,7 @@ $('#myPostsFeedList')?.addEventListener('click', async (e) => {
     const postId = Number(cmtBtn.dataset.cmt);
     const box = document.getElementById(`cbox-${postId}`);
     box.style.display = box.style.display==='none' ? 'block' : 'none';
-    if(box.style.display==='block'){ loadComments(postId); }
+    if(box.style.display==='block'){ openComments(postId); }
     return;
   }
 
@@ -345,7 +347,7 @@ $('#myPostsFeedList')?.addEventListener('click', async (e) => {
     const text = (inp.value||'').trim(); if(!text) return;
     try{
       await api(`/posts/${postId}/comments`, {method:'POST', body: JSON.stringify({user_id: state.user.id, content: text})});
-      inp.value=''; loadComments(postId);
+      inp.value=''; forgetPreview(postId); loadComments(postId);
     }catch(e){ showToast?.(e.message,'error'); }
   }
 });
@@ -474,6 +476,7 @@ function drawPostCard(p, targetEl, opts = {}) {
           <button class="btn" data-like="${p.id}">❤️ ${p.likes ?? 0}</button>
           <button class="btn ghost" data-cmt="${p.id}">💬 ${p.comments ?? 0}</button>
         </div>
+        ${previewHtml(p)}
 
         <div id="cbox-${p.id}" style="display:none; margin-top:8px">
           <div style="display:flex; gap:6px">
@@ -488,6 +491,35 @@ function drawPostCard(p, targetEl, opts = {}) {
   targetEl.appendChild(card);
 }
 
+// ===== Vista previa de comentarios =====
+// el feed y "Mis Posts" piden include=comments_preview: los últimos comentarios
+// de cada post llegan con la página. Al abrir los comentarios, si la vista previa
+// ya los trae todos, no se hace otro request.
+const commentPreviews = new Map();   // post_id -> { items, total }
+
+function previewHtml(p){
+  if (!Array.isArray(p.comments_preview)) return '';
+  commentPreviews.set(p.id, { items: p.comments_preview, total: Number(p.comments ?? 0) });
+  if (!p.comments_preview.length) return '';
+  return `<div class="cpreview" id="cprev-${p.id}" style="margin-top:6px">${
+    p.comments_preview.map(c => `<div class="hint">@${escapeHtml(c.username)}: ${escapeHtml(c.content)}</div>`).join('')
+  }</div>`;
+}
+
+function openComments(postId){
+  const cached = commentPreviews.get(postId);
+  if (cached && cached.items.length >= cached.total) {
+    renderComments(postId, cached.items);
+    return;
+  }
+  return loadComments(postId);
+}
+
+function forgetPreview(postId){
+  commentPreviews.delete(postId);
+  document.getElementById(`cprev-${postId}`)?.remove();
+}
+
 
 async function loadComments(postId){
   try{
@@ -645,7 +677,7 @@ async function renderRanking() {
   list.innerHTML = '<div class="muted">Cargando ranking...</div>';
 
   try {
-    const data = await api(`/public/rank?window=7&page=1&page_size=10`, { signal: rankAbortCtrl.signal });
+    const data = await api(`/public/rank?window=7&page=1&page_size=10&user_id=${state.user.id}`, { signal: rankAbortCtrl.signal });
     const raw = Array.isArray(data?.items) ? data.items
                : Array.isArray(data)       ? data
                : [];
@@ -682,6 +714,22 @@ async function renderRanking() {
       `;
       list.appendChild(row);
     });
+
+    // mi posición (si no aparezco en el top)
+    const me = data?.me;
+    if (me && me.rank > top.length) {
+      const row = document.createElement('div');
+      row.className = 'rank-item';
+      row.innerHTML = `
+        <div class="badge">${me.rank}</div>
+        <div class="post-ava"></div>
+        <div style="flex:1">
+          <div class="post-user">Tú (@${escapeHtml(state.user.username || '')})</div>
+          <div class="muted">${me.done_days} días cumplidos</div>
+        </div>
+      `;
+      list.appendChild(row);
+    }
   } catch (e) {
     if (e.name === 'AbortError') return;
     list.innerHTML = `<div class="muted">No disponible.</div>`;
@@ -695,8 +743,9 @@ async function renderRanking() {
 
 
 // ===== FEED v2 (Home) =====
-let feedPage = 1;
+let feedCursor = null;   // cursor opaco que devuelve /posts/feed (next_cursor)
 let feedLoading = false;
+let feedObserver = null; // scroll infinito: carga la siguiente página al ver "Cargar más"
 const renderedIds = new Set();
 
 function formatTs(ts){ try{ return new Date(ts).toLocaleString(); }catch{ return ts } }
@@ -714,7 +763,7 @@ async function renderFeed(loadMore = false) {
   }
 
   if (!loadMore) {
-    feedPage = 1;
+    feedCursor = null;
     list.innerHTML = '';
     renderedIds.clear();
   }
@@ -726,10 +775,14 @@ async function renderFeed(loadMore = false) {
   if (oldMore) oldMore.parentElement?.remove();
 
   try {
-    const data = await api(`/posts/feed?user_id=${state.user.id}&page=${feedPage}&page_size=8`);
+    const first = !feedCursor;
+    const url = `/posts/feed?user_id=${state.user.id}&page_size=8&include=comments_preview`
+      + (feedCursor ? `&cursor=${encodeURIComponent(feedCursor)}` : '');
+    const data = await api(url);
     const items = Array.isArray(data?.items) ? data.items : [];
+    feedCursor = data?.next_cursor || null;
 
-    if (items.length === 0 && feedPage === 1) {
+    if (items.length === 0 && first) {
       list.innerHTML = `<div class="muted">Aún no hay publicaciones.</div>`;
       return;
     }
@@ -770,6 +823,7 @@ async function renderFeed(loadMore = false) {
             💬 <span data-cmt-count>${cmtCount}</span>
           </button>
         </div>
+        ${previewHtml(p)}
 
         <div class="cbox" id="cbox-${p.id}" hidden style="margin-top:8px">
           <div style="display:flex; gap:6px">
@@ -784,17 +838,26 @@ async function renderFeed(loadMore = false) {
 
     list.appendChild(frag);
 
-    if (items.length === 8) {
+    feedObserver?.disconnect();
+    if (feedCursor) {
       const moreWrap = document.createElement('div');
       moreWrap.style = 'display:flex;justify-content:center;margin-top:8px';
       moreWrap.innerHTML = `<button class="btn" id="feedMoreBtn">Cargar más</button>`;
       list.appendChild(moreWrap);
-      $('#feedMoreBtn').onclick = () => {
+      const more = () => {
         if (feedLoading) return;
+        feedLoading = true;
+        feedObserver?.disconnect();
         moreWrap.remove();
-        feedPage++;
         renderFeed(true);
       };
+      $('#feedMoreBtn').onclick = more;
+      if ('IntersectionObserver' in window) {
+        feedObserver = new IntersectionObserver(entries => {
+          if (entries.some(e => e.isIntersecting)) more();
+        });
+        feedObserver.observe(moreWrap);
+      }
     }
   } catch (e) {
     showToast?.(e.message, 'error');
@@ -825,7 +888,7 @@ $('#feedList')?.addEventListener('click', async (e) => {
     const box = $(`#cbox-${postId}`);
     box.hidden = !box.hidden;
     if (!box.hidden) {
-      await loadComments(postId);
+      await openComments(postId);
     }
     return;
   }
@@ -843,6 +906,7 @@ $('#feedList')?.addEventListener('click', async (e) => {
         body: JSON.stringify({ user_id: state.user.id, content: text })
       });
       input.value = '';
+      forgetPreview(postId);
       await loadComments(postId);
 
       // ++ contador visible
@@ -882,23 +946,72 @@ async function loadComments(postId, page=1, page_size=50) {
   try {
     // tu endpoint devuelve LISTA (no {items}), así que úsalo directo
     const comments = await api(`/posts/${postId}/comments?page=${page}&page_size=${page_size}`);
-    const listEl = $(`#clist-${postId}`);
-    if (!listEl) return;
-    listEl.innerHTML = comments.map(c => `
-      <div class="comment">
-        <b>@${escapeHtml(c.username)}</b>
-        <span class="muted" style="margin-left:6px">${formatTs(c.created_at)}</span>
-        <div>${escapeHtml(c.content)}</div>
-      </div>
-    `).join('');
+    renderComments(postId, comments);
   } catch (e) {
     showToast?.(e.message,'error');
   }
 }
 
+function renderComments(postId, comments){
+  const listEl = $(`#clist-${postId}`);
+  if (!listEl) return;
+  listEl.innerHTML = comments.map(c => `
+    <div class="comment">
+      <b>@${escapeHtml(c.username)}</b>
+      <span class="muted" style="margin-left:6px">${formatTs(c.created_at)}</span>
+      <div>${escapeHtml(c.content)}</div>
+    </div>
+  `).join('');
+}
+
 
 function escapeHtml(s){ return (s||'').replace(/[&<>"']/g,c=>({ '&':'&amp;','<':'&lt;','>':'&gt;','"':'&quot;',"'":'&#39;'}[c])) }
 
+// ===== Eventos en tiempo real (SSE) =====
+// likes y comentarios se actualizan en las tarjetas visibles; posts nuevos (o un
+// "resync" si nos atrasamos) muestran un aviso para recargar el feed
+let eventSource = null;
+
+function connectEvents(){
+  disconnectEvents();
+  if (!state.user || !window.EventSource) return;
+  const es = new EventSource(`${API}/events?user_id=${state.user.id}`);
+  const on = (type, fn) => es.addEventListener(type, ev => {
+    try { fn(JSON.parse(ev.data)); } catch (e) { console.error('[events]', type, e); }
+  });
+
+  on('like', d => {
+    $$(`.post[data-post-id="${d.post_id}"] [data-like-count]`).forEach(el => { el.textContent = String(d.likes); });
+  });
+  on('comment', d => {
+    if (d.user_id === state.user?.id) return;   // el propio ya se sumó al enviarlo
+    $$(`.post[data-post-id="${d.post_id}"] [data-cmt-count]`).forEach(el => {
+      el.textContent = String(Number(el.textContent || 0) + 1);
+    });
+    forgetPreview(d.post_id);
+    const box = $(`#cbox-${d.post_id}`);
+    if (box && !box.hidden) loadComments(d.post_id);
+  });
+  on('post', d => { if (d.author_id !== state.user?.id) showFeedUpdates(); });
+  on('resync', () => showFeedUpdates());
+  eventSource = es;
+}
+
+function disconnectEvents(){
+  eventSource?.close();
+  eventSource = null;
+}
+
+function showFeedUpdates(){
+  const list = $('#feedList');
+  if (!list || $('#feedNewBtn')) return;
+  const wrap = document.createElement('div');
+  wrap.style = 'display:flex;justify-content:center;margin-bottom:8px';
+  wrap.innerHTML = `<button class="btn" id="feedNewBtn">Hay publicaciones nuevas</button>`;
+  list.prepend(wrap);
+  $('#feedNewBtn').onclick = () => { wrap.remove(); renderFeed(false); };
+}
+
 /********* Modal nueva publicación **********/
 const postModal = $('#postModal');
 const openPostModal = ()=>{ postModal.classList.add('open'); postModal.setAttribute('aria-hidden','false'); $('#post-content').value=''; };
@@ -1025,17 +1138,35 @@ function showToast(message, type='info', title){
   return {dismiss};
 }
 
+// Respuestas GET con ETag: se reenvía If-None-Match y un 304 reutiliza el cuerpo guardado
+const etagCache = new Map(); // path -> {etag, body}
+const ETAG_CACHE_MAX = 100;
+
 // Envuelve fetch para devolver mensajes legibles
 async function api(path, opts={}){
   const headers = Object.assign({'Content-Type':'application/json'}, opts.headers||{});
+  const isGet = (opts.method || 'GET').toUpperCase() === 'GET';
+  const cached = isGet ? etagCache.get(path) : null;
+  if(cached) headers['If-None-Match'] = cached.etag;
   const res = await fetch((window.API_BASE || '') + path, {...opts, headers});
+  if(res.status === 304 && cached){
+    etagCache.delete(path);
+    etagCache.set(path, cached);        // más reciente al final (LRU)
+    return JSON.parse(cached.body);     // copia nueva: quien llama puede mutarla
+  }
   if(!res.ok){
     let msg;
     try { msg = normalizeErrorMessage(await res.json()); }
     catch { msg = normalizeErrorMessage(await res.text()); }
     throw new Error(msg || res.statusText);
   }
-  return res.json();
+  const etag = isGet && res.headers.get('ETag');
+  if(!etag) return res.json();
+  const body = await res.text();
+  etagCache.delete(path);
+  etagCache.set(path, {etag, body});
+  if(etagCache.size > ETAG_CACHE_MAX) etagCache.delete(etagCache.keys().next().value);
+  return JSON.parse(body);
 }
 
 
@@ -1061,8 +1192,9 @@ function updateAuthUI(){
     // v1.0: ir a home
     goto('home');
     renderHome();
-
+    connectEvents();
   }else{
+    disconnectEvents();
     goto('auth');
     setAuthView('login');
   }
@@ -1426,7 +1558,7 @@ async function renderStats(){
     card.className='card';
     card.innerHTML = `
       <h3>${row.habit_name}</h3>
-      <div class="muted" style="margin-bottom:8px">Últimos 7 días: ${row.done}/${row.total_days} cumplidos (${percent}%)</div>
+      <div class="muted" style="margin-bottom:8px">Últimos ${row.total_days} días: ${row.done}/${row.total_days} cumplidos (${percent}%)</div>
       <div class="progress"><div class="bar" style="width:${percent}%"></div></div>
       <div class="hint" style="margin-top:8px">Hoy: ${data.today} — ${row.today_done? '✅ cumplido' : '—'}</div>
     `;